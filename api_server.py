@@ -0,0 +1,284 @@
+"""
+Asyncio front-end for the inference server.
+
+Accepts generation jobs over localhost HTTP and WebSocket and streams the decoded events of every generated window
+as newline-delimited JSON. All jobs talk to the shared inference server, so concurrent jobs get batched together.
+
+    POST /generate  {"config": "v30", "overrides": {"audio_path": "...", "output_path": "..."}}
+    GET  /ws        WebSocket, send the same JSON as the first text message
+    GET  /metrics   Metrics of the inference server
+"""
+import excepthook  # noqa
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from hydra import initialize_config_dir, compose
+
+from inference import prepare_args, get_args_from_beatmap, get_config, load_model, load_diff_model, generate, \
+    get_server_address, SERVER_NAME
+from osuT5.osuT5.inference.server import get_server_metrics
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+config_dir = os.path.join(script_dir, "configs", "inference")
+
+WS_MAGIC = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_BODY_SIZE = 1 << 20
+WS_CLOSE_INVALID_DATA = 1007  # Close code for a message with data that does not fit its type
+
+diff_models = {}
+diff_models_lock = threading.Lock()
+
+
+def get_diff_models(args):
+    """Loads the diffusion models once and shares them between jobs."""
+    key = (args.diff_ckpt, args.diff_refine_ckpt, args.device)
+    with diff_models_lock:
+        if key not in diff_models:
+            diff_model, diff_tokenizer = load_diff_model(args.diff_ckpt, args.diffusion, args.device)
+            refine_model = None
+            if os.path.exists(args.diff_refine_ckpt):
+                refine_model = load_diff_model(args.diff_refine_ckpt, args.diffusion, args.device)[0]
+            diff_models[key] = (diff_model, diff_tokenizer, refine_model)
+        return diff_models[key]
+
+
+def run_job(args, emit, state: dict):
+    """Runs one generation job in a worker thread. emit is called with every message for the client.
+    The inference client is put in state, so the job can be cancelled from another thread."""
+    prepare_args(args)
+    model, tokenizer = load_model(args.model_path, args.train, args.device, args.max_batch_size, True, args.precision, args.server_memory_budget, args.server_metrics_log, args.server_replicas, args.encoder_cache_size, args.draft_model_path, args.num_draft_tokens, args.weights_cache_dir, args.server_continuous_batching)
+    state['model'] = model
+
+    diff_model, diff_tokenizer, refine_model = None, None, None
+    if args.generate_positions:
+        diff_model, diff_tokenizer, refine_model = get_diff_models(args)
+
+    get_args_from_beatmap(args, tokenizer)
+    generation_config, beatmap_config = get_config(args)
+
+    def on_window(context_type, frame_time, events, event_times):
+        emit({
+            "type": "window",
+            "context": context_type.value,
+            "time": frame_time,
+            "events": [[event.type.value, event.value, time] for event, time in zip(events, event_times)],
+        })
+
+    result, result_path, osz_path = generate(
+        args,
+        generation_config=generation_config,
+        beatmap_path=args.beatmap_path,
+        beatmap_config=beatmap_config,
+        model=model,
+        tokenizer=tokenizer,
+        diff_model=diff_model,
+        diff_tokenizer=diff_tokenizer,
+        refine_model=refine_model,
+        verbose=False,
+        on_window=on_window,
+    )
+    emit({
+        "type": "result",
+        "result_path": str(result_path) if result_path is not None else None,
+        "osz_path": str(osz_path) if osz_path is not None else None,
+        "beatmap": result,
+    })
+
+
+class ApiServer:
+    def __init__(self, max_jobs: int = 8):
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs)
+
+    def parse_job(self, job: dict):
+        # Hydra compose is not thread safe, so configs are only composed on the event loop thread
+        overrides = [f"{k}={json.dumps(v) if not isinstance(v, str) else v}" for k, v in job.get("overrides", {}).items()]
+        args = compose(config_name=job.get("config", "v30"), overrides=overrides)
+        args.use_server = True  # Jobs have to share the inference server to be batched together
+        return args
+
+    async def stream_job(self, job: dict, send):
+        """Runs a job and awaits send for every message until the job finished."""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        state = {}
+
+        def emit(message):
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+
+        def worker():
+            try:
+                run_job(args, emit, state)
+            except Exception as e:
+                traceback.print_exc()
+                emit({"type": "error", "error": str(e)})
+            finally:
+                emit(None)
+
+        try:
+            args = self.parse_job(job)
+        except Exception as e:
+            await send({"type": "error", "error": str(e)})
+            return
+
+        loop.run_in_executor(self.executor, worker)
+        try:
+            while (message := await queue.get()) is not None:
+                await send(message)
+        except ConnectionError:
+            # The client is gone, so stop spending time on its job
+            if 'model' in state:
+                state['model'].cancel()
+            raise
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            if len(request_line) < 2:
+                return
+            method, path = request_line[0], request_line[1]
+            if method == "POST" and path == "/generate":
+                await self.handle_http(reader, writer, headers)
+            elif method == "GET" and path == "/ws" and headers.get("upgrade", "").lower() == "websocket":
+                await self.handle_websocket(reader, writer, headers)
+            elif method == "GET" and path == "/metrics":
+                await self.handle_metrics(writer)
+            else:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def parse_json(payload: bytes) -> dict:
+        """Parses the JSON of a job. Raises ValueError if it is not a JSON object."""
+        job = json.loads(payload) if payload else {}
+        if not isinstance(job, dict):
+            raise ValueError("Job must be a JSON object.")
+        return job
+
+    @staticmethod
+    async def write_bad_request(writer, error: str):
+        body = json.dumps({"type": "error", "error": error}).encode()
+        writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Type: application/json\r\n"
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n%s" % (len(body), body))
+        await writer.drain()
+
+    async def handle_http(self, reader, writer, headers):
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            await self.write_bad_request(writer, "Invalid Content-Length header.")
+            return
+        if length > MAX_BODY_SIZE:
+            writer.write(b"HTTP/1.1 413 Payload Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            return
+        try:
+            # UnicodeDecodeError and JSONDecodeError are ValueErrors too
+            job = self.parse_json(await reader.readexactly(length) if length > 0 else b"")
+        except ValueError as e:
+            await self.write_bad_request(writer, str(e))
+            return
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+                     b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+
+        async def send(message):
+            chunk = (json.dumps(message) + "\n").encode()
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            await writer.drain()
+
+        await self.stream_job(job, send)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def handle_metrics(self, writer):
+        metrics = await asyncio.get_running_loop().run_in_executor(None, get_server_metrics, get_server_address(SERVER_NAME))
+        body = json.dumps(metrics, default=str).encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n%s" % (len(body), body))
+        await writer.drain()
+
+    async def handle_websocket(self, reader, writer, headers):
+        if "sec-websocket-key" not in headers:
+            await self.write_bad_request(writer, "Missing Sec-WebSocket-Key header.")
+            return
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WS_MAGIC).encode()).digest())
+        writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     b"Sec-WebSocket-Accept: %s\r\n\r\n" % accept)
+        await writer.drain()
+
+        async def send(message):
+            self.write_ws_frame(writer, json.dumps(message).encode())
+            await writer.drain()
+
+        try:
+            job = self.parse_json(await self.read_ws_frame(reader))
+        except ValueError as e:
+            await send({"type": "error", "error": str(e)})
+            writer.write(b"\x88\x02" + WS_CLOSE_INVALID_DATA.to_bytes(2, "big"))  # Close frame
+            await writer.drain()
+            return
+
+        await self.stream_job(job, send)
+        writer.write(b"\x88\x00")  # Close frame
+        await writer.drain()
+
+    @staticmethod
+    async def read_ws_frame(reader: asyncio.StreamReader) -> bytes:
+        """Reads a single unfragmented, masked client frame."""
+        header = await reader.readexactly(2)
+        length = header[1] & 0x7F
+        if length == 126:
+            length = int.from_bytes(await reader.readexactly(2), "big")
+        elif length == 127:
+            length = int.from_bytes(await reader.readexactly(8), "big")
+        if length > MAX_BODY_SIZE:
+            raise ConnectionError("WebSocket frame too large.")
+        mask = await reader.readexactly(4) if header[1] & 0x80 else b"\x00" * 4
+        payload = await reader.readexactly(length)
+        return bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+    @staticmethod
+    def write_ws_frame(writer: asyncio.StreamWriter, payload: bytes):
+        """Writes an unmasked text frame."""
+        if len(payload) < 126:
+            header = bytes([0x81, len(payload)])
+        elif len(payload) < 1 << 16:
+            header = bytes([0x81, 126]) + len(payload).to_bytes(2, "big")
+        else:
+            header = bytes([0x81, 127]) + len(payload).to_bytes(8, "big")
+        writer.write(header + payload)
+
+
+async def main(host: str, port: int, max_jobs: int):
+    server = ApiServer(max_jobs)
+    tcp_server = await asyncio.start_server(server.handle_connection, host, port)
+    print(f"Serving on http://{host}:{port}")
+    async with tcp_server:
+        await tcp_server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP/WebSocket front-end for Mapperatorinator inference.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-jobs", type=int, default=8, help="Maximum number of jobs that run at the same time.")
+    opts = parser.parse_args()
+
+    with initialize_config_dir(config_dir=config_dir, version_base="1.1"):
+        asyncio.run(main(opts.host, opts.port, opts.max_jobs))
@@ -0,0 +1,73 @@
+"""
+Measures the import time of a script with `python -X importtime`, to keep the startup of the inference CLI fast.
+The web UI and cli_inference.sh start a new inference.py process for every job, so its startup is paid constantly.
+
+Usage: python benchmark_startup.py [--module inference] [--runs 5] [--top 15]
+"""
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+IMPORT_TIME_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+# Modules which should only be imported once a model is loaded or used
+HEAVY_MODULES = ["torch", "transformers", "accelerate", "osu_diffusion.utils.models", "osuT5.osuT5.model.modeling_mapperatorinator"]
+
+
+def measure(module: str) -> tuple[float, dict[str, tuple[int, int]]]:
+    """Imports the module in a new interpreter.
+    Returns the wall time in seconds and the self and cumulative import time in microseconds of each imported module."""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+    )
+    wall_time = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match is not None:
+            times[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    return wall_time, times
+
+
+def main(args):
+    runs = [measure(args.module) for _ in range(args.runs)]
+    wall_times = [wall_time for wall_time, _ in runs]
+    import_times = [times[args.module][1] for _, times in runs]
+
+    # Report the modules of the run with the median import time
+    median_run = sorted(range(args.runs), key=lambda i: import_times[i])[args.runs // 2]
+    times = runs[median_run][1]
+
+    print(f"Import of {args.module} over {args.runs} runs:")
+    print(f"  import time: {statistics.median(import_times) / 1e6:.3f}s median, {min(import_times) / 1e6:.3f}s min")
+    print(f"  process wall time: {statistics.median(wall_times):.3f}s median, {min(wall_times):.3f}s min")
+    print(f"  modules imported: {len(times)}")
+
+    print(f"\nTop {args.top} modules by cumulative import time:")
+    for name, (self_time, cumulative_time) in sorted(times.items(), key=lambda x: x[1][1], reverse=True)[:args.top]:
+        print(f"  {cumulative_time / 1e6:8.3f}s {self_time / 1e6:8.3f}s  {name}")
+
+    print("\nHeavy modules:")
+    for name in HEAVY_MODULES:
+        print(f"  {name}: {f'{times[name][1] / 1e6:.3f}s' if name in times else 'not imported'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the import time of a script with python -X importtime.")
+    parser.add_argument("--module", type=str, default="inference", help="Module to import.")
+    parser.add_argument("--runs", type=int, default=5, help="Number of runs.")
+    parser.add_argument("--top", type=int, default=15, help="Number of modules to list.")
+    args = parser.parse_args()
+
+    main(args)
@@ -19,6 +19,7 @@ from classifier.libs.model.model import OsuClassifierOutput
 from classifier.libs.utils import load_ckpt
 from config import FidConfig
 from inference import prepare_args, load_diff_model, generate, load_model
+from osuT5.osuT5.dataset.audio_cache import get_audio_cache
 from osuT5.osuT5.dataset.data_utils import load_audio_file, load_mmrs_metadata, filter_mmrs_metadata
 from osuT5.osuT5.inference import generation_config_from_beatmap, beatmap_config_from_beatmap
 from osuT5.osuT5.tokenizer import ContextType
@@ -198,7 +199,7 @@ def generate_beatmaps(beatmap_paths, fid_args: FidConfig, return_dict, idx):
     torch.set_float32_matmul_precision('high')
 
     model, tokenizer, diff_model, diff_tokenizer, refine_model = None, None, None, None, None
-    model, tokenizer = load_model(args.model_path, args.train, args.device, args.max_batch_size, args.use_server, args.precision)
+    model, tokenizer = load_model(args.model_path, args.train, args.device, args.max_batch_size, args.use_server, args.precision, args.server_memory_budget, args.server_metrics_log, args.server_replicas, args.encoder_cache_size, args.draft_model_path, args.num_draft_tokens, args.weights_cache_dir, args.server_continuous_batching)
 
     if args.compile:
         model.transformer.forward = torch.compile(model.transformer.forward, mode="reduce-overhead", fullgraph=True)
@@ -300,7 +301,8 @@ def calculate_metrics(args: FidConfig, beatmap_paths: list[Path]):
             if args.fid:
                 # Calculate feature vectors for real and generated beatmaps
                 sample_rate = classifier_args.data.sample_rate
-                audio = load_audio_file(audio_path, sample_rate, normalize=args.inference.train.data.normalize_audio)
+                audio = load_audio_file(audio_path, sample_rate, normalize=args.inference.train.data.normalize_audio,
+                                        cache=get_audio_cache(args.inference.audio_cache_dir, args.inference.audio_cache_size))
 
                 for example in DataLoader(
                         ExampleDataset(beatmap, audio, classifier_args, classifier_tokenizer, args.device),
@@ -5,7 +5,7 @@ from hydra.core.config_store import ConfigStore
 from omegaconf import MISSING
 
 from osuT5.osuT5.config import TrainConfig
-from osuT5.osuT5.tokenizer import ContextType
+from osuT5.osuT5.event import ContextType
 from osu_diffusion.config import DiffusionTrainConfig
 
 
@@ -61,6 +61,10 @@ class InferenceConfig:
     top_p: float = 0.95  # Top-p sampling threshold
     top_k: int = 0  # Top-k sampling threshold
     parallel: bool = False  # Use parallel sampling
+    pipeline: bool = True  # Prepare the next window on a worker thread while the current window decodes in sequential sampling (only with CUDA or the inference server)
+    parallel_chunks: int = 0  # Split the song at quiet windows into this many chunks which are sampled sequentially in one batch (0 to disable)
+    variants: list[dict[str, Any]] = field(default_factory=list)  # Overrides of the settings of each beatmap to generate together in one batch, like the difficulties of a mapset (only difficulty, style, metadata and sampling settings)
+    silence_threshold: Optional[float] = None  # Skip windows this many dB quieter than the loudest window, e.g. -50 (None to disable)
     do_sample: bool = True  # Use sampling
     num_beams: int = 1  # Number of beams for beam search
     super_timing: bool = False  # Use super timing generator (slow but accurate timing)
@@ -70,6 +74,18 @@ class InferenceConfig:
     timer_iterations: int = 20  # Number of iterations for timer
     use_server: bool = True  # Use server for optimized multiprocess inference
     max_batch_size: int = 16  # Maximum batch size for inference (only used for parallel sampling or super timing)
+    server_memory_budget: float = 0  # Maximum GB of model weights the inference server keeps loaded (0 for no limit)
+    server_metrics_log: str = ''  # File the inference server appends a JSON snapshot of its metrics to every minute
+    server_replicas: int = 0  # Number of model replicas of the inference server, each pinned to its own CPU cores (0 to disable)
+    server_continuous_batching: bool = False  # Let rows join and leave the running batch of the inference server at every token
+    audio_cache_dir: str = ''  # Directory to cache decoded audio in, so repeated runs on the same song skip decoding (empty to disable)
+    audio_cache_size: float = 10  # Maximum GB of decoded audio to keep in the cache
+    precompute_spectrogram: bool = False  # Compute the spectrogram once for the whole song instead of once per window
+    stream_audio: bool = False  # Decode audio in chunks into a memory-mapped file, so memory use does not grow with song length
+    encoder_cache_size: float = 0  # GB of encoder outputs to keep on the model device, so repeated passes over the same audio skip the encoder, e.g. 1 (0 to disable)
+    draft_model_path: str = ''  # Path to a small model with the same tokenizer for speculative decoding (empty to disable)
+    num_draft_tokens: int = 4  # Number of tokens the draft model proposes per forward pass of the main model
+    weights_cache_dir: str = ''  # Directory to keep model weights converted to the inference precision in, so later runs memory-map them directly, e.g. '~/.cache/mapperatorinator/weights' (empty to disable)
     resnap_events: bool = True  # Resnap notes to the timing after generation
 
     # Metadata settings
@@ -1,34 +1,38 @@
+from __future__ import annotations
+
 import excepthook  # noqa
 import os.path
-from functools import reduce
+from functools import reduce, partial
 from pathlib import Path
 import random
+from typing import TYPE_CHECKING
 
 import hydra
-import torch
-from accelerate.utils import set_seed
 from omegaconf import OmegaConf, DictConfig
 from slider import Beatmap
-from transformers.utils import cached_file
 
-import osu_diffusion
-import routed_pickle
 from config import InferenceConfig, FidConfig
-from diffusion_pipeline import DiffisionPipeline
 from osuT5.osuT5.config import TrainConfig
-from osuT5.osuT5.dataset.data_utils import events_of_type, TIMING_TYPES, merge_events
-from osuT5.osuT5.inference import Preprocessor, Processor, Postprocessor, BeatmapConfig, GenerationConfig, \
-    generation_config_from_beatmap, beatmap_config_from_beatmap, background_line
-from osuT5.osuT5.inference.server import InferenceClient
-from osuT5.osuT5.inference.super_timing_generator import SuperTimingGenerator
-from osuT5.osuT5.model import Mapperatorinator
-from osuT5.osuT5.tokenizer import Tokenizer, ContextType
-from osuT5.osuT5.utils import get_model
-from osu_diffusion import DiT_models
-from osu_diffusion.config import DiffusionTrainConfig
+from osuT5.osuT5.event import ContextType
+
+# Torch, transformers and the model stacks are imported where they are first used, so the CLI starts fast
+# and processes which only need the helpers, like the web UI, never load them
+if TYPE_CHECKING:
+    from osuT5.osuT5.inference import BeatmapConfig, GenerationConfig
+    from osuT5.osuT5.inference.server import InferenceClient
+    from osuT5.osuT5.model import Mapperatorinator
+    from osuT5.osuT5.tokenizer import Tokenizer
+    from osu_diffusion.config import DiffusionTrainConfig
+
+
+# Name of the inference server shared by all models
+SERVER_NAME = "Mapperatorinator"
 
 
 def prepare_args(args: FidConfig | InferenceConfig):
+    import torch
+    from accelerate.utils import set_seed
+
     if args.device == "auto":
         if torch.cuda.is_available():
             print("Using CUDA for inference (auto-selected).")
@@ -169,6 +173,8 @@ def get_args_from_beatmap(args: InferenceConfig, tokenizer: Tokenizer):
     if beatmap.mode not in args.train.data.gamemodes and (any(c in [ContextType.MAP, ContextType.GD, ContextType.NO_HS] for c in args.in_context) or args.add_to_beatmap):
         raise ValueError(f"Beatmap mode {beatmap.mode} is not supported by the model. Supported modes: {args.train.data.gamemodes}")
 
+    from osuT5.osuT5.inference import generation_config_from_beatmap, beatmap_config_from_beatmap
+
     print(f"Using metadata from beatmap: {beatmap.display_name}")
     generation_config = generation_config_from_beatmap(beatmap, tokenizer)
 
@@ -270,6 +276,8 @@ def get_tags_dict(args: DictConfig | InferenceConfig):
 
 
 def get_config(args: InferenceConfig):
+    from osuT5.osuT5.inference import BeatmapConfig, GenerationConfig, background_line
+
     # Create tags that describes args
     tags = get_tags_dict(args)
     # Filter to all non-default values
@@ -334,12 +342,84 @@ def generate(
         diff_tokenizer=None,
         refine_model=None,
         verbose=True,
+        on_window=None,
 ):
+    return generate_variants(
+        args,
+        audio_path=audio_path,
+        beatmap_path=beatmap_path,
+        output_path=output_path,
+        generation_configs=[generation_config],
+        beatmap_configs=[beatmap_config],
+        model=model,
+        tokenizer=tokenizer,
+        diff_model=diff_model,
+        diff_tokenizer=diff_tokenizer,
+        refine_model=refine_model,
+        verbose=verbose,
+        on_window=on_window,
+    )[0]
+
+
+# Settings of args.variants which only go into the generation and beatmap configs, so they may differ between variants
+VARIANT_CONFIG_SETTINGS = (
+    'beatmap_id', 'difficulty', 'mapper_id', 'year', 'hitsounded', 'hp_drain_rate', 'circle_size', 'overall_difficulty',
+    'approach_rate', 'slider_multiplier', 'slider_tick_rate', 'keycount', 'hold_note_ratio', 'scroll_speed_ratio',
+    'descriptors', 'negative_descriptors', 'creator', 'version', 'background', 'preview_time',
+)
+
+
+def get_variant_configs(args: InferenceConfig) -> tuple[list[GenerationConfig], list[BeatmapConfig], list[dict]]:
+    """
+    Returns the generation config, beatmap config and sampling settings of each variant in args.variants.
+    Raises a ValueError if a variant overrides a setting which has to be the same for all variants of a batch.
+    """
+    from osuT5.osuT5.inference.processor import SAMPLING_SETTINGS
+
+    generation_configs, beatmap_configs, sampling_settings = [], [], []
+    for variant in args.variants:
+        invalid = [k for k in variant if k not in VARIANT_CONFIG_SETTINGS and k not in SAMPLING_SETTINGS]
+        if len(invalid) > 0:
+            raise ValueError(f"Variants can not override {', '.join(invalid)}. Allowed settings: {', '.join(VARIANT_CONFIG_SETTINGS + SAMPLING_SETTINGS)}")
+        variant_args = OmegaConf.merge(args, variant)
+        generation_config, beatmap_config = get_config(variant_args)
+        generation_configs.append(generation_config)
+        beatmap_configs.append(beatmap_config)
+        sampling_settings.append({k: variant_args[k] for k in SAMPLING_SETTINGS})
+    return generation_configs, beatmap_configs, sampling_settings
+
+
+def generate_variants(
+        args: InferenceConfig,
+        *,
+        audio_path: str = None,
+        beatmap_path: str = None,
+        output_path: str = None,
+        generation_configs: list[GenerationConfig],
+        beatmap_configs: list[BeatmapConfig],
+        sampling_settings: list[dict] = None,
+        model: Mapperatorinator | InferenceClient,
+        tokenizer,
+        diff_model=None,
+        diff_tokenizer=None,
+        refine_model=None,
+        verbose=True,
+        on_window=None,
+):
+    """
+    Generates a beatmap for each pair of generation and beatmap configs on the same audio, like all difficulties of a mapset.
+    The audio is loaded and segmented once, and the windows of all variants are generated together as rows of one batch.
+    sampling_settings may override the sampling settings of args for each variant, see Processor.generate_variants.
+    Returns the result, result path and .osz path of each variant.
+    """
     audio_path = args.audio_path if audio_path is None else audio_path
     beatmap_path = args.beatmap_path if beatmap_path is None else beatmap_path
     output_path = args.output_path if output_path is None else output_path
+    num_variants = len(generation_configs)
 
     # Do some validation
+    if len(beatmap_configs) != num_variants:
+        raise ValueError(f"Expected a beatmap config for each of the {num_variants} generation configs, got {len(beatmap_configs)}.")
     if not Path(audio_path).exists() or not Path(audio_path).is_file():
         raise FileNotFoundError(f"Provided audio file path does not exist: {audio_path}")
     if beatmap_path:
@@ -350,100 +430,122 @@ def generate(
         if beatmap_path_obj.suffix.lower() != '.osu':
             raise ValueError(f"Beatmap file must have .osu extension: {beatmap_path}")
 
+    from osuT5.osuT5.dataset.data_utils import events_of_type, TIMING_TYPES, merge_events
+    from osuT5.osuT5.inference import Preprocessor, Processor, Postprocessor
+
     preprocessor = Preprocessor(args, parallel=args.parallel)
     processor = Processor(args, model, tokenizer)
+    processor.on_window = on_window
     postprocessor = Postprocessor(args)
 
     audio = preprocessor.load(audio_path)
     sequences = preprocessor.segment(audio)
-    extra_in_context = {}
+    extra_in_contexts = [{} for _ in range(num_variants)]
     output_type = args.output_type.copy()
 
     # Auto generate timing if not provided in in_context and required for the model and this output_type
-    timing_events, timing_times, timing = None, None, None
+    timing_events, timings = [None] * num_variants, [None] * num_variants
     if args.super_timing and ContextType.NONE in args.in_context:
+        from osuT5.osuT5.inference.super_timing_generator import SuperTimingGenerator
+
         super_timing_generator = SuperTimingGenerator(args, model, tokenizer)
-        timing_events, timing_times = super_timing_generator.generate(audio, generation_config, verbose=verbose)
-        timing = postprocessor.generate_timing(timing_events)
-        extra_in_context[ContextType.TIMING] = timing
+        for i, generation_config in enumerate(generation_configs):
+            timing_events[i], _ = super_timing_generator.generate(audio, generation_config, verbose=verbose)
+            timings[i] = postprocessor.generate_timing(timing_events[i])
+            extra_in_contexts[i][ContextType.TIMING] = timings[i]
         if ContextType.TIMING in output_type:
             output_type.remove(ContextType.TIMING)
     elif (ContextType.NONE in args.in_context and ContextType.MAP in output_type and
           not any((ContextType.NONE in ctx["in"] or len(ctx["in"]) == 0) and ContextType.MAP in ctx["out"] for ctx in args.train.data.context_types)):
         # Generate timing and convert in_context to timing context
-        timing_events, timing_times = processor.generate(
+        results = processor.generate_variants(
             sequences=sequences,
-            generation_config=generation_config,
+            generation_configs=generation_configs,
             in_context=[ContextType.NONE],
             out_context=[ContextType.TIMING],
+            sampling_settings=sampling_settings,
             verbose=verbose,
-        )[0]
-        timing_events, timing_times = events_of_type(timing_events, timing_times, TIMING_TYPES)
-        timing = postprocessor.generate_timing(timing_events)
-        extra_in_context[ContextType.TIMING] = timing
+        )
+        for i, result in enumerate(results):
+            timing_events[i], _ = events_of_type(*result[0], TIMING_TYPES)
+            timings[i] = postprocessor.generate_timing(timing_events[i])
+            extra_in_contexts[i][ContextType.TIMING] = timings[i]
         if ContextType.TIMING in output_type:
             output_type.remove(ContextType.TIMING)
     elif ContextType.TIMING in args.in_context or (
             args.train.data.add_timing and any(t in args.in_context for t in [ContextType.GD, ContextType.NO_HS])):
         # Exact timing is provided in the other beatmap, so we don't need to generate it
         timing = [tp for tp in Beatmap.from_path(Path(beatmap_path)).timing_points if tp.parent is None]
+        timings = [timing] * num_variants
 
-    # Generate beatmap
+    # Generate beatmaps
+    variant_events = timing_events
     if len(output_type) > 0:
-        result = processor.generate(
+        results = processor.generate_variants(
             sequences=sequences,
-            generation_config=generation_config,
+            generation_configs=generation_configs,
             in_context=args.in_context,
             out_context=output_type,
             beatmap_path=beatmap_path,
-            extra_in_context=extra_in_context,
+            extra_in_contexts=extra_in_contexts,
+            sampling_settings=sampling_settings,
             verbose=verbose,
         )
 
-        events, _ = reduce(merge_events, result)
+        variant_events = []
+        for i, result in enumerate(results):
+            events, _ = reduce(merge_events, result)
 
-        if timing is None and (ContextType.TIMING in args.output_type or args.train.data.add_timing):
-            timing = postprocessor.generate_timing(events)
+            if timings[i] is None and (ContextType.TIMING in args.output_type or args.train.data.add_timing):
+                timings[i] = postprocessor.generate_timing(events)
 
-        # Resnap timing events
-        if args.resnap_events and timing is not None:
-            events = postprocessor.resnap_events(events, timing)
-    else:
-        events = timing_events
+            # Resnap timing events
+            if args.resnap_events and timings[i] is not None:
+                events = postprocessor.resnap_events(events, timings[i])
+            variant_events.append(events)
 
-    # Generate positions with diffusion
+    diffusion_pipeline = None
     if args.generate_positions and args.gamemode in [0, 2] and ContextType.MAP in output_type:
+        from diffusion_pipeline import DiffisionPipeline
+
         diffusion_pipeline = DiffisionPipeline(args, diff_model, diff_tokenizer, refine_model)
-        events = diffusion_pipeline.generate(
+
+    outputs = []
+    for events, timing, generation_config, beatmap_config in zip(variant_events, timings, generation_configs, beatmap_configs):
+        # Generate positions with diffusion
+        if diffusion_pipeline is not None:
+            events = diffusion_pipeline.generate(
+                events=events,
+                generation_config=generation_config,
+                timing=timing,
+                verbose=verbose,
+            )
+
+        result = postprocessor.generate(
             events=events,
-            generation_config=generation_config,
+            beatmap_config=beatmap_config,
             timing=timing,
-            verbose=verbose,
         )
 
-    result = postprocessor.generate(
-        events=events,
-        beatmap_config=beatmap_config,
-        timing=timing,
-    )
+        result_path = None
+        osz_path = None
+        if args.add_to_beatmap:
+            result_path = postprocessor.add_to_beatmap(result, beatmap_path)
+            if verbose:
+                print(f"Added generated content to {result_path}")
+        elif output_path is not None and output_path != "":
+            result_path = postprocessor.write_result(result, output_path)
+            if verbose:
+                print(f"Generated beatmap saved to {result_path}")
 
-    result_path = None
-    osz_path = None
-    if args.add_to_beatmap:
-        result_path = postprocessor.add_to_beatmap(result, beatmap_path)
-        if verbose:
-            print(f"Added generated content to {result_path}")
-    elif output_path is not None and output_path != "":
-        result_path = postprocessor.write_result(result, output_path)
-        if verbose:
-            print(f"Generated beatmap saved to {result_path}")
+        if args.export_osz:
+            osz_path = postprocessor.export_osz(result_path, audio_path, output_path)
+            if verbose:
+                print(f"Generated .osz saved to {osz_path}")
 
-    if args.export_osz:
-        osz_path = postprocessor.export_osz(result_path, audio_path, output_path)
-        if verbose:
-            print(f"Generated .osz saved to {osz_path}")
+        outputs.append((result, result_path, osz_path))
 
-    return result, result_path, osz_path
+    return outputs
 
 
 def load_model(
@@ -453,49 +555,36 @@ def load_model(
         max_batch_size: int = 8,
         use_server: bool = False,
         precision: str = "fp32",
+        server_memory_budget: float = 0,
+        server_metrics_log: str = "",
+        server_replicas: int = 0,
+        encoder_cache_size: float = 0,
+        draft_model_path: str = "",
+        num_draft_tokens: int = 4,
+        weights_cache_dir: str = "",
+        server_continuous_batching: bool = False,
 ):
     if ckpt_path_str == "":
         raise ValueError("Model path is empty.")
 
-    ckpt_path = Path(ckpt_path_str)
-
-    def tokenizer_loader():
-        if not (ckpt_path / "pytorch_model.bin").exists() or not (ckpt_path / "custom_checkpoint_0.pkl").exists():
-            tokenizer = Tokenizer.from_pretrained(ckpt_path_str)
-        else:
-            tokenizer_state = torch.load(ckpt_path / "custom_checkpoint_0.pkl", pickle_module=routed_pickle, weights_only=False)
-            tokenizer = Tokenizer()
-            tokenizer.load_state_dict(tokenizer_state)
-        return tokenizer
+    from osuT5.osuT5.inference.model_loading import load_tokenizer, load_mapperatorinator
+    from osuT5.osuT5.inference.server import InferenceClient
 
+    # Use partials of module-level functions, so the loaders can be sent to an inference server in another process
+    tokenizer_loader = partial(load_tokenizer, ckpt_path_str)
     tokenizer = tokenizer_loader()
-
-    def model_loader():
-        if not (ckpt_path / "pytorch_model.bin").exists() or not (ckpt_path / "custom_checkpoint_0.pkl").exists():
-            model = Mapperatorinator.from_pretrained(ckpt_path_str)
-            model.generation_config.disable_compile = True
-        else:
-            model_state = torch.load(ckpt_path / "pytorch_model.bin", map_location=device, weights_only=True)
-            model = get_model(t5_args, tokenizer)
-            model.load_state_dict(model_state)
-
-        model.eval()
-        model.to(device)
-
-        if precision == "bf16":
-            # Cast every submodule to bfloat16 except for the spectrogram module
-            for name, module in model.named_modules():
-                if name != "" and "spectrogram" not in name:
-                    module.to(torch.bfloat16)
-
-        print(f"Model loaded: {ckpt_path_str} on device {device}")
-        return model
+    model_loader = partial(load_mapperatorinator, ckpt_path_str, t5_args, device, precision, int(encoder_cache_size * 1024 ** 3), draft_model_path, num_draft_tokens, weights_cache_dir)
 
     return InferenceClient(
         model_loader,
         tokenizer_loader,
         max_batch_size=max_batch_size,
-        socket_path=get_server_address(ckpt_path_str),
+        socket_path=get_server_address(SERVER_NAME),
+        model_id=f"{ckpt_path_str}:{device}:{precision}",
+        memory_budget=int(server_memory_budget * 1024 ** 3) if server_memory_budget > 0 else None,
+        metrics_log_path=server_metrics_log or None,
+        num_replicas=server_replicas,
+        continuous_batching=server_continuous_batching,
     ) if use_server else model_loader(), tokenizer
 
 
@@ -518,6 +607,12 @@ def load_diff_model(
         diff_args: DiffusionTrainConfig,
         device,
 ):
+    import torch
+    from transformers.utils import cached_file
+
+    import routed_pickle
+    from osu_diffusion import DiT_models, Tokenizer as DiffusionTokenizer
+
     if not os.path.exists(ckpt_path) and ckpt_path != "":
         tokenizer_file = cached_file(ckpt_path, "tokenizer.pkl")
         model_file = cached_file(ckpt_path, "model_ema.pkl")
@@ -527,7 +622,7 @@ def load_diff_model(
         model_file = ckpt_path / "model_ema.pkl"
 
     tokenizer_state = torch.load(tokenizer_file, pickle_module=routed_pickle, weights_only=False)
-    tokenizer = osu_diffusion.utils.tokenizer.Tokenizer()
+    tokenizer = DiffusionTokenizer()
     tokenizer.load_state_dict(tokenizer_state)
 
     ema_state = torch.load(model_file, pickle_module=routed_pickle, weights_only=False, map_location=device)
@@ -544,7 +639,7 @@ def load_diff_model(
 def main(args: InferenceConfig):
     prepare_args(args)
 
-    model, tokenizer = load_model(args.model_path, args.train, args.device, args.max_batch_size, args.use_server, args.precision)
+    model, tokenizer = load_model(args.model_path, args.train, args.device, args.max_batch_size, args.use_server, args.precision, args.server_memory_budget, args.server_metrics_log, args.server_replicas, args.encoder_cache_size, args.draft_model_path, args.num_draft_tokens, args.weights_cache_dir, args.server_continuous_batching)
 
     diff_model, diff_tokenizer, refine_model = None, None, None
     if args.generate_positions:
@@ -554,9 +649,28 @@ def main(args: InferenceConfig):
             refine_model = load_diff_model(args.diff_refine_ckpt, args.diffusion, args.device)[0]
 
         if args.compile:
+            import torch
+
             diff_model.forward = torch.compile(diff_model.forward, mode="reduce-overhead", fullgraph=True)
 
     get_args_from_beatmap(args, tokenizer)
+
+    if len(args.variants) > 0:
+        # Generate all variants in one batch, each with its own overrides of the generation and sampling settings
+        generation_configs, beatmap_configs, sampling_settings = get_variant_configs(args)
+        return generate_variants(
+            args,
+            generation_configs=generation_configs,
+            beatmap_path=args.beatmap_path,
+            beatmap_configs=beatmap_configs,
+            sampling_settings=sampling_settings,
+            model=model,
+            tokenizer=tokenizer,
+            diff_model=diff_model,
+            diff_tokenizer=diff_tokenizer,
+            refine_model=refine_model,
+        )
+
     generation_config, beatmap_config = get_config(args)
 
     return generate(
@@ -29,13 +29,10 @@ def play_hs(audio, tokens, sr, tokenizer):
     hitsound_amp = 0.2
 
     # Find time events in labels
-    time_indices = []
-    for t in tokens:
-        if tokenizer.event_start[EventType.TIME_SHIFT] <= t < tokenizer.event_end[EventType.TIME_SHIFT]:
-            time_event = tokenizer.decode(t.item())
-            # Convert to sample index
-            x = int(time_event.value / STEPS_PER_MILLISECOND / 1000 * sr)
-            time_indices.append(x)
+    type_indices, values = tokenizer.decode_many(tokens)
+    time_values = values[type_indices == tokenizer.event_type_index[EventType.TIME_SHIFT]]
+    # Convert to sample index
+    time_indices = [int(value / STEPS_PER_MILLISECOND / 1000 * sr) for value in time_values.tolist()]
 
     # Add hitsounds
     audio_with_hits = audio.copy()
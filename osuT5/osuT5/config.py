@@ -139,6 +139,8 @@ class DataConfig:
     max_year: Optional[int] = None  # Maximum year of the beatmap to include in the dataset
     frame_offset_augment_prob: float = 1.0  # Probability of augmenting beatmap sequences with frame offset
     normalize_audio: bool = True  # Normalize audio data
+    audio_cache_dir: str = ''  # Directory to cache decoded audio in (empty to disable)
+    audio_cache_size: float = 50  # Maximum GB of decoded audio to keep in the cache
     slider_version: int = 1  # Slider version to use (1 or 2)
 
 
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import functools
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, Callable, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+BYTES_PER_GB = 1024 ** 3
+
+
+class AudioCache(object):
+    def __init__(self, directory: str | os.PathLike, max_size: float = 10):
+        """On-disk cache of decoded audio.
+
+        Entries are mono float32 `.npy` files addressed by the hash of the source file contents
+        and the decoding parameters. Hits are opened memory-mapped copy-on-write, so repeated loads skip
+        ffmpeg, processes reading the same song share its pages and writes to the samples never reach the
+        cache. The least recently used entries are evicted when the total size exceeds `max_size`.
+
+        Args:
+            directory: Directory to store the cache entries in.
+            max_size: Maximum size of the cache in GB (0 for no limit).
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(max_size * BYTES_PER_GB)
+        self._file_hashes: dict[tuple[str, int, int], str] = {}
+
+    def _hash_file(self, file: Path) -> str:
+        stat = file.stat()
+        memo_key = (str(file.resolve()), stat.st_size, stat.st_mtime_ns)
+        digest = self._file_hashes.get(memo_key)
+        if digest is None:
+            h = hashlib.blake2b(digest_size=16)
+            with open(file, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            self._file_hashes[memo_key] = digest
+        return digest
+
+    def get_path(self, file: str | os.PathLike, sample_rate: int, speed: float, normalize: bool) -> Path:
+        key = f"{self._hash_file(Path(file))}:{sample_rate}:{float(speed)!r}:{bool(normalize)}"
+        return self.directory / f"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}.npy"
+
+    def load(
+            self,
+            file: str | os.PathLike,
+            sample_rate: int,
+            speed: float,
+            normalize: bool,
+            write: Callable[[BinaryIO], None],
+    ) -> npt.NDArray:
+        """Load decoded audio from the cache, decoding and storing it on a miss.
+
+        Args:
+            file: Path to the source audio file.
+            sample_rate: Sample rate of the decoded audio.
+            speed: Speed multiplier of the decoded audio.
+            normalize: Whether the decoded audio is normalized.
+            write: Function which decodes the audio into a .npy file on a cache miss.
+
+        Returns:
+            samples: Copy-on-write memory-mapped audio time series.
+        """
+        path = self.get_path(file, sample_rate, speed, normalize)
+
+        try:
+            samples = np.load(path, mmap_mode="c")
+            os.utime(path)
+            return samples
+        except (FileNotFoundError, ValueError, OSError):
+            pass
+
+        self._store(path, write)
+        samples = np.load(path, mmap_mode="c")
+        self._evict()
+        return samples
+
+    def _store(self, path: Path, write: Callable[[BinaryIO], None]) -> None:
+        # Write to a temporary file first so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w+b") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _evict(self) -> None:
+        if self.max_bytes <= 0:
+            return
+
+        entries = []
+        for path in self.directory.glob("*.npy"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                # Entries which are still mapped can not be removed on every platform
+                continue
+            total -= size
+
+
+@functools.lru_cache(maxsize=None)
+def get_audio_cache(directory: str, max_size: float = 10) -> Optional[AudioCache]:
+    """Get the shared audio cache for a directory, or None if the directory is empty."""
+    if not directory:
+        return None
+    return AudioCache(directory, max_size)
@@ -1,16 +1,23 @@
 import dataclasses
+import os
+import subprocess
+import tempfile
+import weakref
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Iterable, Iterator, Optional
 
 import numpy as np
 import pandas as pd
 from pandas import DataFrame
 from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError
+from pydub.utils import audioop, mediainfo_json
 
 import numpy.typing as npt
 from slider import Beatmap, HoldNote, TimingPoint
 
+from .audio_cache import AudioCache
 from ..event import Event, EventType
 
 MILISECONDS_PER_SECOND = 1000
@@ -73,7 +80,14 @@ TIMED_EVENTS = [
 ]
 
 
-def load_audio_file(file: str, sample_rate: int, speed: float = 1.0, normalize: bool = True) -> npt.NDArray:
+def load_audio_file(
+        file: str,
+        sample_rate: int,
+        speed: float = 1.0,
+        normalize: bool = True,
+        cache: Optional[AudioCache] = None,
+        stream: bool = False,
+) -> npt.NDArray:
     """Load an audio file as a numpy time-series array
 
     The signals are resampled, converted to mono channel, and normalized.
@@ -83,10 +97,39 @@ def load_audio_file(file: str, sample_rate: int, speed: float = 1.0, normalize:
         sample_rate: Sample rate to resample the audio.
         speed: Speed multiplier for the audio.
         normalize: If True, normalize the audio samples to the range [-1, 1].
+        cache: Optional on-disk cache of decoded audio. Cached samples are returned copy-on-write memory-mapped.
+        stream: If True, decode the audio in chunks into a memory-mapped file instead of memory,
+            so memory use does not grow with the length of the song.
 
     Returns:
         samples: Audio time series.
     """
+    if stream:
+        def write(f: BinaryIO):
+            save_audio_stream(f, stream_audio_file(file, sample_rate, speed), normalize)
+    else:
+        def write(f: BinaryIO):
+            np.save(f, load_audio_file(file, sample_rate, speed, normalize))
+
+    if cache is not None:
+        return cache.load(file, sample_rate, speed, normalize, write)
+
+    if stream:
+        fd, path = tempfile.mkstemp(suffix=".npy")
+        try:
+            with os.fdopen(fd, "w+b") as f:
+                write(f)
+            samples = np.load(path, mmap_mode="c")
+        except BaseException:
+            os.remove(path)
+            raise
+        try:
+            # The mapping stays valid after unlinking on POSIX, elsewhere remove the file once the samples are freed
+            os.remove(path)
+        except OSError:
+            weakref.finalize(samples, _try_remove, path)
+        return samples
+
     file = Path(file)
     audio = AudioSegment.from_file(file)
     audio.frame_rate = int(audio.frame_rate * speed)
@@ -94,10 +137,144 @@ def load_audio_file(file: str, sample_rate: int, speed: float = 1.0, normalize:
     audio = audio.set_channels(1)
     samples = np.array(audio.get_array_of_samples()).astype(np.float32)
     if normalize:
-        samples *= 1.0 / np.max(np.abs(samples))
+        samples /= np.max(np.abs(samples))
     return samples
 
 
+def stream_audio_file(
+        file: str,
+        sample_rate: int,
+        speed: float = 1.0,
+        chunk_frames: int = 1 << 18,
+) -> Iterator[npt.NDArray]:
+    """Decode an audio file in chunks.
+
+    Decodes with the same ffmpeg settings, resampling, and down-mixing as `load_audio_file`,
+    so the concatenated chunks are equal to its unnormalized output.
+
+    Args:
+        file: Path to audio file.
+        sample_rate: Sample rate to resample the audio.
+        speed: Speed multiplier for the audio.
+        chunk_frames: Number of source frames to decode per chunk.
+
+    Yields:
+        samples: Consecutive chunks of the mono audio time series as float32.
+    """
+    file = str(file)
+    info = mediainfo_json(file)
+    audio_streams = [x for x in info.get("streams", []) if x["codec_type"] == "audio"]
+    if len(audio_streams) == 0:
+        raise CouldntDecodeError(f"No audio stream found in {file}")
+    stream = audio_streams[0]
+    if stream.get("sample_fmt") == "fltp" and stream.get("codec_name") in ["mp3", "mp4", "aac", "webm", "ogg"]:
+        bits_per_sample = 16
+    else:
+        bits_per_sample = int(stream["bits_per_sample"])
+    channels = int(stream["channels"])
+    frame_rate = int(int(stream["sample_rate"]) * speed)
+
+    raw_format = "u8" if bits_per_sample == 8 else f"s{bits_per_sample}le"
+    acodec = "pcm_u8" if bits_per_sample == 8 else f"pcm_s{bits_per_sample}le"
+    # Like pydub, 24-bit samples are widened to 32-bit words without rescaling
+    sample_width = 4 if bits_per_sample == 24 else bits_per_sample // 8
+    dtype = np.dtype(f"<i{sample_width}")
+
+    command = [AudioSegment.converter, "-nostdin", "-v", "error", "-i", file,
+               "-acodec", acodec, "-vn", "-f", raw_format, "-"]
+    # Write stderr to a file, so ffmpeg can not block on a full stderr pipe while stdout is read
+    with tempfile.TemporaryFile() as stderr_file:
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file)
+        try:
+            state = None
+            while True:
+                data = p.stdout.read(chunk_frames * channels * bits_per_sample // 8)
+                if len(data) == 0:
+                    break
+                if bits_per_sample == 8:
+                    data = audioop.bias(data, 1, -128)
+                elif bits_per_sample == 24:
+                    raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+                    widened = np.empty((len(raw), 4), dtype=np.uint8)
+                    widened[:, 0] = np.where(raw[:, 2] > 0x7f, 0xff, 0)
+                    widened[:, 1:] = raw
+                    data = widened.tobytes()
+
+                if frame_rate != sample_rate:
+                    data, state = audioop.ratecv(data, sample_width, channels, frame_rate, sample_rate, state)
+
+                if channels == 2:
+                    data = audioop.tomono(data, sample_width, 0.5, 0.5)
+                    samples = np.frombuffer(data, dtype=dtype)
+                elif channels > 2:
+                    frames = np.frombuffer(data, dtype=dtype).reshape(-1, channels)
+                    samples = (frames // channels).sum(axis=1, dtype=dtype)
+                else:
+                    samples = np.frombuffer(data, dtype=dtype)
+
+                yield samples.astype(np.float32)
+
+            if p.wait() != 0:
+                stderr_file.seek(0)
+                stderr = stderr_file.read()
+                raise CouldntDecodeError(
+                    f"Decoding failed. ffmpeg returned error code: {p.returncode}\n\n"
+                    f"Output from ffmpeg/avlib:\n\n{stderr.decode(errors='ignore')}")
+        finally:
+            if p.poll() is None:
+                p.kill()
+            p.stdout.close()
+            p.wait()
+
+
+def save_audio_stream(f: BinaryIO, chunks: Iterable[npt.NDArray], normalize: bool = True) -> None:
+    """Write streamed audio samples to a .npy file without holding all of them in memory.
+
+    Args:
+        f: Writable and seekable binary file.
+        chunks: Chunks of a float32 audio time series.
+        normalize: If True, normalize the audio samples to the range [-1, 1].
+    """
+    start = f.tell()
+    # The length is only known at the end, so reserve room for the largest header and fill it in afterward
+    f.write(_npy_header(np.iinfo(np.int64).max))
+    length = 0
+    peak = np.float32(0)
+    for chunk in chunks:
+        f.write(chunk.tobytes())
+        length += len(chunk)
+        if len(chunk) > 0:
+            peak = max(peak, np.max(np.abs(chunk)))
+    f.seek(start)
+    f.write(_npy_header(length))
+    f.flush()
+
+    if normalize and length > 0:
+        samples = np.memmap(f, dtype=np.float32, mode="r+", offset=start + _NPY_HEADER_SIZE, shape=(length,))
+        # Divide like load_audio_file, so the result is equal to the in-memory path
+        for i in range(0, length, 1 << 22):
+            samples[i:i + (1 << 22)] /= peak
+        samples.flush()
+        del samples
+    f.seek(0, os.SEEK_END)
+
+
+_NPY_HEADER_SIZE = 128
+
+
+def _npy_header(length: int) -> bytes:
+    header = f"{{'descr': '<f4', 'fortran_order': False, 'shape': ({length},), }}"
+    header = header.ljust(_NPY_HEADER_SIZE - 11) + "\n"
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1")
+
+
+def _try_remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
 def load_mmrs_metadata(path) -> DataFrame:
     # Loads the metadata parquet from the dataset path
     df = pd.read_parquet(Path(path) / "metadata.parquet")
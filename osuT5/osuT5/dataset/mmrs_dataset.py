@@ -13,6 +13,7 @@ from pandas import Series, DataFrame
 from slider import Beatmap
 from torch.utils.data import IterableDataset
 
+from .audio_cache import get_audio_cache
 from .data_utils import load_audio_file, remove_events_of_type, get_hold_note_ratio, get_scroll_speed_ratio, \
     get_hitsounded_status, get_song_length, load_mmrs_metadata, filter_mmrs_metadata
 from .osu_parser import OsuParser
@@ -477,6 +478,10 @@ class BeatmapDatasetIterable:
 
         return special_tokens
 
+    def _encode_events(self, events: list[Event]) -> torch.Tensor:
+        values = np.fromiter((event.value for event in events), dtype=np.int64, count=len(events))
+        return torch.from_numpy(self.tokenizer.encode_many([event.type for event in events], values))
+
     def _tokenize_sequence(self, sequence: dict) -> dict:
         """Tokenize the event sequence.
 
@@ -492,17 +497,11 @@ class BeatmapDatasetIterable:
         sequence["special_tokens"] = self._get_special_tokens(sequence["special"])
 
         for context in sequence["in_context"] + sequence["out_context"]:
-            tokens = torch.empty(len(context["events"]), dtype=torch.long)
-            for i, event in enumerate(context["events"]):
-                tokens[i] = self.tokenizer.encode(event)
-            context["tokens"] = tokens
+            context["tokens"] = self._encode_events(context["events"])
             context["special_tokens"] = self._get_special_tokens(context)
 
         if "pre_events" in sequence:
-            pre_tokens = torch.empty(len(sequence["pre_events"]), dtype=torch.long)
-            for i, event in enumerate(sequence["pre_events"]):
-                pre_tokens[i] = self.tokenizer.encode(event)
-            sequence["pre_tokens"] = pre_tokens
+            sequence["pre_tokens"] = self._encode_events(sequence["pre_events"])
             del sequence["pre_events"]
 
         return sequence
@@ -715,7 +714,9 @@ class BeatmapDatasetIterable:
             track_path = self.path / "data" / metadata.iloc[0]["BeatmapSetFolder"]
             audio_path = track_path / metadata.iloc[0]["AudioFile"]
             try:
-                audio_samples = load_audio_file(audio_path, self.args.sample_rate, speed, self.args.normalize_audio)
+                # Audio at a random augmented speed is rarely loaded again, so caching it would only evict useful entries
+                cache = get_audio_cache(self.args.audio_cache_dir, self.args.audio_cache_size) if speed == 1.0 else None
+                audio_samples = load_audio_file(audio_path, self.args.sample_rate, speed, self.args.normalize_audio, cache=cache)
             except Exception as e:
                 print(f"Failed to load audio file: {audio_path}")
                 print(e)
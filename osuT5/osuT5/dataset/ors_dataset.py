@@ -13,6 +13,7 @@ import torch
 from slider import Beatmap
 from torch.utils.data import IterableDataset
 
+from .audio_cache import get_audio_cache
 from .data_utils import load_audio_file, remove_events_of_type
 from .osu_parser import OsuParser
 from ..tokenizer import Event, EventType, Tokenizer, ContextType
@@ -374,6 +375,10 @@ class BeatmapDatasetIterable:
 
         return sequence
 
+    def _encode_events(self, events: list[Event]) -> torch.Tensor:
+        values = np.fromiter((event.value for event in events), dtype=np.int64, count=len(events))
+        return torch.from_numpy(self.tokenizer.encode_many([event.type for event in events], values))
+
     def _tokenize_sequence(self, sequence: dict) -> dict:
         """Tokenize the event sequence.
 
@@ -387,10 +392,7 @@ class BeatmapDatasetIterable:
             The same sequence with tokenized events.
         """
         for context in sequence["in_context"] + [sequence["out_context"]]:
-            tokens = torch.empty(len(context["events"]), dtype=torch.long)
-            for i, event in enumerate(context["events"]):
-                tokens[i] = self.tokenizer.encode(event)
-            context["tokens"] = tokens
+            context["tokens"] = self._encode_events(context["events"])
 
             if "beatmap_id" in context:
                 if self.args.add_style_token:
@@ -414,10 +416,7 @@ class BeatmapDatasetIterable:
                         if random.random() >= self.args.descriptor_dropout_prob else [self.tokenizer.descriptor_unk]
 
         if "pre_events" in sequence:
-            pre_tokens = torch.empty(len(sequence["pre_events"]), dtype=torch.long)
-            for i, event in enumerate(sequence["pre_events"]):
-                pre_tokens[i] = self.tokenizer.encode(event)
-            sequence["pre_tokens"] = pre_tokens
+            sequence["pre_tokens"] = self._encode_events(sequence["pre_events"])
             del sequence["pre_events"]
 
         sequence["beatmap_idx"] = sequence["beatmap_idx"] \
@@ -635,7 +634,9 @@ class BeatmapDatasetIterable:
 
             speed = self._get_speed_augment()
             audio_path = beatmap_path.parents[1] / list(beatmap_path.parents[1].glob('audio.*'))[0]
-            audio_samples = load_audio_file(audio_path, self.args.sample_rate, speed, self.args.normalize_audio)
+            # Audio at a random augmented speed is rarely loaded again, so caching it would only evict useful entries
+            cache = get_audio_cache(self.args.audio_cache_dir, self.args.audio_cache_size) if speed == 1.0 else None
+            audio_samples = load_audio_file(audio_path, self.args.sample_rate, speed, self.args.normalize_audio, cache=cache)
 
             for sample in self._get_next_beatmap(audio_samples, beatmap_path, metadata, speed):
                 yield sample
@@ -653,7 +654,9 @@ class BeatmapDatasetIterable:
 
             speed = self._get_speed_augment()
             audio_path = track_path / list(track_path.glob('audio.*'))[0]
-            audio_samples = load_audio_file(audio_path, self.args.sample_rate, speed, self.args.normalize_audio)
+            # Audio at a random augmented speed is rarely loaded again, so caching it would only evict useful entries
+            cache = get_audio_cache(self.args.audio_cache_dir, self.args.audio_cache_size) if speed == 1.0 else None
+            audio_samples = load_audio_file(audio_path, self.args.sample_rate, speed, self.args.normalize_audio, cache=cache)
 
             beatmaps = [list(metadata["Beatmaps"])[-1]] if self.args.only_last_beatmap else metadata["Beatmaps"]
 
@@ -1,7 +1,37 @@
+from __future__ import annotations
+
+import copy
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
 import torch
 from transformers import EncoderDecoderCache, Cache, StaticCache
 
-from osuT5.osuT5.model import Mapperatorinator
+if TYPE_CHECKING:
+    from osuT5.osuT5.model import Mapperatorinator
+
+
+class RowPositionStaticCache(StaticCache):
+    """
+    StaticCache which can also write the new token of each row at a position of its own, given in write_positions.
+    This lets rows at different lengths decode a token together, like the rows of a continuous batch.
+    Without write_positions it updates like a regular StaticCache.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_positions = None
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        if self.write_positions is None:
+            return super().update(key_states, value_states, layer_idx, cache_kwargs)
+        key_cache = self.key_cache[layer_idx]
+        value_cache = self.value_cache[layer_idx]
+        rows = torch.arange(key_cache.shape[0], device=key_cache.device)
+        key_cache[rows, :, self.write_positions] = key_states[:, :, -1].to(key_cache.dtype)
+        value_cache[rows, :, self.write_positions] = value_states[:, :, -1].to(value_cache.dtype)
+        return key_cache, value_cache
 
 
 class MapperatorinatorCache(EncoderDecoderCache):
@@ -29,8 +59,182 @@ def get_cache(model: Mapperatorinator, batch_size: int, num_beams: int = 1, cfg_
         "device": model.device,
         "dtype": model.dtype,
     }
-    decoder_cache = StaticCache(**cache_kwargs)
+    decoder_cache = RowPositionStaticCache(**cache_kwargs)
     encoder_kwargs = cache_kwargs.copy()
     encoder_kwargs["max_cache_len"] = model.config.max_source_positions
     encoder_cache = StaticCache(**encoder_kwargs)
     return MapperatorinatorCache(decoder_cache, encoder_cache, cfg_scale)
+
+
+def get_cache_view(cache: MapperatorinatorCache, batch_size: int, start: int = 0) -> MapperatorinatorCache:
+    """Returns a cache that uses batch_size rows of the preallocated buffers of the given cache, from row start.
+    This allows a single preallocated cache to be shared by batches of varying size."""
+    return MapperatorinatorCache(
+        _narrow_static_cache(cache.self_attention_cache, batch_size, start),
+        _narrow_static_cache(cache.cross_attention_cache, batch_size, start),
+        cache.cfg_scale,
+    )
+
+
+def _narrow_static_cache(cache: StaticCache, batch_size: int, start: int = 0) -> StaticCache:
+    if start + batch_size > cache.max_batch_size:
+        raise ValueError(f"Batch size {batch_size} exceeds the cache capacity of {cache.max_batch_size}.")
+    view = copy.copy(cache)
+    view.max_batch_size = batch_size
+    view.key_cache = [k[start:start + batch_size] for k in cache.key_cache]
+    view.value_cache = [v[start:start + batch_size] for v in cache.value_cache]
+    return view
+
+
+def get_shared_prefix_length(model_kwargs: dict) -> int:
+    """
+    Returns the number of leading decoder positions where the positive and negative prompts agree for all rows.
+    The negative prompt only replaces the first tokens of the prompt, so the halves of a CFG batch often share
+    in-context tokens and padding before the class tokens.
+    """
+    prompt = model_kwargs.get('decoder_input_ids')
+    negative_prompt = model_kwargs.get('negative_prompt')
+    if prompt is None or negative_prompt is None:
+        return 0
+
+    length = min(prompt.shape[1], negative_prompt.shape[1])
+    same = prompt[:, :length] == negative_prompt[:, :length]
+    attention_mask = model_kwargs.get('decoder_attention_mask')
+    negative_attention_mask = model_kwargs.get('negative_prompt_attention_mask')
+    if attention_mask is not None and negative_attention_mask is not None:
+        same &= attention_mask[:, :length].bool() == negative_attention_mask[:, :length].bool()
+    mismatches = (~same).any(dim=0).nonzero()
+    return int(mismatches[0, 0]) if len(mismatches) > 0 else length
+
+
+@torch.no_grad()
+def prefill_shared_prefix(model: Mapperatorinator, cache: MapperatorinatorCache, model_kwargs: dict, length: int):
+    """
+    Runs the decoder once over the first length positions of the negative prompts and copies the resulting
+    KV-cache to the positive half of the CFG batch, so generate only has to prefill the positions after the shared prefix.
+    The cache must be an empty static cache for the doubled batch and model_kwargs must contain encoder_outputs.
+    length must not exceed get_shared_prefix_length(model_kwargs).
+    """
+    # The negative half comes first in the doubled batch, so fill those rows from the negative prompts
+    prompt = model_kwargs['decoder_input_ids'].clone()
+    negative_prompt = model_kwargs['negative_prompt']
+    prompt[:, :negative_prompt.shape[1]] = negative_prompt
+    # Generate takes negative_prompt_attention_mask as an argument of its own, so both halves attend with the prompt's mask
+    attention_mask = model_kwargs.get('decoder_attention_mask')
+    batch_size = prompt.shape[0]
+
+    # Prepare the inputs like generate does, so the decoder gets the same position ids for padded prompts
+    inputs = model.prepare_inputs_for_generation(
+        prompt[:, :length],
+        past_key_values=get_cache_view(cache, batch_size),
+        use_cache=True,
+        encoder_outputs=model_kwargs['encoder_outputs'],
+        decoder_attention_mask=attention_mask[:, :length] if attention_mask is not None else None,
+        cache_position=torch.arange(length, device=prompt.device),
+    )
+    model(**inputs)
+
+    # Rows of the positive half hold the same prefix, because it is shared by both halves
+    self_attention_cache = cache.self_attention_cache
+    cross_attention_cache = cache.cross_attention_cache
+    for layer_idx in range(len(self_attention_cache.key_cache)):
+        for buffer in (self_attention_cache.key_cache[layer_idx], self_attention_cache.value_cache[layer_idx]):
+            buffer[batch_size:2 * batch_size, :, :length] = buffer[:batch_size, :, :length]
+        for buffer in (cross_attention_cache.key_cache[layer_idx], cross_attention_cache.value_cache[layer_idx]):
+            buffer[batch_size:2 * batch_size] = buffer[:batch_size]
+        cache.is_updated[layer_idx] = True
+
+
+def get_cache_nbytes(cache: MapperatorinatorCache) -> int:
+    """Returns the number of bytes allocated by the buffers of the cache."""
+    return sum(
+        t.numel() * t.element_size()
+        for c in (cache.self_attention_cache, cache.cross_attention_cache)
+        for t in c.key_cache + c.value_cache
+    )
+
+
+class CachePool:
+    """
+    Keeps caches around after use, so calls with the same batch size, number of beams and CFG setting
+    can reuse the buffers instead of allocating new ones.
+    Caches are zeroed when they are handed out again. The least recently used caches are dropped when
+    the total size of the pooled caches and the caches held with hold exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = 4 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.free: OrderedDict[tuple, tuple[MapperatorinatorCache, int]] = OrderedDict()
+        self.total_bytes = 0
+        self.held: dict[int, int] = {}  # id of held cache -> number of bytes
+        self.held_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(model: Mapperatorinator, batch_size: int, num_beams: int, cfg_scale: float) -> tuple:
+        return id(model), model.device, model.dtype, batch_size, num_beams, cfg_scale > 1
+
+    def acquire(self, model: Mapperatorinator, batch_size: int, num_beams: int = 1, cfg_scale: float = 1.0) -> MapperatorinatorCache:
+        """Returns an empty cache for the given batch. Give it back with release when done."""
+        key = self._get_key(model, batch_size, num_beams, cfg_scale)
+        with self.lock:
+            entry = self.free.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= entry[1]
+
+        if entry is None:
+            cache = get_cache(model, batch_size, num_beams, cfg_scale)
+        else:
+            cache = entry[0]
+            cache.reset()
+        cache.pool_key = key
+        return cache
+
+    def release(self, cache: MapperatorinatorCache):
+        """Returns a cache to the pool, so it can be reused."""
+        key = getattr(cache, "pool_key", None)
+        if key is None:
+            return
+        nbytes = get_cache_nbytes(cache)
+        with self.lock:
+            if key not in self.free:
+                self.free[key] = (cache, nbytes)
+                self.total_bytes += nbytes
+        self._evict()
+
+    def hold(self, cache: MapperatorinatorCache):
+        """Counts a cache which is kept in use, like the cache of a continuous batch, towards max_bytes
+        until it is given back with unhold. Pooled caches are dropped to make room for it."""
+        nbytes = get_cache_nbytes(cache)
+        with self.lock:
+            if id(cache) not in self.held:
+                self.held[id(cache)] = nbytes
+                self.held_bytes += nbytes
+        self._evict()
+
+    def unhold(self, cache: MapperatorinatorCache):
+        """Stops counting a cache given to hold."""
+        with self.lock:
+            self.held_bytes -= self.held.pop(id(cache), 0)
+
+    def _evict(self):
+        evicted = False
+        with self.lock:
+            while self.total_bytes + self.held_bytes > self.max_bytes and len(self.free) > 0:
+                _, (_, evicted_bytes) = self.free.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+                evicted = True
+
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()  # Give the memory of evicted caches back to other processes
+
+    def drop_model(self, model: Mapperatorinator):
+        """Drops all pooled caches of the given model."""
+        with self.lock:
+            for key in [key for key in self.free if key[0] == id(model)]:
+                self.total_bytes -= self.free.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.free.clear()
+            self.total_bytes = 0
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import inspect
+from typing import TYPE_CHECKING, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import LogitsProcessorList
+from transformers.modeling_outputs import BaseModelOutput
+
+from .cache_utils import MapperatorinatorCache, get_cache_view
+
+if TYPE_CHECKING:
+    from ..model import Mapperatorinator
+
+
+def supports_continuous_batching(model: Mapperatorinator) -> bool:
+    """Returns whether the backbone takes decoder position ids, which rows at different positions need."""
+    return 'decoder_position_ids' in inspect.signature(model.transformer.forward).parameters
+
+
+class ContinuousBatch:
+    """
+    Decodes rows which join and leave between steps, so a finished row frees its place for a new row right away.
+    Each row holds a slot of one preallocated cache, which is two adjacent cache rows with CFG.
+    A row that joins is prefilled on its own into a free slot. Each step then feeds the last token of all rows
+    in a single forward pass, which writes the keys and values of every row at the position of that row.
+    Each row keeps its own logits processors, so processors that keep state between steps see every step of their row.
+    Only supports greedy search and sampling.
+    """
+
+    def __init__(self, cache: MapperatorinatorCache, do_sample: bool):
+        self.cache = cache
+        self.do_sample = do_sample
+        self.multiplier = 2 if cache.cfg_scale > 1 else 1
+        self.capacity = cache.self_attention_cache.max_batch_size // self.multiplier
+        self.max_cache_len = cache.self_attention_cache.max_cache_len
+        self.device = cache.self_attention_cache.key_cache[0].device
+
+        # Per slot, None for free slots
+        self.logits_processors: list[Optional[LogitsProcessorList]] = [None] * self.capacity
+        self.eos_token_ids: list[Optional[set[int]]] = [None] * self.capacity
+        self.max_lengths: list[int] = [0] * self.capacity
+        self.lengths: list[int] = [0] * self.capacity  # number of tokens of each row, the cache holds all but the last one
+        self.prefill_logits: list[Optional[torch.FloatTensor]] = [None] * self.capacity  # of rows which were just prefilled
+        # One more position than the cache, for the token generated after the last cache position
+        self.input_ids = torch.zeros((self.capacity, self.max_cache_len + 1), dtype=torch.long, device=self.device)
+        # Positions of the cache which each cache row attends to
+        self.valid = torch.zeros((self.capacity * self.multiplier, self.max_cache_len), dtype=torch.bool, device=self.device)
+        self.encoder_placeholder = None
+
+    @property
+    def num_free_slots(self) -> int:
+        return self.logits_processors.count(None)
+
+    @torch.no_grad()
+    def add(
+            self,
+            model: Mapperatorinator,
+            prompt: torch.LongTensor,
+            attention_mask: torch.Tensor,
+            encoder_outputs: torch.FloatTensor,
+            logits_processor: LogitsProcessorList,
+            eos_token_id: list[int],
+            max_length: int,
+            negative_prompt: torch.LongTensor = None,
+    ) -> int:
+        """
+        Prefills a row of 1 x L tokens into a free slot and returns the slot.
+        The logits processors have to include the sampling warpers. The row gets its first token in the next step.
+        The negative prompt attends with the attention mask of the prompt, like in generate,
+        which takes negative_prompt_attention_mask as an argument of its own.
+        """
+        if self.num_free_slots == 0:
+            raise ValueError(f"All {self.capacity} slots of the continuous batch are in use.")
+        slot = self.logits_processors.index(None)
+        length = prompt.shape[1]
+        m = self.multiplier
+
+        cache = get_cache_view(self.cache, m, slot * m)
+        # The slot may still hold the cross-attention keys and values of a previous row
+        for layer_idx in cache.is_updated:
+            cache.is_updated[layer_idx] = False
+        inputs = model.prepare_inputs_for_generation(
+            prompt,
+            past_key_values=cache,
+            use_cache=True,
+            encoder_outputs=BaseModelOutput(last_hidden_state=encoder_outputs),
+            decoder_attention_mask=attention_mask,
+            cache_position=torch.arange(length, device=prompt.device),
+            negative_prompt=negative_prompt,
+        )
+        self.prefill_logits[slot] = model(**inputs).logits[:, -1].float()
+
+        self.valid[slot * m:(slot + 1) * m, :length] = attention_mask.bool()
+
+        self.input_ids[slot, :length] = prompt[0]
+        self.lengths[slot] = length
+        self.logits_processors[slot] = logits_processor
+        self.eos_token_ids[slot] = set(eos_token_id)
+        self.max_lengths[slot] = min(max_length, self.max_cache_len + 1)
+        self.encoder_placeholder = encoder_outputs[:1, :1].clone()
+        return slot
+
+    def remove(self, slot: int):
+        """Frees the slot of a row, for example when its request got cancelled."""
+        self.logits_processors[slot] = None
+        self.eos_token_ids[slot] = None
+        self.prefill_logits[slot] = None
+        self.lengths[slot] = 0
+        self.valid[slot * self.multiplier:(slot + 1) * self.multiplier] = False
+
+    @torch.no_grad()
+    def step(self, model: Mapperatorinator) -> dict[int, torch.LongTensor]:
+        """
+        Generates one token for every row. Rows which were just added take theirs from the logits of their prefill.
+        Returns the full sequence of each row that finished, by slot, and frees their slots.
+        """
+        slots = [slot for slot, processors in enumerate(self.logits_processors) if processors is not None]
+        if len(slots) == 0:
+            return {}
+        decode_slots = [slot for slot in slots if self.prefill_logits[slot] is None]
+        logits = {slot: self.prefill_logits[slot] for slot in slots if self.prefill_logits[slot] is not None}
+        if len(decode_slots) > 0:
+            decode_logits = self._decode(model, decode_slots)
+            logits.update((slot, decode_logits[slot]) for slot in decode_slots)
+
+        # Each row runs its own logits processors, the same way generate would for a batch of that row only
+        scores = torch.cat([
+            self.logits_processors[slot](self.input_ids[slot:slot + 1, :self.lengths[slot]], logits[slot])
+            for slot in slots
+        ])
+        if self.do_sample:
+            tokens = torch.multinomial(F.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+        else:
+            tokens = scores.argmax(dim=-1)
+        slots_tensor = torch.tensor(slots, device=self.device)
+        self.input_ids[slots_tensor, torch.tensor([self.lengths[slot] for slot in slots], device=self.device)] = tokens
+
+        finished = {}
+        for slot, token in zip(slots, tokens.tolist()):
+            self.prefill_logits[slot] = None
+            self.lengths[slot] += 1
+            if token in self.eos_token_ids[slot] or self.lengths[slot] >= self.max_lengths[slot]:
+                # Copy, because the slot gets reused and on CPU .cpu() would return a view of the buffer
+                finished[slot] = self.input_ids[slot, :self.lengths[slot]].to('cpu', copy=True)
+                self.remove(slot)
+        return finished
+
+    def _decode(self, model: Mapperatorinator, slots: list[int]) -> torch.FloatTensor:
+        """Feeds the last token of the given rows and returns the logits of all slots up to the last given one."""
+        m = self.multiplier
+        num_slots = slots[-1] + 1
+        batch_size = num_slots * m
+        lengths = torch.tensor(self.lengths[:num_slots], device=self.device)
+        is_fed = torch.zeros(num_slots, dtype=torch.bool, device=self.device)
+        is_fed[torch.tensor(slots, device=self.device)] = True
+
+        # Rows that are not fed write at their next free position, which their next token overwrites
+        write_positions = torch.where(is_fed, lengths - 1, lengths).clamp(max=self.max_cache_len - 1).repeat_interleave(m)
+        input_ids = self.input_ids[torch.arange(num_slots, device=self.device), (lengths - 1).clamp(min=0)]
+        input_ids = input_ids.repeat_interleave(m).unsqueeze(1)
+        valid = self.valid[:batch_size]
+        # Position ids count the tokens before each token, like generate does with the attention mask
+        position_ids = valid.sum(dim=1, keepdim=True)
+        rows = torch.arange(batch_size, device=self.device)
+        valid[rows, write_positions] |= is_fed.repeat_interleave(m)
+        attention_mask = torch.zeros(valid.shape, dtype=model.dtype, device=self.device)
+        attention_mask.masked_fill_(~valid, torch.finfo(model.dtype).min)
+
+        cache = get_cache_view(self.cache, batch_size)
+        cache.self_attention_cache.write_positions = write_positions
+        for layer_idx in cache.is_updated:
+            cache.is_updated[layer_idx] = True
+        # The cross-attention reads the keys and values of the encoder outputs of each row from the cache,
+        # so it only needs encoder outputs of the right batch size
+        encoder_outputs = self.encoder_placeholder.expand(batch_size, -1, -1)
+        logits = model(
+            encoder_outputs=BaseModelOutput(last_hidden_state=encoder_outputs),
+            decoder_input_ids=input_ids,
+            decoder_attention_mask=attention_mask[:, None, None, :],
+            decoder_position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+            cache_position=write_positions.max().unsqueeze(0),
+        ).logits[:, -1].float()
+        return logits.view(num_slots, m, -1)
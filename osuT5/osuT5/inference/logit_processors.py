@@ -1,6 +1,6 @@
 import torch
 import torch.nn.functional as F
-from transformers import LogitsProcessor
+from transformers import LogitsProcessor, StoppingCriteria
 
 from osuT5.osuT5.dataset.data_utils import TIMED_EVENTS
 from osuT5.osuT5.event import EventType, Event
@@ -33,24 +33,89 @@ def get_scroll_speed_tokens(tokenizer: Tokenizer) -> tuple[int, ...]:
                  if EventType.SCROLL_SPEED in tokenizer.event_start else [])
 
 
+def _per_row(value: float | torch.Tensor) -> float | torch.Tensor:
+    """Makes a per-row tensor of shape (batch_size,) broadcastable against scores of shape (batch_size, vocab_size)."""
+    return value.unsqueeze(1) if isinstance(value, torch.Tensor) else value
+
+
 class TimeshiftBias(LogitsProcessor):
-    def __init__(self, timeshift_bias: float, time_start: int, time_end: int):
+    def __init__(self, timeshift_bias: float | torch.Tensor, time_start: int, time_end: int):
         self.timeshift_bias = timeshift_bias
         self.time_range = slice(time_start, time_end)
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.Tensor:
         scores_processed = scores.clone()
-        scores_processed[:, self.time_range] += self.timeshift_bias
+        scores_processed[:, self.time_range] += _per_row(self.timeshift_bias)
         return scores_processed
 
 
+class ClassifierFreeGuidanceLogitsProcessor(LogitsProcessor):
+    """Same as the transformers ClassifierFreeGuidanceLogitsProcessor, but with a guidance scale for each row."""
+    def __init__(self, guidance_scale: torch.Tensor):
+        self.guidance_scale = guidance_scale
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.Tensor:
+        if scores.shape[0] != 2 * input_ids.shape[0]:
+            raise ValueError(
+                f"Logits should have twice the batch size of the input ids. Got batch size {scores.shape[0]} for "
+                f"the logits and {input_ids.shape[0]} for the input ids."
+            )
+        cond_logits, uncond_logits = scores.split(scores.shape[0] // 2, dim=0)
+        return uncond_logits + (cond_logits - uncond_logits) * _per_row(self.guidance_scale)
+
+
+class TemperatureLogitsWarper(LogitsProcessor):
+    """Same as the transformers TemperatureLogitsWarper, but with a temperature for each row."""
+    def __init__(self, temperature: float | torch.Tensor):
+        self.temperature = temperature
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.Tensor:
+        return scores / _per_row(self.temperature)
+
+
+class TopPLogitsWarper(LogitsProcessor):
+    """Same as the transformers TopPLogitsWarper, but with a top_p for each row."""
+    def __init__(self, top_p: torch.Tensor, filter_value: float = -float("Inf"), min_tokens_to_keep: int = 1):
+        self.top_p = top_p
+        self.filter_value = filter_value
+        self.min_tokens_to_keep = min_tokens_to_keep
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.Tensor:
+        sorted_logits, sorted_indices = torch.sort(scores, descending=False)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+
+        # Remove tokens with cumulative top_p above the threshold (token with 0 are kept)
+        sorted_indices_to_remove = cumulative_probs <= (1 - _per_row(self.top_p))
+        # Keep at least min_tokens_to_keep
+        sorted_indices_to_remove[..., -self.min_tokens_to_keep:] = 0
+
+        # scatter sorted tensors to original indexing
+        indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+        return scores.masked_fill(indices_to_remove, self.filter_value)
+
+
+class EosTokenMaskCriteria(StoppingCriteria):
+    """Stops each row when it generates one of the EOS tokens of that row.
+    :param eos_mask: Boolean tensor of shape (batch_size, vocab_size) which marks the EOS tokens of each row.
+    :param eos_token_id: The EOS tokens shared by all rows.
+    """
+    def __init__(self, eos_mask: torch.BoolTensor, eos_token_id: list[int]):
+        self.eos_mask = eos_mask
+        # The presence of this attribute makes generate pad finished rows
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        last_tokens = input_ids[:, -1]
+        return self.eos_mask[torch.arange(len(last_tokens), device=last_tokens.device), last_tokens]
+
+
 class ConditionalTemperatureLogitsWarper(LogitsProcessor):
     def __init__(
             self,
-            temperature: float,
-            timing_temperature: float,
-            mania_column_temperature: float,
-            taiko_hit_temperature: float,
+            temperature: float | torch.Tensor,
+            timing_temperature: float | torch.Tensor,
+            mania_column_temperature: float | torch.Tensor,
+            taiko_hit_temperature: float | torch.Tensor,
             types_first: bool,
             beat_type_tokens: tuple[int, ...],
             mania_type_tokens: tuple[int, ...],
@@ -59,70 +124,98 @@ class ConditionalTemperatureLogitsWarper(LogitsProcessor):
         self.temperature = temperature
         self.conditionals = []
 
-        if timing_temperature != temperature and len(beat_type_tokens) > 0:
-            self.conditionals.append((timing_temperature, beat_type_tokens, 1))
-        if mania_column_temperature != temperature and len(mania_type_tokens) > 0:
-            self.conditionals.append((mania_column_temperature, mania_type_tokens, 3))
-        if taiko_hit_temperature != temperature and len(scroll_speed_tokens) > 0:
-            self.conditionals.append((taiko_hit_temperature, scroll_speed_tokens, 1))
+        if _differs(timing_temperature, temperature) and len(beat_type_tokens) > 0:
+            self.conditionals.append((timing_temperature, torch.tensor(beat_type_tokens), 1))
+        if _differs(mania_column_temperature, temperature) and len(mania_type_tokens) > 0:
+            self.conditionals.append((mania_column_temperature, torch.tensor(mania_type_tokens), 3))
+        if _differs(taiko_hit_temperature, temperature) and len(scroll_speed_tokens) > 0:
+            self.conditionals.append((taiko_hit_temperature, torch.tensor(scroll_speed_tokens), 1))
 
-        if not types_first:
+        if not types_first and len(self.conditionals) > 0:
             print("WARNING: Conditional temperature is not supported for types_first=False. Ignoring.")
             self.conditionals = []
 
-        self.max_offset = max([offset for _, _, offset in self.conditionals], default=0)
-
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.Tensor:
-        if len(self.conditionals) > 0:
-            lookback = input_ids[0, -self.max_offset:].cpu()
-            for temperature, tokens, offset in self.conditionals:
-                if len(lookback) >= offset and lookback[-offset] in tokens:
-                    return scores / temperature
+        if len(self.conditionals) == 0:
+            return scores / _per_row(self.temperature)
+
+        if self.conditionals[0][1].device != input_ids.device:
+            # Move the token sets and per-row temperatures to the device once
+            self.conditionals = [(_to_device(t, input_ids.device), tokens.to(input_ids.device), offset) for t, tokens, offset in self.conditionals]
+            self.temperature = _to_device(self.temperature, input_ids.device)
+
+        # The first conditional that matches the recent tokens of a row decides the temperature of that row
+        temperature = torch.as_tensor(self.temperature, dtype=scores.dtype, device=scores.device).expand(scores.shape[0])
+        matched = torch.zeros(scores.shape[0], dtype=torch.bool, device=scores.device)
+        for conditional_temperature, tokens, offset in self.conditionals:
+            if input_ids.shape[1] < offset:
+                continue
+            is_match = torch.isin(input_ids[:, -offset], tokens) & ~matched
+            temperature = torch.where(is_match, conditional_temperature, temperature)
+            matched |= is_match
+
+        return scores / temperature.unsqueeze(1)
 
-        return scores / self.temperature
+
+def _to_device(value: float | torch.Tensor, device) -> float | torch.Tensor:
+    return value.to(device) if isinstance(value, torch.Tensor) else value
+
+
+def _differs(a: float | torch.Tensor, b: float | torch.Tensor) -> bool:
+    if isinstance(a, torch.Tensor) or isinstance(b, torch.Tensor):
+        return bool(torch.any(torch.as_tensor(a) != torch.as_tensor(b)))
+    return a != b
 
 
 class LookbackBiasLogitsWarper(LogitsProcessor):
     """This logit processor adjusts for bias in the frequency of generated events in case there is a lookback window,
     and it is not full of generated tokens. In this case, the lookback window will be considered multiple times for
     generating the next token, so we nill the scores of the lookback tokens and increase the chance of eos.
+    The lookback_max_time may be a tensor of shape (batch_size,) to use a different lookback window for each row.
     """
-    def __init__(self, lookback_max_time: float, tokenizer: Tokenizer, types_first: bool, device):
+    def __init__(self, lookback_max_time: float | torch.Tensor, tokenizer: Tokenizer, types_first: bool, device):
         self.types_first = types_first  # Lookback bias is only supported for types_first=True
         self.lookback_start = tokenizer.event_start[EventType.TIME_SHIFT]
-        self.lookback_end = tokenizer.encode(Event(EventType.TIME_SHIFT, int(lookback_max_time / MILISECONDS_PER_STEP)))
-        self.lookback_range = torch.full((tokenizer.vocab_size_out,), False, dtype=torch.bool, device=device)
-        self.lookback_range[self.lookback_start:self.lookback_end] = True
+        if isinstance(lookback_max_time, torch.Tensor):
+            lookback_max_time = lookback_max_time.tolist()
+            lookback_end = [tokenizer.encode(Event(EventType.TIME_SHIFT, int(t / MILISECONDS_PER_STEP))) for t in lookback_max_time]
+            self.lookback_range = torch.full((len(lookback_end), tokenizer.vocab_size_out), False, dtype=torch.bool, device=device)
+            for i, end in enumerate(lookback_end):
+                self.lookback_range[i, self.lookback_start:end] = True
+            self.has_lookback = torch.tensor([t > 0 for t in lookback_max_time], dtype=torch.bool, device=device)
+        else:
+            self.lookback_end = tokenizer.encode(Event(EventType.TIME_SHIFT, int(lookback_max_time / MILISECONDS_PER_STEP)))
+            self.lookback_range = torch.full((tokenizer.vocab_size_out,), False, dtype=torch.bool, device=device)
+            self.lookback_range[self.lookback_start:self.lookback_end] = True
+            self.has_lookback = torch.tensor(True, device=device)
         self.other_range = ~self.lookback_range
         self.eos_ids = torch.tensor([tokenizer.eos_id] + [tokenizer.context_eos[context] for context in tokenizer.context_eos], dtype=torch.long, device=device)
 
         self.last_scores = None
-        self.timed_tokens = []
+        # Lookup table of the timed tokens, so checking the last token of each row is a single gather
+        self.is_timed = torch.zeros(tokenizer.vocab_size_in, dtype=torch.bool, device=device)
         for event_type in TIMED_EVENTS:
             if event_type in tokenizer.event_start:
-                self.timed_tokens.extend(list(range(tokenizer.event_start[event_type], tokenizer.event_end[event_type])))
-        self.timed_tokens = torch.tensor(self.timed_tokens, dtype=torch.long, device=device)
+                self.is_timed[tokenizer.event_start[event_type]:tokenizer.event_end[event_type]] = True
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.Tensor:
         if not self.types_first:
-            scores_processed = scores.clone()
-            scores_processed[:, self.lookback_range] = -torch.inf
-            return scores_processed
+            return scores.masked_fill(self.lookback_range, -torch.inf)
 
         scores_processed = scores
 
         if input_ids.shape[1] != 0 and self.last_scores is not None:
             last_token = input_ids[:, -1]
-            last_timed = torch.isin(last_token, self.timed_tokens)
+            last_timed = self.is_timed[last_token.clamp(0, len(self.is_timed) - 1)] & self.has_lookback
             if last_timed.any():
                 # The scores are for a timeshift event
                 last_probs = F.softmax(self.last_scores, dim=-1)
                 probs = F.softmax(scores, dim=-1)
                 prob_eos = last_probs[:, self.eos_ids].sum(dim=-1)
                 prob_event = 1 - prob_eos
-                s = 1 / (probs[:, self.other_range].sum(dim=-1) * prob_event + prob_eos)
-                probs[:, self.lookback_range] = 0
-                probs[:, self.other_range] *= s.unsqueeze(1)
+                s = 1 / (probs.masked_fill(self.lookback_range, 0).sum(dim=-1) * prob_event + prob_eos)
+                probs = probs.masked_fill(self.lookback_range, 0)
+                probs = torch.where(self.other_range, probs * s.unsqueeze(1), probs)
                 # Probability of eos now which should have been at the previous token
                 prob_eos_extra = torch.clip((s - 1) * prob_eos / prob_event, 0, 1)  # Clip to avoid numerical instability
                 probs[:, self.lookback_start] = prob_eos_extra  # This will be treated as eos if trim lookback is true
@@ -134,50 +227,82 @@ class LookbackBiasLogitsWarper(LogitsProcessor):
 
 
 class MonotonicTimeShiftLogitsProcessor(LogitsProcessor):
-    def __init__(self, tokenizer):
+    """Masks timeshift tokens which go back in time from the last timeshift after the last SOS token.
+    The last timeshift of each row is tracked from the newly appended token, so each step only looks at one token per row.
+    The rows are rescanned if they changed in any other way, like after the rejected draft tokens of speculative decoding.
+    :param incremental: Must be False for beam search, which reorders the rows between steps.
+    """
+    def __init__(self, tokenizer, incremental: bool = True):
         self.tokenizer = tokenizer
+        self.incremental = incremental
         self.time_shift_start = tokenizer.event_start[EventType.TIME_SHIFT]
         self.time_shift_end = tokenizer.event_end[EventType.TIME_SHIFT]
         self.sos_ids = torch.tensor([tokenizer.sos_id] + list(getattr(tokenizer, "context_sos", {}).values()))
+        self.is_sos = None
+        self.time_shift_offsets = None
 
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        # State of the rows after the last call
+        self.seen_length = 0
+        self.last_tokens = None
+        self.last_time_shift_values = None
+        self.apply_mask = None
+
+    def _init_tables(self, input_ids: torch.LongTensor):
         device = input_ids.device
-        batch_size, seq_len = input_ids.shape
-        self.sos_ids = self.sos_ids.to(device)
+        vocab_size = max(self.tokenizer.vocab_size_in, int(self.sos_ids.max()) + 1)
+        self.is_sos = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+        self.is_sos[self.sos_ids.to(device)] = True
+        self.time_shift_offsets = torch.arange(self.time_shift_end - self.time_shift_start, device=device)
 
-        # Create masks for time_shift and sos tokens
+    def _scan(self, input_ids: torch.LongTensor):
+        """Finds the last timeshift and SOS token of each row in the whole sequence."""
+        batch_size, seq_len = input_ids.shape
         is_time_shift = (input_ids >= self.time_shift_start) & (input_ids < self.time_shift_end)
-        is_sos = torch.isin(input_ids, self.sos_ids)
-
-        # Create a sequence of indices [0, 1, ..., seq_len-1]
-        indices = torch.arange(seq_len, device=device).expand(batch_size, -1)
+        is_sos = self.is_sos[input_ids.clamp(0, len(self.is_sos) - 1)]
 
         # Find the index of the last occurrence of each event type
         # If not found, it will be -1
+        indices = torch.arange(seq_len, device=input_ids.device).expand(batch_size, -1)
         last_time_shift_idx = torch.max(torch.where(is_time_shift, indices, -1), dim=1).values
         last_sos_idx = torch.max(torch.where(is_sos, indices, -1), dim=1).values
 
-        # Get the value of the last time_shift token for each sequence
-        # If no time_shift token, value is 0
-        last_time_shift_values = torch.where(
+        self.last_time_shift_values = torch.where(
             last_time_shift_idx != -1,
-            input_ids[torch.arange(batch_size), last_time_shift_idx] - self.time_shift_start,
+            input_ids[torch.arange(batch_size, device=input_ids.device), last_time_shift_idx] - self.time_shift_start,
             0
         )
-
-        # Determine which sequences in the batch need masking
         # Mask if a time_shift token was found and it did not appear after the last SOS token
-        apply_mask = (last_time_shift_idx != -1) & (last_time_shift_idx > last_sos_idx)
-
-        # Create the mask for invalid time_shift tokens
-        time_shift_vocab = torch.arange(self.time_shift_start, self.time_shift_end, device=device)
-        # Shape: (batch_size, num_time_shift_tokens)
-        invalid_mask = time_shift_vocab.unsqueeze(0) < (self.time_shift_start + last_time_shift_values).unsqueeze(1)
-
-        # Apply the mask to the scores for the relevant sequences
-        # Shape: (batch_size, vocab_size)
-        batch_mask = torch.full_like(scores, False, dtype=torch.bool)
-        batch_mask[:, self.time_shift_start:self.time_shift_end] = invalid_mask
-        scores[apply_mask] = scores[apply_mask].masked_fill(batch_mask[apply_mask], -torch.inf)
+        self.apply_mask = (last_time_shift_idx != -1) & (last_time_shift_idx > last_sos_idx)
+
+    def _update(self, tokens: torch.LongTensor):
+        """Updates the last timeshift of each row with the newly appended tokens."""
+        is_time_shift = (tokens >= self.time_shift_start) & (tokens < self.time_shift_end)
+        is_sos = self.is_sos[tokens.clamp(0, len(self.is_sos) - 1)]
+        self.last_time_shift_values = torch.where(is_time_shift, tokens - self.time_shift_start, self.last_time_shift_values)
+        self.apply_mask = torch.where(is_time_shift, True, self.apply_mask & ~is_sos)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.is_sos is None or self.is_sos.device != input_ids.device:
+            self._init_tables(input_ids)
+
+        seq_len = input_ids.shape[1]
+        can_update = (
+            self.incremental
+            and self.last_tokens is not None
+            and seq_len == self.seen_length + 1
+            and self.last_tokens.shape[0] == input_ids.shape[0]
+            and torch.equal(input_ids[:, -2], self.last_tokens)
+        ) if seq_len > 1 else False
+        if can_update:
+            self._update(input_ids[:, -1])
+        else:
+            self._scan(input_ids)
+        self.seen_length = seq_len
+        self.last_tokens = input_ids[:, -1] if seq_len > 0 else None
+
+        # Mask the timeshift tokens before the last timeshift of the rows which need masking
+        threshold = torch.where(self.apply_mask, self.last_time_shift_values, 0)
+        invalid_mask = self.time_shift_offsets.unsqueeze(0) < threshold.unsqueeze(1)
+        scores[:, self.time_shift_start:self.time_shift_end].masked_fill_(invalid_mask, -torch.inf)
 
         return scores
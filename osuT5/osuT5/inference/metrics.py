@@ -0,0 +1,165 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+
+import torch
+from transformers import LogitsProcessor
+
+# Upper bounds of the histogram buckets for durations in seconds
+TIME_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Upper bounds of the histogram buckets for fractions, like the occupancy of a batch
+FRACTION_BUCKETS = [0.125, 0.25, 0.375, 0.5, 0.625, 0.75, 0.875, 1]
+
+HISTOGRAM_BUCKETS = {
+    'batch_occupancy': FRACTION_BUCKETS,
+}
+
+
+class Histogram:
+    def __init__(self, buckets: list[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket counts values above the largest bound
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q: float) -> float | None:
+        """Returns the upper bound of the bucket holding the given quantile."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count > 0 else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': {str(bound): count for bound, count in zip(self.buckets + ['inf'], self.counts)},
+        }
+
+
+class StepTimer(LogitsProcessor):
+    """
+    Does not change the scores, but records when generate finishes the forward pass of each step.
+    The first step includes the prefill of the prompt, the others decode a single token.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_step = None
+        self.last_step = None
+        self.steps = 0
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        now = time.perf_counter()
+        if self.first_step is None:
+            self.first_step = now
+        self.last_step = now
+        self.steps += 1
+        return scores
+
+
+class GenerateTimes:
+    """
+    Stands in for ServerMetrics in processes without one, like model replicas.
+    Collects the times of generate calls and counter increments, so they can be sent to the server and recorded there.
+    """
+
+    def __init__(self):
+        self.calls: list[tuple[float, float, int, int]] = []  # prefill seconds, decode seconds, steps, batch size
+        self.counters = defaultdict(float)
+
+    def inc(self, name: str, value: float = 1):
+        self.counters[name] += value
+
+    def record_generate(self, timer: StepTimer, batch_size: int):
+        if timer.first_step is None:
+            return
+        self.calls.append((timer.first_step - timer.start, time.perf_counter() - timer.first_step, timer.steps, batch_size))
+
+
+class ServerMetrics:
+    """
+    Thread-safe counters and histograms of an inference server.
+    Durations are in seconds. Gauges, like the queue depth, are computed by the server when taking a snapshot.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.histograms: dict[str, Histogram] = {}
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name: str, value: float):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(HISTOGRAM_BUCKETS.get(name, TIME_BUCKETS))
+            self.histograms[name].observe(value)
+
+    def record_generate(self, timer: StepTimer, batch_size: int):
+        """Records the prefill and decode time of a generate call timed with the given StepTimer."""
+        if timer.first_step is None:
+            return
+        self.record_generate_times(timer.first_step - timer.start, time.perf_counter() - timer.first_step, timer.steps, batch_size)
+
+    def record_generate_times(self, prefill_seconds: float, decode_seconds: float, steps: int, batch_size: int):
+        self.observe('prefill_seconds', prefill_seconds)
+        self.observe('decode_seconds', decode_seconds)
+        with self.lock:
+            self.counters['prefill_seconds_total'] += prefill_seconds
+            self.counters['decode_seconds_total'] += decode_seconds
+            self.counters['decode_tokens'] += (steps - 1) * batch_size
+            self.counters['prefill_rows'] += batch_size
+
+    def record_prefill(self, seconds: float, rows: int):
+        """Records a prefill outside of generate, like that of rows joining a continuous batch."""
+        self.observe('prefill_seconds', seconds)
+        with self.lock:
+            self.counters['prefill_seconds_total'] += seconds
+            self.counters['prefill_rows'] += rows
+
+    def record_decode_step(self, seconds: float, tokens: int):
+        """Records a single step of a continuous batch, which generates a token for each of its rows."""
+        self.observe('decode_step_seconds', seconds)
+        with self.lock:
+            self.counters['decode_seconds_total'] += seconds
+            self.counters['decode_tokens'] += tokens
+
+    def snapshot(self, gauges: dict = None) -> dict:
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+        decode_seconds = counters.get('decode_seconds_total', 0)
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.start_time,
+            'counters': counters,
+            'decode_tokens_per_second': counters.get('decode_tokens', 0) / decode_seconds if decode_seconds > 0 else None,
+            'gauges': gauges or {},
+            'histograms': histograms,
+        }
@@ -0,0 +1,87 @@
+import time
+from pathlib import Path
+
+import torch
+
+import routed_pickle
+from ..config import TrainConfig
+from .speculative import SpeculativeDecoder
+from .weights_cache import get_weights_cache_path, load_cached_model, save_cached_model
+from ..model import Mapperatorinator
+from ..tokenizer import Tokenizer
+from ..utils import get_model
+
+
+def is_hf_checkpoint(ckpt_path_str: str) -> bool:
+    ckpt_path = Path(ckpt_path_str)
+    return not (ckpt_path / "pytorch_model.bin").exists() or not (ckpt_path / "custom_checkpoint_0.pkl").exists()
+
+
+def load_tokenizer(ckpt_path_str: str) -> Tokenizer:
+    if is_hf_checkpoint(ckpt_path_str):
+        tokenizer = Tokenizer.from_pretrained(ckpt_path_str)
+    else:
+        tokenizer_state = torch.load(Path(ckpt_path_str) / "custom_checkpoint_0.pkl", pickle_module=routed_pickle, weights_only=False)
+        tokenizer = Tokenizer()
+        tokenizer.load_state_dict(tokenizer_state)
+    return tokenizer
+
+
+def load_mapperatorinator(
+        ckpt_path_str: str,
+        t5_args: TrainConfig,
+        device,
+        precision: str = "fp32",
+        encoder_cache_bytes: int = 0,
+        draft_model_path: str = "",
+        num_draft_tokens: int = 4,
+        weights_cache_dir: str = "",
+) -> Mapperatorinator:
+    timings = {}
+    start = time.perf_counter()
+    cache_path = get_weights_cache_path(weights_cache_dir, ckpt_path_str, precision) if weights_cache_dir else None
+    model = load_cached_model(cache_path, device) if cache_path is not None else None
+    cache_hit = model is not None
+    if cache_hit:
+        timings["cache"] = time.perf_counter() - start
+    elif is_hf_checkpoint(ckpt_path_str):
+        model = Mapperatorinator.from_pretrained(ckpt_path_str)
+        model.generation_config.disable_compile = True
+        timings["checkpoint"] = time.perf_counter() - start
+    else:
+        model_state = torch.load(Path(ckpt_path_str) / "pytorch_model.bin", map_location=device, weights_only=True)
+        model = get_model(t5_args, load_tokenizer(ckpt_path_str))
+        model.load_state_dict(model_state)
+        timings["checkpoint"] = time.perf_counter() - start
+
+    model.eval()
+
+    if not cache_hit:
+        # Cached weights are already on the device and in the inference precision
+        start = time.perf_counter()
+        model.to(device)
+
+        if precision == "bf16":
+            # Cast every submodule to bfloat16 except for the spectrogram module
+            for name, module in model.named_modules():
+                if name != "" and "spectrogram" not in name:
+                    module.to(torch.bfloat16)
+        timings["convert"] = time.perf_counter() - start
+
+    if cache_path is not None and not cache_hit:
+        # Store the converted weights, so the next load maps them in directly
+        start = time.perf_counter()
+        save_cached_model(model, cache_path)
+        timings["cache write"] = time.perf_counter() - start
+
+    model.enable_encoder_cache(encoder_cache_bytes)
+
+    if draft_model_path:
+        draft_model = load_mapperatorinator(draft_model_path, t5_args, device, precision, weights_cache_dir=weights_cache_dir)
+        speculative_decoder = SpeculativeDecoder(draft_model, num_draft_tokens)
+        speculative_decoder.check_compatible(model)
+        model.speculative_decoder = speculative_decoder
+
+    breakdown = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+    print(f"Model loaded: {ckpt_path_str} on device {device} ({breakdown})")
+    return model
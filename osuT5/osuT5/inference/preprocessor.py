@@ -1,11 +1,17 @@
 from __future__ import annotations
 
+import copy
+import math
+from typing import Optional, Union
+
 import torch
 import numpy as np
 import numpy.typing as npt
 
 from config import InferenceConfig
+from ..dataset.audio_cache import get_audio_cache
 from ..dataset.data_utils import load_audio_file, MILISECONDS_PER_SECOND
+from ..model.spectrogram import MelSpectrogram
 
 
 class Preprocessor(object):
@@ -19,6 +25,25 @@ class Preprocessor(object):
         self.parallel = parallel
         if parallel:
             self.sequence_stride = self.samples_per_sequence
+        self.spectrogram = None
+        if args.precompute_spectrogram:
+            spectrogram_args = args.train.model.spectrogram
+            self.spectrogram = MelSpectrogram(
+                spectrogram_args.implementation,
+                spectrogram_args.log_scale,
+                spectrogram_args.sample_rate,
+                spectrogram_args.n_fft,
+                spectrogram_args.n_mels,
+                spectrogram_args.hop_length,
+                spectrogram_args.f_min,
+                spectrogram_args.f_max,
+                spectrogram_args.pad_mode,
+            ).to(args.device)
+            self.n_fft = spectrogram_args.n_fft
+            self.device = args.device
+            self.precision = args.precision
+            # Windows have to start on the frame grid of the whole-song spectrogram
+            self.sequence_stride = max(self.frame_size, self.sequence_stride - self.sequence_stride % self.frame_size)
         self.miliseconds_per_stride = self.sequence_stride * MILISECONDS_PER_SECOND / self.sample_rate
         self.miliseconds_per_sequence = self.samples_per_sequence * MILISECONDS_PER_SECOND / self.sample_rate
         self.lookback_max_time = args.lookback * self.miliseconds_per_sequence
@@ -26,6 +51,8 @@ class Preprocessor(object):
         self.start_time = args.start_time
         self.end_time = args.end_time
         self.normalize_audio = args.train.data.normalize_audio
+        self.audio_cache = get_audio_cache(args.audio_cache_dir, args.audio_cache_size)
+        self.stream_audio = args.stream_audio
 
     def load(self, path: str) -> npt.ArrayLike:
         """Load an audio file as audio frames. Convert stereo to mono, normalize.
@@ -36,15 +63,18 @@ class Preprocessor(object):
         Returns:
             samples: Audio time-series.
         """
-        return load_audio_file(path, self.sample_rate, normalize=self.normalize_audio)
+        return load_audio_file(path, self.sample_rate, normalize=self.normalize_audio, cache=self.audio_cache,
+                               stream=self.stream_audio)
 
     def segment(
             self,
             samples: npt.ArrayLike,
             begin_pad: int = 0,
             end_pad: int = 0,
-    ) -> tuple[torch.Tensor, torch.Tensor, float]:
+    ) -> tuple[LazyWindows, torch.Tensor, float]:
         """Segment audio samples into sequences. Sequences are flattened frames.
+        The sequences are cut from the samples lazily, so the padded song and overlapping windows are never copied.
+        With precompute_spectrogram, the sequences are slices of one mel spectrogram of the whole song instead.
 
         Args:
             samples: Audio time-series.
@@ -56,19 +86,18 @@ class Preprocessor(object):
             sequence_times: A list of sequence start times in miliseconds.
         """
         song_length = len(samples) / self.sample_rate * 1000
-        samples = np.pad(samples, [begin_pad, end_pad])
+        padded_length = begin_pad + len(samples) + end_pad
 
-        if len(samples) < self.samples_per_sequence:
+        if padded_length < self.samples_per_sequence:
             # If samples is smaller than our window size, pad to window size
-            padding_needed = self.samples_per_sequence - len(samples)
+            padding_needed = self.samples_per_sequence - padded_length
         else:
             # Calculate padding needed to make the total length exactly fit the striding pattern
-            remainder = (len(samples) - self.samples_per_sequence) % self.sequence_stride
+            remainder = (padded_length - self.samples_per_sequence) % self.sequence_stride
             padding_needed = 0 if remainder == 0 else self.sequence_stride - remainder
 
-        samples = np.pad(samples, [0, padding_needed])
-        sequences = self.window(samples, self.samples_per_sequence, self.sequence_stride)
-        sequences = torch.from_numpy(sequences).to(torch.float32)
+        num_windows = (padded_length + padding_needed - self.samples_per_sequence) // self.sequence_stride + 1
+        sequences = LazyWindows(samples, self.samples_per_sequence, self.sequence_stride, num_windows, begin_pad)
         sequence_times = torch.arange(0, len(sequences) * self.miliseconds_per_stride,
                                       self.miliseconds_per_stride).to(torch.int32)
 
@@ -89,14 +118,173 @@ class Preprocessor(object):
             sequences = sequences[:end_idx]
             sequence_times = sequence_times[:end_idx]
 
+        if self.spectrogram is not None and len(sequences) > 0:
+            sequences = SpectrogramWindows(sequences, self.compute_spectrogram(sequences), self.frame_size)
+
         return sequences, sequence_times, song_length
 
-    @staticmethod
-    def window(a, w, o, copy=False):
-        sh = (a.size - w + 1, w)
-        st = a.strides * 2
-        view = np.lib.stride_tricks.as_strided(a, strides=st, shape=sh)[0::o]
-        if copy:
-            return view.copy()
-        else:
-            return view
+    @torch.no_grad()
+    def compute_spectrogram(self, windows: LazyWindows, chunk_frames: int = 2048) -> torch.Tensor:
+        """Computes the mel spectrogram of the padded song covered by the windows, a chunk of frames at a time.
+        Each chunk gets enough neighbouring samples that its frames equal those of a single pass over the whole song.
+
+        Args:
+            windows: Windows of audio samples, whose stride is a multiple of the hop length.
+            chunk_frames: Number of spectrogram frames to compute at a time.
+
+        Returns:
+            spectrogram: Mel spectrogram of shape (number of frames, n_mels) starting at the first window.
+        """
+        hop = self.frame_size
+        context = math.ceil(self.n_fft // 2 / hop)
+        first_frame = windows.indices[0] * windows.stride // hop
+        num_frames = (windows.indices[-1] - windows.indices[0]) * windows.stride // hop + windows.window_size // hop + 1
+        chunks = []
+        with torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16, enabled=self.precision == 'amp'):
+            for start in range(first_frame, first_frame + num_frames, chunk_frames):
+                end = min(start + chunk_frames, first_frame + num_frames)
+                samples = windows.read((start - context) * hop, (end - 1 + context) * hop + 1)
+                spectrogram = self.spectrogram(torch.from_numpy(samples).to(self.device).unsqueeze(0))[0]
+                chunks.append(spectrogram[context:context + end - start].float().cpu())
+        return torch.cat(chunks)
+
+
+class LazyWindows(object):
+    def __init__(
+            self,
+            samples: npt.ArrayLike,
+            window_size: int,
+            stride: int,
+            num_windows: int,
+            begin_pad: int = 0,
+            indices: Optional[npt.NDArray] = None,
+    ):
+        """Windows of audio samples which are only cut from the samples when they are accessed.
+
+        Window i covers samples [i * stride - begin_pad, i * stride - begin_pad + window_size),
+        where samples outside the song are zero. Indexing with an integer returns that window as a tensor,
+        while indexing with a slice, index list, or boolean mask returns another lazy selection of windows.
+
+        Args:
+            samples: Audio time-series. May be memory-mapped.
+            window_size: Number of samples per window.
+            stride: Number of samples between the starts of consecutive windows.
+            num_windows: Number of windows.
+            begin_pad: Number of zero samples before the start of the song.
+            indices: Indices of the selected windows. Defaults to all windows.
+        """
+        self.samples = samples
+        self.window_size = window_size
+        self.stride = stride
+        self.begin_pad = begin_pad
+        self.indices = np.arange(num_windows) if indices is None else indices
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    @property
+    def shape(self) -> torch.Size:
+        return torch.Size([len(self), self.window_size])
+
+    def dim(self) -> int:
+        return 2
+
+    def __getitem__(self, index) -> Union[torch.Tensor, LazyWindows]:
+        if isinstance(index, (int, np.integer)) or (isinstance(index, torch.Tensor) and index.dim() == 0):
+            return self.tensor(self.indices[int(index)][None])[0]
+        if isinstance(index, torch.Tensor):
+            index = index.cpu().numpy()
+        selection = copy.copy(self)
+        selection.indices = self.indices[index]
+        return selection
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def read(self, start: int, end: int) -> npt.NDArray:
+        """Copies the padded song from start to end, where samples outside the song are zero."""
+        out = np.zeros(end - start, dtype=np.float32)
+        begin = max(start - self.begin_pad, 0)
+        stop = min(end - self.begin_pad, len(self.samples))
+        if begin < stop:
+            out[begin + self.begin_pad - start:stop + self.begin_pad - start] = self.samples[begin:stop]
+        return out
+
+    def tensor(self, indices: Optional[npt.NDArray] = None) -> torch.Tensor:
+        """Copies the selected windows into a tensor of shape (number of windows, window size)."""
+        return self._cut(self.indices if indices is None else indices)
+
+    def _cut(self, indices: npt.NDArray) -> torch.Tensor:
+        windows = np.empty((len(indices), self.window_size), dtype=np.float32)
+        for row, index in enumerate(indices):
+            windows[row] = self.read(index * self.stride, index * self.stride + self.window_size)
+        return torch.from_numpy(windows)
+
+    def energy(self, batch_size: int = 64) -> torch.Tensor:
+        """Mean squared amplitude of the audio of each window, computed a few windows at a time."""
+        if len(self) == 0:
+            return torch.zeros(0)
+        return torch.cat([self._cut(self.indices[i:i + batch_size]).pow(2).mean(dim=1)
+                          for i in range(0, len(self), batch_size)])
+
+
+class SpectrogramWindows(LazyWindows):
+    def __init__(self, windows: LazyWindows, spectrogram: torch.Tensor, hop_length: int):
+        """Windows of a mel spectrogram which is computed once for the whole song, instead of once per window.
+
+        Selecting windows works like LazyWindows, but the windows are slices of the spectrogram of shape
+        (frames per window, n_mels). These match the spectrograms of the audio windows, except for the frames
+        near the window edges, which see the neighbouring audio instead of padding.
+
+        Args:
+            windows: Windows of audio samples, whose stride is a multiple of the hop length.
+            spectrogram: Mel spectrogram of the padded song, starting at the first window.
+            hop_length: Number of samples per spectrogram frame.
+        """
+        super().__init__(windows.samples, windows.window_size, windows.stride, 0, windows.begin_pad, windows.indices)
+        self.spectrogram = spectrogram
+        self.frames_per_window = windows.window_size // hop_length + 1
+        self.frames_per_stride = windows.stride // hop_length
+        self.first_index = windows.indices[0]
+
+    @property
+    def shape(self) -> torch.Size:
+        return torch.Size([len(self), self.frames_per_window, self.spectrogram.shape[1]])
+
+    def dim(self) -> int:
+        return 3
+
+    def tensor(self, indices: Optional[npt.NDArray] = None) -> torch.Tensor:
+        """Copies the selected windows into a tensor of shape (number of windows, frames per window, n_mels)."""
+        indices = torch.from_numpy(np.asarray(self.indices if indices is None else indices))
+        starts = (indices - self.first_index) * self.frames_per_stride
+        return self.spectrogram[starts.unsqueeze(1) + torch.arange(self.frames_per_window)]
+
+
+def get_window_energy(sequences: Union[torch.Tensor, LazyWindows]) -> torch.Tensor:
+    """Mean squared amplitude of each window of shape (number of windows, samples per sequence)."""
+    if isinstance(sequences, LazyWindows):
+        return sequences.energy()
+    return sequences.float().pow(2).mean(dim=1)
+
+
+def get_silent_windows(sequences: Union[torch.Tensor, LazyWindows], threshold: Optional[float]) -> torch.Tensor:
+    """Marks windows whose RMS level is more than -threshold dB below the loudest window.
+    Nothing gets placed in these windows, so they can be skipped without running the model.
+
+    Args:
+        sequences: Windows of audio samples of shape (number of windows, samples per sequence).
+        threshold: Level in dB relative to the loudest window. None marks no windows.
+
+    Returns:
+        silent: Boolean mask of shape (number of windows,).
+    """
+    if threshold is None or len(sequences) == 0:
+        return torch.zeros(len(sequences), dtype=torch.bool)
+    rms = get_window_energy(sequences).sqrt()
+    peak = rms.max()
+    if peak <= 0:
+        return torch.ones(len(sequences), dtype=torch.bool)
+    level = 20 * torch.log10(rms / peak)
+    return level < threshold
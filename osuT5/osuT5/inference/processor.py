@@ -1,26 +1,37 @@
 from __future__ import annotations
 
+import bisect
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Optional
+from typing import TYPE_CHECKING, Any, Callable, Optional
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 from slider import Beatmap, TimingPoint
 from tqdm import tqdm
+from transformers.modeling_outputs import BaseModelOutput
 
 from config import InferenceConfig
-from .server import InferenceClient, model_generate, model_forward
+from .cache_utils import CachePool
+from .preprocessor import LazyWindows, get_silent_windows, get_window_energy
+from .server import InferenceClient, model_generate, model_forward, model_encode, get_eos_token_id
 from ..dataset.osu_parser import OsuParser
 from ..dataset.data_utils import (update_event_times, remove_events_of_type, get_hold_note_ratio,
                                   get_scroll_speed_ratio, get_hitsounded_status)
-from ..model import Mapperatorinator
 from ..tokenizer import Event, EventType, Tokenizer, ContextType
 
+if TYPE_CHECKING:
+    from ..model import Mapperatorinator
+
 MILISECONDS_PER_SECOND = 1000
 MILISECONDS_PER_STEP = 10
 
+# Sampling settings which may differ between the variants of generate_variants, because model_generate takes them per row
+SAMPLING_SETTINGS = ('cfg_scale', 'temperature', 'timing_temperature', 'mania_column_temperature', 'taiko_hit_temperature', 'top_p', 'timeshift_bias')
+
 
 @dataclass
 class GenerationConfig:
@@ -79,6 +90,8 @@ class Processor(object):
         self.args = args
         self.model = model
         self.tokenizer = tokenizer
+        # A local model reuses the KV-caches of earlier windows, the inference server pools its own caches
+        self.cache_pool = CachePool() if not isinstance(model, InferenceClient) else None
         self.tgt_seq_len = args.train.data.tgt_seq_len
         self.frame_seq_len = args.train.data.src_seq_len - 1
         self.frame_size = args.train.model.spectrogram.hop_length
@@ -149,13 +162,20 @@ class Processor(object):
         self.do_sample = args.do_sample
         self.num_beams = args.num_beams
         self.parallel = args.parallel
+        # A local model on the CPU would encode the next window on the same threads the current one decodes on
+        self.pipeline = args.pipeline and (isinstance(model, InferenceClient) or model.device.type == "cuda")
+        self.parallel_chunks = args.parallel_chunks
+        self.silence_threshold = args.silence_threshold
         self.max_batch_size = args.max_batch_size
 
         self.timeshift_bias = args.timeshift_bias
         self.types_first = args.train.data.types_first
 
+        # Called with the context type, frame time, events and event times added by each generated window
+        self.on_window: Optional[Callable[[ContextType, float, list[Event], list[int]], None]] = None
+
     def model_generate(self, model_kwargs, **generate_kwargs: Any) -> Any:
-        generate_kwargs2 = generate_kwargs | dict(
+        generate_kwargs2 = dict(
             precision=self.precision,
             do_sample=self.do_sample,
             num_beams=self.num_beams,
@@ -169,12 +189,28 @@ class Processor(object):
             timing_temperature=self.timing_temperature,
             mania_column_temperature=self.mania_column_temperature,
             taiko_hit_temperature=self.taiko_hit_temperature,
-        )
+        ) | generate_kwargs
 
         if isinstance(self.model, InferenceClient):
             return self.model.generate(model_kwargs, generate_kwargs2)
         else:
-            return model_generate(self.model, self.tokenizer, model_kwargs, generate_kwargs2)
+            return model_generate(self.model, self.tokenizer, model_kwargs, generate_kwargs2, cache_pool=self.cache_pool)
+
+    def get_sampling_settings(self) -> dict[str, Any]:
+        """Returns the current values of the settings in SAMPLING_SETTINGS."""
+        return {k: getattr(self, k) for k in SAMPLING_SETTINGS}
+
+    @contextmanager
+    def use_sampling_settings(self, sampling_settings: dict[str, Any]):
+        """Temporarily replaces the settings in SAMPLING_SETTINGS with the given values."""
+        previous = self.get_sampling_settings()
+        for k, v in sampling_settings.items():
+            setattr(self, k, v)
+        try:
+            yield
+        finally:
+            for k, v in previous.items():
+                setattr(self, k, v)
 
     def model_forward(self, model_kwargs) -> Any:
         generate_kwargs2 = dict(
@@ -190,7 +226,7 @@ class Processor(object):
     def generate(
             self,
             *,
-            sequences: tuple[torch.Tensor, torch.Tensor, float],
+            sequences: tuple[torch.Tensor | LazyWindows, torch.Tensor, float],
             generation_config: GenerationConfig,
             in_context: list[ContextType] = None,
             out_context: list[ContextType] = None,
@@ -213,6 +249,129 @@ class Processor(object):
             events: List of Event object lists.
             event_times: Corresponding event times of Event object lists in miliseconds.
         """
+        inputs = self._prepare_generation(
+            sequences=sequences,
+            generation_config=generation_config,
+            in_context=in_context,
+            out_context=out_context,
+            beatmap_path=beatmap_path,
+            extra_in_context=extra_in_context,
+            verbose=verbose,
+        )
+
+        if self.parallel:
+            generate_func = self.generate_parallel
+        elif self.parallel_chunks > 1:
+            generate_func = self.generate_chunked
+        else:
+            generate_func = self.generate_sequential
+        if isinstance(self.model, InferenceClient):
+            with self.model:
+                generate_func(**inputs)
+        else:
+            generate_func(**inputs)
+
+        return self._finish_generation(
+            inputs["out_context"],
+            generation_config=generation_config,
+            out_context=out_context,
+            song_length=sequences[2],
+            beatmap_path=beatmap_path,
+            extra_in_context=extra_in_context,
+        )
+
+    def generate_variants(
+            self,
+            *,
+            sequences: tuple[torch.Tensor | LazyWindows, torch.Tensor, float],
+            generation_configs: list[GenerationConfig],
+            in_context: list[ContextType] = None,
+            out_context: list[ContextType] = None,
+            beatmap_path: Optional[str] = None,
+            extra_in_contexts: Optional[list[Optional[dict[ContextType, tuple[list[Event], list[int]] | tuple[list[Event], list[int], torch.Tensor] | list[TimingPoint]]]]] = None,
+            sampling_settings: Optional[list[dict[str, Any]]] = None,
+            verbose: bool = True,
+    ) -> list[list[tuple[list[Event], list[int]]]]:
+        """Generate events for multiple generation configs on the same audio, like all difficulties of a mapset.
+        The windows of all variants advance together, so they are generated as rows of one batch.
+
+        Args:
+            sequences: A list of batched source sequences, and the total song length in milliseconds.
+            generation_configs: Generation configuration of each variant.
+            in_context: List of context information.
+            out_context: Output contexts to generate.
+            beatmap_path: Path to the beatmap file for context generation.
+            extra_in_contexts: Extra context information of each variant to use instead of beatmap_path.
+            sampling_settings: Overrides of the settings in SAMPLING_SETTINGS for each variant.
+            verbose: Whether to show progress bar.
+
+        Returns:
+            The events and event times of each output context for each variant.
+        """
+        if extra_in_contexts is None:
+            extra_in_contexts = [None] * len(generation_configs)
+        sampling_settings = [self.get_sampling_settings() | (settings or {}) for settings in sampling_settings or [None] * len(generation_configs)]
+
+        if len(generation_configs) == 1:
+            with self.use_sampling_settings(sampling_settings[0]):
+                return [self.generate(
+                    sequences=sequences,
+                    generation_config=generation_configs[0],
+                    in_context=in_context,
+                    out_context=out_context,
+                    beatmap_path=beatmap_path,
+                    extra_in_context=extra_in_contexts[0],
+                    verbose=verbose,
+                )]
+
+        variants = [self._prepare_generation(
+            sequences=sequences,
+            generation_config=generation_config,
+            in_context=in_context,
+            out_context=out_context,
+            beatmap_path=beatmap_path,
+            extra_in_context=extra_in_context,
+            verbose=verbose,
+        ) for generation_config, extra_in_context in zip(generation_configs, extra_in_contexts)]
+
+        def generate_func():
+            if self.parallel:
+                # Parallel sampling already batches all windows of a variant
+                for inputs, settings in zip(variants, sampling_settings):
+                    with self.use_sampling_settings(settings):
+                        self.generate_parallel(**inputs)
+            else:
+                # Build negative prompts for all rows if any variant uses CFG, the rows of the others get a cfg_scale of 1
+                with self.use_sampling_settings({'cfg_scale': max(settings['cfg_scale'] for settings in sampling_settings)}):
+                    self._generate_lockstep(sequences, variants, verbose, sampling_settings)
+
+        if isinstance(self.model, InferenceClient):
+            with self.model:
+                generate_func()
+        else:
+            generate_func()
+
+        return [self._finish_generation(
+            inputs["out_context"],
+            generation_config=generation_config,
+            out_context=out_context,
+            song_length=sequences[2],
+            beatmap_path=beatmap_path,
+            extra_in_context=extra_in_context,
+        ) for inputs, generation_config, extra_in_context in zip(variants, generation_configs, extra_in_contexts)]
+
+    def _prepare_generation(
+            self,
+            *,
+            sequences: tuple[torch.Tensor | LazyWindows, torch.Tensor, float],
+            generation_config: GenerationConfig,
+            in_context: list[ContextType],
+            out_context: list[ContextType],
+            beatmap_path: Optional[str],
+            extra_in_context: Optional[dict],
+            verbose: bool,
+    ) -> dict[str, Any]:
+        """Returns the inputs of the generate functions."""
         gen_in_context, gen_out_context, req_special_tokens = self._get_viable_template(
             in_context=in_context,
             out_context=out_context,
@@ -238,8 +397,7 @@ class Processor(object):
             verbose=verbose,
         )
 
-        # Start generation
-        inputs = dict(
+        return dict(
             sequences=sequences,
             in_context=in_context_data,
             out_context=out_context_data,
@@ -248,13 +406,17 @@ class Processor(object):
             verbose=verbose,
         )
 
-        generate_func = self.generate_parallel if self.parallel else self.generate_sequential
-        if isinstance(self.model, InferenceClient):
-            with self.model:
-                generate_func(**inputs)
-        else:
-            generate_func(**inputs)
-
+    def _finish_generation(
+            self,
+            out_context_data: list[dict[str, Any]],
+            *,
+            generation_config: GenerationConfig,
+            out_context: list[ContextType],
+            song_length: float,
+            beatmap_path: Optional[str],
+            extra_in_context: Optional[dict],
+    ) -> list[tuple[list[Event], list[int]]]:
+        """Post-processes the generated contexts and returns the events and event times of the requested output contexts."""
         # Post-process events
         for context in out_context_data:
             # Regenerate event times
@@ -308,14 +470,15 @@ class Processor(object):
     def generate_sequential(
             self,
             *,
-            sequences: tuple[torch.Tensor, torch.Tensor, float],
+            sequences: tuple[torch.Tensor | LazyWindows, torch.Tensor, float],
             in_context: list[dict[str, Any]],
             out_context: list[dict[str, Any]],
             model_kwargs: dict[str, Any],
             req_special_tokens: list[str],
             verbose: bool = True,
     ):
-        song_length = sequences[2]
+        frames, frame_times, song_length = sequences
+        silent = self._get_silent_windows(sequences, verbose)
 
         for i, context in enumerate(out_context):
             if context["finished"]:
@@ -323,59 +486,106 @@ class Processor(object):
 
             if verbose:
                 print(f"Generating {context['context_type'].value}")
-            iterator = tqdm(list(zip(*sequences[:2]))) if verbose else zip(*sequences[:2])
-            for sequence_index, (frames, frame_time) in enumerate(iterator):
-                trim_lookback = sequence_index != 0 and self.types_first and self.lookback_time > 0
-                trim_lookahead = sequence_index != len(sequences[0]) - 1
-
-                # noinspection PyUnresolvedReferences
-                frames = self.prepare_frames(frames)
-                frame_time = frame_time.item()
-
-                # Get relevant tokens for current frame
-                cond_prompt, uncond_prompt = self.get_prompts(
-                    self.prepare_context_sequences(in_context, frame_time, False, req_special_tokens),
-                    self.prepare_context_sequences(out_context[:i + 1], frame_time, True, req_special_tokens),
-                )
 
-                [prompt, uncond_prompt], max_len = self.pad_prompts([cond_prompt, uncond_prompt])
-
-                # Prepare additional model kwargs
-                if self.do_song_position_embed:
-                    global_pos_start = frame_time / song_length
-                    global_pos_end = (frame_time + self.miliseconds_per_sequence) / song_length
-                    model_kwargs["song_position"] = torch.tensor([global_pos_start, global_pos_end], dtype=torch.float32).unsqueeze(0)
-
-                result = self.model_generate(
-                    model_kwargs | dict(
-                        inputs=frames,
-                        decoder_input_ids=prompt,
-                        decoder_attention_mask=prompt.ne(self.tokenizer.pad_id),
-                        negative_prompt=uncond_prompt,
-                        negative_prompt_attention_mask=uncond_prompt.ne(self.tokenizer.pad_id) if uncond_prompt is not None else None,
-                    ),
-                    lookback_time=self.lookback_time if trim_lookback else 0,
-                    lookahead_time=self.lookahead_time if trim_lookahead else 0,
-                    context_type=context["context_type"].value,
-                )
+            def prepare(sequence_index):
+                if silent[sequence_index]:
+                    return None
+                return self._prepare_window(frames[sequence_index:sequence_index + 1], frame_times[sequence_index], song_length, in_context, out_context[:i], model_kwargs)
+
+            # With pipelining, the next window is prepared on a worker thread while the model decodes the current one
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                next_window = executor.submit(prepare, 0) if self.pipeline and len(frame_times) > 0 else None
+                iterator = tqdm(range(len(frame_times))) if verbose else range(len(frame_times))
+                for sequence_index in iterator:
+                    if next_window is not None:
+                        window = next_window.result()
+                        if sequence_index + 1 < len(frame_times):
+                            next_window = executor.submit(prepare, sequence_index + 1)
+                    else:
+                        window = prepare(sequence_index)
+
+                    trim_lookback = sequence_index != 0 and self.types_first and self.lookback_time > 0
+                    trim_lookahead = sequence_index != len(frame_times) - 1
+                    if window is None:
+                        self.add_predicted_tokens_to_context(context, torch.tensor([], dtype=torch.long), frame_times[sequence_index].item(), trim_lookback, trim_lookahead)
+                        continue
+                    frame_time = window["frame_time"]
+
+                    # Only the tokens of the context being generated depend on the previous window
+                    cond_prompt, uncond_prompt = self.get_prompts(
+                        window["in_sequences"],
+                        self.prepare_context_sequences(out_context[:i + 1], frame_time, True, req_special_tokens, window["out_sequences"]),
+                    )
 
-                # Only support batch size 1
-                predicted_tokens = result[0, max_len:].cpu()
-                self.add_predicted_tokens_to_context(context, predicted_tokens, frame_time, trim_lookback, trim_lookahead)
+                    [prompt, uncond_prompt], max_len = self.pad_prompts([cond_prompt, uncond_prompt])
+
+                    result = self.model_generate(
+                        window["model_kwargs"] | dict(
+                            decoder_input_ids=prompt,
+                            decoder_attention_mask=prompt.ne(self.tokenizer.pad_id),
+                            negative_prompt=uncond_prompt,
+                            negative_prompt_attention_mask=uncond_prompt.ne(self.tokenizer.pad_id) if uncond_prompt is not None else None,
+                        ),
+                        lookback_time=self.lookback_time if trim_lookback else 0,
+                        lookahead_time=self.lookahead_time if trim_lookahead else 0,
+                        context_type=context["context_type"].value,
+                    )
+
+                    # Only support batch size 1
+                    predicted_tokens = result[0, max_len:].cpu()
+                    self.add_predicted_tokens_to_context(context, predicted_tokens, frame_time, trim_lookback, trim_lookahead)
+
+    def _prepare_window(
+            self,
+            frames: torch.Tensor,
+            frame_time: torch.Tensor,
+            song_length: float,
+            in_context: list[dict[str, Any]],
+            finished_out_context: list[dict[str, Any]],
+            model_kwargs: dict[str, Any],
+    ) -> dict[str, Any]:
+        """Prepares the parts of a window for sequential generation which do not depend on the previous windows.
+        This includes the encoder outputs if pipelining with a local model."""
+        # noinspection PyUnresolvedReferences
+        frames = self.prepare_frames(frames)
+        frame_time = frame_time.item()
+
+        # Prepare additional model kwargs
+        window_kwargs = dict(model_kwargs)
+        if self.do_song_position_embed:
+            global_pos_start = frame_time / song_length
+            global_pos_end = (frame_time + self.miliseconds_per_sequence) / song_length
+            window_kwargs["song_position"] = torch.tensor([global_pos_start, global_pos_end], dtype=torch.float32).unsqueeze(0)
+
+        # The frames are kept next to the encoder outputs, because a draft model for speculative decoding needs them
+        window_kwargs["inputs"] = frames
+        if self.pipeline and not isinstance(self.model, InferenceClient):
+            encoder_outputs = model_encode(self.model, window_kwargs, self.precision)
+            window_kwargs["encoder_outputs"] = BaseModelOutput(last_hidden_state=encoder_outputs)
+
+        return dict(
+            frame_time=frame_time,
+            model_kwargs=window_kwargs,
+            in_sequences=self.prepare_context_sequences(in_context, frame_time, False, []),
+            out_sequences=[self.prepare_context_sequence(context, frame_time) for context in finished_out_context],
+        )
 
     def generate_parallel(
             self,
             *,
-            sequences: tuple[torch.Tensor, torch.Tensor, float],
+            sequences: tuple[torch.Tensor | LazyWindows, torch.Tensor, float],
             in_context: list[dict[str, Any]],
             out_context: list[dict[str, Any]],
             model_kwargs: dict[str, Any],
             req_special_tokens: list[str],
             verbose: bool = True,
     ):
-        # Get relevant inputs
-        frames = self.prepare_frames(sequences[0])
-        frame_times = sequences[1]
+        # Get relevant inputs, leaving out silent windows
+        audible = ~self._get_silent_windows(sequences, verbose)
+        if not audible.any():
+            return
+        frames = sequences[0][audible]
+        frame_times = sequences[1][audible]
         song_length = sequences[2]
 
         cond_prompts, uncond_prompts, model_kwargses = self._prepare_parallel_inputs(
@@ -410,10 +620,193 @@ class Processor(object):
                 start, end = self._get_token_context(result[i], self.tokenizer.sos_id, self.tokenizer.eos_id)
                 self.add_predicted_tokens_to_context(out_context[0], result[i, start:end], frame_time)
 
+    def generate_chunked(
+            self,
+            *,
+            sequences: tuple[torch.Tensor | LazyWindows, torch.Tensor, float],
+            in_context: list[dict[str, Any]],
+            out_context: list[dict[str, Any]],
+            model_kwargs: dict[str, Any],
+            req_special_tokens: list[str],
+            verbose: bool = True,
+    ):
+        """Splits the song into chunks at quiet windows and generates each chunk sequentially.
+        The chunks advance in lockstep, so the windows of all chunks are generated together in one batch."""
+        variant = dict(
+            in_context=in_context,
+            out_context=out_context,
+            model_kwargs=model_kwargs,
+            req_special_tokens=req_special_tokens,
+        )
+        self._generate_lockstep(sequences, [variant], verbose)
+
+    def _generate_lockstep(
+            self,
+            sequences: tuple[torch.Tensor | LazyWindows, torch.Tensor, float],
+            variants: list[dict[str, Any]],
+            verbose: bool = True,
+            sampling_settings: Optional[list[dict[str, Any]]] = None,
+    ):
+        """Generates the out contexts of all variants sequentially, with the song split into parallel_chunks chunks.
+        The windows of all chunks of all variants advance in lockstep, so they are generated together in one batch.
+        Each variant may have its own settings in SAMPLING_SETTINGS, which are applied to its rows.
+        Negative prompts are only built if the cfg_scale of the processor is above 1."""
+        if sampling_settings is None:
+            sampling_settings = [self.get_sampling_settings()] * len(variants)
+        frames = sequences[0]
+        frame_times = sequences[1]
+        song_length = sequences[2]
+        num_windows = len(frame_times)
+        silent = self._get_silent_windows(sequences, verbose)
+        chunk_starts = self._get_chunk_starts(frames, self.parallel_chunks)
+        chunk_ends = chunk_starts[1:] + [num_windows]
+        num_steps = max(end - start for start, end in zip(chunk_starts, chunk_ends))
+
+        for i in range(max(len(variant["out_context"]) for variant in variants)):
+            chunks = []
+            merges = []
+            for variant, settings in zip(variants, sampling_settings):
+                if i >= len(variant["out_context"]) or variant["out_context"][i]["finished"]:
+                    continue
+
+                # The first chunk generates into the context itself, the other chunks into copies which are appended after
+                context = variant["out_context"][i]
+                chunk_contexts = [context] + [context | dict(events=context["events"].copy(), event_times=context["event_times"].copy()) for _ in chunk_starts[1:]]
+                merges.append((context, len(context["events"]), chunk_contexts[1:]))
+                chunks.extend((variant, chunk_context, start, end, settings) for chunk_context, start, end in zip(chunk_contexts, chunk_starts, chunk_ends))
+
+            if len(chunks) == 0:
+                continue
+
+            if verbose:
+                context_types = ", ".join(dict.fromkeys(chunk_context["context_type"].value for _, chunk_context, _, _, _ in chunks))
+                print(f"Generating {context_types} in {len(chunks)} chunks")
+
+            iterator = tqdm(range(num_steps)) if verbose else range(num_steps)
+            for step in iterator:
+                # Windows at the start of a chunk trim their lookback and windows at the end trim their lookahead,
+                # just like in sequential generation, so the seams between chunks line up.
+                # Rows with different trimming or context types need different EOS tokens, so they are generated in separate batches.
+                # Beam search can not take sampling settings per row, so there rows with different settings are also split.
+                groups = {}
+                for variant, chunk_context, start, end, settings in chunks:
+                    sequence_index = start + step
+                    if sequence_index >= end:
+                        continue
+                    trim_lookback = sequence_index != 0 and self.types_first and self.lookback_time > 0
+                    trim_lookahead = sequence_index != num_windows - 1
+                    if silent[sequence_index]:
+                        self.add_predicted_tokens_to_context(chunk_context, torch.tensor([], dtype=torch.long), frame_times[sequence_index].item(), trim_lookback, trim_lookahead)
+                        continue
+                    group_key = (trim_lookback, trim_lookahead, chunk_context["context_type"], tuple(settings.items()) if self.num_beams > 1 else None)
+                    groups.setdefault(group_key, []).append((variant, chunk_context, sequence_index, settings))
+
+                for (trim_lookback, trim_lookahead, _, _), rows in groups.items():
+                    self._generate_chunk_windows(
+                        rows,
+                        i,
+                        frames=frames,
+                        frame_times=frame_times,
+                        song_length=song_length,
+                        trim_lookback=trim_lookback,
+                        trim_lookahead=trim_lookahead,
+                    )
+
+            for context, num_events, chunk_contexts in merges:
+                for chunk_context in chunk_contexts:
+                    context["events"] += chunk_context["events"][num_events:]
+                    context["event_times"] += chunk_context["event_times"][num_events:]
+
+    def _generate_chunk_windows(
+            self,
+            rows: list[tuple[dict[str, Any], dict[str, Any], int, dict[str, Any]]],
+            context_index: int,
+            *,
+            frames: torch.Tensor | LazyWindows,
+            frame_times: torch.Tensor,
+            song_length: float,
+            trim_lookback: bool,
+            trim_lookahead: bool,
+    ):
+        """Generates the next window of each chunk in rows, given as the variant, the chunk context, the window index
+        and the sampling settings. The chunk context takes the place of the out context at context_index of the variant."""
+        cond_prompts = []
+        uncond_prompts = []
+        model_kwargses = []
+        for variant, chunk_context, sequence_index, _ in rows:
+            frame_time = frame_times[sequence_index].item()
+            cond_prompt, uncond_prompt = self.get_prompts(
+                self.prepare_context_sequences(variant["in_context"], frame_time, False, variant["req_special_tokens"]),
+                self.prepare_context_sequences(variant["out_context"][:context_index] + [chunk_context], frame_time, True, variant["req_special_tokens"]),
+            )
+            cond_prompts.append(cond_prompt)
+            uncond_prompts.append(uncond_prompt)
+
+            kwargs = variant["model_kwargs"].copy()
+            if self.do_song_position_embed:
+                global_pos_start = frame_time / song_length
+                global_pos_end = (frame_time + self.miliseconds_per_sequence) / song_length
+                kwargs["song_position"] = torch.tensor([global_pos_start, global_pos_end], dtype=torch.float32).unsqueeze(0)
+            model_kwargses.append(kwargs)
+
+        context_type = rows[0][1]["context_type"]
+        lookback_time = self.lookback_time if trim_lookback else 0
+        lookahead_time = self.lookahead_time if trim_lookahead else 0
+        eos_token_id = torch.tensor(get_eos_token_id(self.tokenizer, lookback_time, lookahead_time, context_type), dtype=torch.long)
+        _, _, max_len = self.stack_prompts(cond_prompts, uncond_prompts)
+
+        results = self._batched_inference(
+            lambda kwargs, **row_kwargs: self.model_generate(kwargs, lookback_time=lookback_time, lookahead_time=lookahead_time, context_type=context_type.value, **row_kwargs),
+            cond_prompts,
+            uncond_prompts,
+            frames[[sequence_index for _, _, sequence_index, _ in rows]],
+            model_kwargses,
+            verbose=False,
+            generator=True,
+            row_generate_kwargs=[settings for _, _, _, settings in rows],
+        )
+
+        row_index = 0
+        for result in results:
+            for predicted_tokens in result[:, max_len:].cpu():
+                # Finished rows are padded up to the longest row of the batch, so cut after the first EOS token
+                eos_indices = torch.isin(predicted_tokens, eos_token_id).nonzero()
+                if len(eos_indices) > 0:
+                    predicted_tokens = predicted_tokens[:eos_indices[0, 0] + 1]
+                _, chunk_context, sequence_index, _ = rows[row_index]
+                frame_time = frame_times[sequence_index].item()
+                self.add_predicted_tokens_to_context(chunk_context, predicted_tokens, frame_time, trim_lookback, trim_lookahead)
+                row_index += 1
+
+    def _get_silent_windows(self, sequences: tuple[torch.Tensor | LazyWindows, torch.Tensor, float], verbose: bool) -> torch.Tensor:
+        """Returns the mask of windows which are skipped because they are silent, and reports the skipped time."""
+        frames, frame_times, _ = sequences
+        silent = get_silent_windows(frames, self.silence_threshold)
+        if verbose and silent.any():
+            stride = (frame_times[-1] - frame_times[0]).item() / (len(frame_times) - 1) if len(frame_times) > 1 else self.miliseconds_per_sequence
+            print(f"Skipping {silent.sum().item()} silent windows ({silent.sum().item() * stride / 1000:.1f} s)")
+        return silent
+
+    def _get_chunk_starts(self, frames: torch.Tensor | LazyWindows, num_chunks: int) -> list[int]:
+        """Returns the first window index of each chunk.
+        The chunks are about equally long, but each starts at the quietest window near its ideal start."""
+        num_windows = frames.shape[0]
+        num_chunks = max(1, min(num_chunks, num_windows))
+        energy = get_window_energy(frames)
+        chunk_length = num_windows / num_chunks
+        radius = int(chunk_length // 4)
+        starts = [0]
+        for j in range(1, num_chunks):
+            ideal = round(j * chunk_length)
+            low = max(starts[-1] + 1, ideal - radius)
+            high = min(num_windows - (num_chunks - j), ideal + radius)
+            starts.append(low + int(torch.argmin(energy[low:high + 1])))
+        return starts
+
     def ai_mod(
             self,
             *,
-            sequences: tuple[torch.Tensor, torch.Tensor, float],
+            sequences: tuple[torch.Tensor | LazyWindows, torch.Tensor, float],
             generation_config: GenerationConfig,
             beatmap_path: Optional[str] = None,
             verbose: bool = True,
@@ -439,7 +832,7 @@ class Processor(object):
         )
 
         # Get relevant inputs
-        frames = self.prepare_frames(sequences[0])
+        frames = sequences[0]
         frame_times = sequences[1]
         song_length = sequences[2]
 
@@ -683,10 +1076,11 @@ class Processor(object):
             genereate_func,
             cond_prompts: list[torch.Tensor],
             uncond_prompts: list[torch.Tensor],
-            frames: torch.Tensor,
+            frames: torch.Tensor | LazyWindows,
             model_kwargses: list[dict[str, torch.Tensor]],
             verbose: bool = True,
             generator: bool = False,
+            row_generate_kwargs: Optional[list[dict[str, Any]]] = None,
     ):
         cond_prompt, uncond_prompt, max_len = self.stack_prompts(cond_prompts, uncond_prompts)
 
@@ -700,12 +1094,22 @@ class Processor(object):
         iterator = tqdm(list(range(0, num_samples, max_batch_size))) if verbose else range(0, num_samples,
                                                                                            max_batch_size)
         for i in iterator:
-            frames_batch = frames[i:i + max_batch_size]
+            frames_batch = self.prepare_frames(frames[i:i + max_batch_size])
             cond_prompt_batch = cond_prompt[i:i + max_batch_size]
             uncond_prompt_batch = uncond_prompt[i:i + max_batch_size] if uncond_prompt is not None else None
             kwargses_batch = model_kwargses[i:i + max_batch_size]
             model_kwargs_batch = {k: torch.cat([kwargs[k] for kwargs in kwargses_batch], dim=0) for k in
                                   model_kwarg_keys}
+            # Generate kwargs of each row are passed as a list with a value for each row, or one value if all rows agree
+            generate_kwargs_batch = {}
+            if row_generate_kwargs is not None:
+                rows_batch = row_generate_kwargs[i:i + max_batch_size]
+                for k in rows_batch[0]:
+                    values = [kwargs[k] for kwargs in rows_batch]
+                    generate_kwargs_batch[k] = values[0] if all(v == values[0] for v in values) else values
+                if uncond_prompt_batch is not None and max(kwargs['cfg_scale'] for kwargs in rows_batch) <= 1:
+                    # None of the rows use CFG, so leave out the negative prompts
+                    uncond_prompt_batch = None
 
             # Start generation
             result = genereate_func(
@@ -717,6 +1121,7 @@ class Processor(object):
                     negative_prompt_attention_mask=uncond_prompt_batch.ne(
                         self.tokenizer.pad_id) if uncond_prompt_batch is not None else None,
                 ),
+                **generate_kwargs_batch,
             )
 
             if generator:
@@ -745,7 +1150,9 @@ class Processor(object):
             return [None] * batch_size
         return [tensor[i:i + max_batch_size] for i in range(0, tensor.size(0), max_batch_size)]
 
-    def prepare_frames(self, frames: torch.Tensor) -> torch.Tensor:
+    def prepare_frames(self, frames: torch.Tensor | LazyWindows) -> torch.Tensor:
+        if isinstance(frames, LazyWindows):
+            frames = frames.tensor()
         if frames.dim() == 1:
             frames = frames.unsqueeze(0)
 
@@ -1023,6 +1430,7 @@ class Processor(object):
                 predicted_tokens = predicted_tokens[:-1]
 
         result = self._decode(predicted_tokens, frame_time)
+        num_events = len(context["events"])
         context["events"] += result
         update_event_times(context["events"], context["event_times"], frame_time + self.eos_time, self.types_first)
 
@@ -1031,6 +1439,9 @@ class Processor(object):
             lookahead_time = frame_time + self.lookahead_max_time
             self._trim_events_after_time(context["events"], context["event_times"], lookahead_time)
 
+        if self.on_window is not None:
+            self.on_window(context["context_type"], frame_time, context["events"][num_events:], context["event_times"][num_events:])
+
     def get_required_extra_special_tokens(self, all_out_context: list[ContextType]) -> list[str]:
         result = []
         if ContextType.KIAI in all_out_context or (self.add_kiai and any(c in all_out_context for c in [ContextType.GD, ContextType.MAP])):
@@ -1041,10 +1452,11 @@ class Processor(object):
             result.append("song_position")
         return result
 
-    def prepare_context_sequences(self, contexts: list[dict], frame_time, out_context: bool, req_special_tokens: list[str]) -> list[dict]:
+    def prepare_context_sequences(self, contexts: list[dict], frame_time, out_context: bool, req_special_tokens: list[str], prepared: Optional[list[dict]] = None) -> list[dict]:
         results = []
         for i, context in enumerate(contexts):
-            result = self.prepare_context_sequence(context, frame_time)
+            # Use the sequences of leading contexts which were already prepared
+            result = prepared[i] if prepared is not None and i < len(prepared) else self.prepare_context_sequence(context, frame_time)
             results.append(result)
             # Extra special tokens are to be stored in the first output context
             if out_context and i != 0:
@@ -1165,24 +1577,15 @@ class Processor(object):
         return cond_prompt, uncond_prompt
 
     def _get_events_time_range(self, event_times: list[float], start_time: float, end_time: float):
-        # Look from the end of the list
-        s = 0
-        for i in range(len(event_times) - 1, -1, -1):
-            if event_times[i] < start_time:
-                s = i + 1
-                break
-        e = 0
-        for i in range(len(event_times) - 1, -1, -1):
-            if event_times[i] < end_time:
-                e = i + 1
-                break
+        # Event times are sorted, so binary search the window bounds
+        s = bisect.bisect_left(event_times, start_time)
+        e = bisect.bisect_left(event_times, end_time, lo=s)
         return s, e
 
     def _trim_events_before_time(self, events, event_times, time):
-        for i in range(len(event_times) - 1, -1, -1):
-            if event_times[i] < time:
-                del events[i]
-                del event_times[i]
+        i = bisect.bisect_left(event_times, time)
+        del events[:i]
+        del event_times[:i]
 
     def _trim_events_after_time(self, events, event_times, time):
         for i in range(len(event_times) - 1, -1, -1):
@@ -1193,15 +1596,17 @@ class Processor(object):
                 break
 
     def _encode(self, events: list[Event], frame_time: float) -> torch.Tensor:
-        tokens = torch.empty((1, len(events)), dtype=torch.long)
+        event_types = [event.type for event in events]
+        values = np.fromiter((event.value for event in events), dtype=np.float64, count=len(events))
+
+        # Time shifts are relative to the start of the window
+        is_timeshift = np.fromiter((t == EventType.TIME_SHIFT for t in event_types), dtype=bool, count=len(events))
         timeshift_range = self.tokenizer.event_range[EventType.TIME_SHIFT]
-        for i, event in enumerate(events):
-            if event.type == EventType.TIME_SHIFT:
-                value = int((event.value - frame_time) / MILISECONDS_PER_STEP)
-                value = np.clip(value, timeshift_range.min_value, timeshift_range.max_value)
-                event = Event(type=event.type, value=value)
-            tokens[0, i] = self.tokenizer.encode(event)
-        return tokens
+        timeshifts = np.trunc((values[is_timeshift] - frame_time) / MILISECONDS_PER_STEP)
+        values[is_timeshift] = np.clip(timeshifts, timeshift_range.min_value, timeshift_range.max_value)
+
+        tokens = self.tokenizer.encode_many(event_types, values.astype(np.int64))
+        return torch.from_numpy(tokens).unsqueeze(0)
 
     def _decode(
             self,
@@ -1218,22 +1623,26 @@ class Processor(object):
         Returns:
             events: List of Event objects.
         """
-        events = []
-        for token in tokens:
-            if token == self.tokenizer.eos_id and not allow_non_events:
-                break
+        tokens = tokens.cpu().numpy() if isinstance(tokens, torch.Tensor) else np.asarray(tokens, dtype=np.int64)
+        if not allow_non_events:
+            eos_indices = np.flatnonzero(tokens == self.tokenizer.eos_id)
+            if len(eos_indices) > 0:
+                tokens = tokens[:eos_indices[0]]
 
-            try:
-                event = self.tokenizer.decode(token.item())
-            except:
+        type_indices, values = self.tokenizer.decode_many(tokens)
+
+        events = []
+        for token, type_index, value in zip(tokens.tolist(), type_indices.tolist(), values.tolist()):
+            if type_index < 0:
                 if allow_non_events:
-                    events.append(Event(EventType.CONTROL, token.item()))
+                    events.append(Event(EventType.CONTROL, token))
                 continue
 
-            if event.type == EventType.TIME_SHIFT:
-                event.value = frame_time + event.value * MILISECONDS_PER_STEP
+            event_type = self.tokenizer.event_types[type_index]
+            if event_type == EventType.TIME_SHIFT:
+                value = frame_time + value * MILISECONDS_PER_STEP
 
-            events.append(event)
+            events.append(Event(type=event_type, value=value))
 
         return events
 
@@ -1257,14 +1666,14 @@ class Processor(object):
         return new_events, new_event_times
 
     def _kiai_before_time(self, events, event_times, time) -> Event:
-        for i in range(len(events) - 1, -1, -1):
-            if events[i].type == EventType.KIAI and event_times[i] < time:
+        for i in range(bisect.bisect_left(event_times, time) - 1, -1, -1):
+            if events[i].type == EventType.KIAI:
                 return events[i]
         return self._default_special_event("last_kiai")
 
     def _sv_before_time(self, events, event_times, time) -> Event:
-        for i in range(len(events) - 1, -1, -1):
-            if events[i].type == EventType.SCROLL_SPEED and event_times[i] < time:
+        for i in range(bisect.bisect_left(event_times, time) - 1, -1, -1):
+            if events[i].type == EventType.SCROLL_SPEED:
                 return events[i]
         return self._default_special_event("last_sv")
 
@@ -1,21 +1,39 @@
+from __future__ import annotations
+
 import _pickle
+import functools
+import json
+import multiprocessing
 import os
+import queue
 import time
 import threading
 import traceback
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+from typing import TYPE_CHECKING
 import torch
-from multiprocessing.connection import Listener, Client
+from multiprocessing import Pipe
+from multiprocessing.connection import Listener, Client, wait
 
-from transformers import LogitsProcessorList, ClassifierFreeGuidanceLogitsProcessor, TemperatureLogitsWarper
+from transformers import GenerationConfig, LogitsProcessorList, StoppingCriteriaList, TopKLogitsWarper, StaticCache
+from transformers import TopPLogitsWarper as HFTopPLogitsWarper
 
 from ..event import EventType, ContextType
 from .logit_processors import ConditionalTemperatureLogitsWarper, get_beat_type_tokens, \
     get_mania_type_tokens, get_scroll_speed_tokens, TimeshiftBias, LookbackBiasLogitsWarper, \
-    MonotonicTimeShiftLogitsProcessor
-from .cache_utils import get_cache
-from ..model import Mapperatorinator
+    MonotonicTimeShiftLogitsProcessor, ClassifierFreeGuidanceLogitsProcessor, TopPLogitsWarper, EosTokenMaskCriteria, \
+    TemperatureLogitsWarper
+from .cache_utils import get_cache, get_cache_nbytes, CachePool, get_shared_prefix_length, prefill_shared_prefix
+from .continuous_batching import ContinuousBatch, supports_continuous_batching
+from .metrics import ServerMetrics, StepTimer, GenerateTimes
+from .shm_transport import SharedMemoryReader, SharedMemoryWriter
+from .speculative import SpeculativeDecoder
 from ..tokenizer import Tokenizer
 
+if TYPE_CHECKING:
+    from ..model import Mapperatorinator
+
 # The default address used for IPC
 SOCKET_PATH = r'\\.\pipe\Mapperatorinator'
 
@@ -24,6 +42,52 @@ MILISECONDS_PER_STEP = 10
 
 RETRY_SIGNAL = "RETRY_SIGNAL"
 
+# Sent by a client to tell the server how to load its model
+REGISTER_SIGNAL = "REGISTER_SIGNAL"
+
+# Sent by a client to cancel its request in flight, and sent back in place of the result of a cancelled request
+CANCEL_SIGNAL = "CANCEL_SIGNAL"
+
+# Sent in place of the result of a request that passed its deadline
+DEADLINE_SIGNAL = "DEADLINE_SIGNAL"
+
+# Sent by a client to get a snapshot of the server metrics
+METRICS_SIGNAL = "METRICS_SIGNAL"
+
+# Names of the counters of requests dropped with each signal
+DROP_COUNTERS = {
+    RETRY_SIGNAL: 'requests_retried',
+    CANCEL_SIGNAL: 'requests_cancelled',
+    DEADLINE_SIGNAL: 'requests_timed_out',
+}
+
+# Held while a client starts an inference server in this process
+SERVER_START_LOCK = threading.Lock()
+
+# Time in seconds a request for an unloaded model waits for requests of loaded models, before its model gets swapped in
+MODEL_SWITCH_TIMEOUT = 10
+# Minimum time in seconds a model stays swapped in before requests that waited for MODEL_SWITCH_TIMEOUT can swap it out again
+MODEL_MIN_RESIDENCY = 30
+
+# Generate kwargs which may have a different value for each row of a batch, with their default values.
+# model_generate accepts a list with a value for each row for these.
+ROW_GENERATE_KWARGS = {
+    'cfg_scale': 1.0,
+    'timeshift_bias': 0,
+    'temperature': 1.0,
+    'timing_temperature': None,  # Defaults to temperature
+    'mania_column_temperature': None,  # Defaults to temperature
+    'taiko_hit_temperature': None,  # Defaults to temperature
+    'top_p': 1.0,
+    'lookback_time': 0.0,
+    'lookahead_time': 0.0,
+    'context_type': None,
+}
+
+
+class RequestCancelledError(RuntimeError):
+    pass
+
 
 def get_eos_token_id(tokenizer, lookback_time: float = 0, lookahead_time: float = 0, context_type: ContextType = None):
     eos_token_id = [tokenizer.eos_id]
@@ -36,36 +100,82 @@ def get_eos_token_id(tokenizer, lookback_time: float = 0, lookahead_time: float
     return eos_token_id
 
 
-@torch.no_grad()
-def model_generate(model, tokenizer, model_kwargs, generate_kwargs):
-    # To device
-    model_kwargs = {k: v.to(model.device) if isinstance(v, torch.Tensor) else v for k, v in model_kwargs.items()}
-    model_kwargs = {k: v.to(model.dtype) if k != "inputs" and isinstance(v, torch.Tensor) and v.dtype == torch.float32 else v for k, v in model_kwargs.items()}
-    batch_size = model_kwargs['inputs'].shape[0]
-    # print(f"[Model Generate] Batch size: {batch_size}, Model device: {model.device}")
+def get_row_generate_kwargs(generate_kwargs: dict, index: int = None) -> dict:
+    """
+    Returns the values of the per-row generate kwargs with defaults filled in.
+    A request may give a list with a value for each of its rows, of which index picks the value of one row.
+    """
+    row_kwargs = {k: generate_kwargs.get(k, default) for k, default in ROW_GENERATE_KWARGS.items()}
+    if index is not None:
+        row_kwargs = {k: v[index] if isinstance(v, list) else v for k, v in row_kwargs.items()}
+    for k in ('timing_temperature', 'mania_column_temperature', 'taiko_hit_temperature'):
+        if row_kwargs[k] is None:
+            row_kwargs[k] = row_kwargs['temperature']
+    return row_kwargs
+
+
+def get_group_key(generate_kwargs: dict) -> frozenset:
+    """
+    Returns the key used to group requests into batches.
+    Requests only have to agree on the kwargs which change the structure of the generation loop.
+    The per-row kwargs in ROW_GENERATE_KWARGS may differ between requests, except for beam search,
+    which handles EOS tokens and scores for the whole batch at once.
+    """
+    if generate_kwargs.get('num_beams', 1) > 1:
+        return frozenset(generate_kwargs.items())
+    key = {k: v for k, v in generate_kwargs.items() if k not in ROW_GENERATE_KWARGS}
+    # CFG doubles the batch, so it can not be mixed with requests without CFG
+    key['cfg'] = uses_cfg(generate_kwargs)
+    return frozenset(key.items())
+
+
+def uses_cfg(generate_kwargs: dict) -> bool:
+    """Returns whether any row uses classifier-free guidance, which doubles the batch."""
+    cfg_scale = generate_kwargs.get('cfg_scale', 1.0)
+    return max(cfg_scale) > 1 if isinstance(cfg_scale, list) else cfg_scale > 1
 
-    precision = generate_kwargs.pop('precision', 'fp32')
-    cfg_scale = generate_kwargs.pop('cfg_scale', 1.0)
-    timeshift_bias = generate_kwargs.pop('timeshift_bias', 0)
-    types_first = generate_kwargs.pop('types_first', False)
-    temperature = generate_kwargs.pop('temperature', 1.0)
-    timing_temperature = generate_kwargs.pop('timing_temperature', temperature)
-    mania_column_temperature = generate_kwargs.pop('mania_column_temperature', temperature)
-    taiko_hit_temperature = generate_kwargs.pop('taiko_hit_temperature', temperature)
-    lookback_time = generate_kwargs.pop('lookback_time', 0.0)
-    lookahead_time = generate_kwargs.pop('lookahead_time', 0.0)
-    context_type = generate_kwargs.pop('context_type', None)
-    if context_type is not None:
-        context_type = ContextType(context_type)  # Convert to ContextType enum
+
+def _unique_or_rows(value):
+    """Returns a list of per-row values as a single value if all rows have the same value."""
+    if isinstance(value, list):
+        return value[0] if all(v == value[0] for v in value) else value
+    return value
+
+
+def get_row_logits_processor_list(
+        model,
+        tokenizer,
+        row_kwargs: dict,
+        *,
+        types_first: bool = False,
+        incremental: bool = True,
+        do_sample: bool = False,
+        top_k: int = 0,
+) -> LogitsProcessorList:
+    """
+    Creates the logits processors for the per-row kwargs of model_generate, which hold either a single value
+    or a list with a value for each row. Top-k and top-p are only added for per-row top-p, otherwise generate adds them.
+    """
+    def to_row_tensor(value):
+        return torch.tensor(value, dtype=torch.float32, device=model.device) if isinstance(value, list) else value
+
+    cfg_scale = to_row_tensor(row_kwargs['cfg_scale'])
+    timeshift_bias = to_row_tensor(row_kwargs['timeshift_bias'])
+    temperature = to_row_tensor(row_kwargs['temperature'])
+    timing_temperature = to_row_tensor(row_kwargs['timing_temperature'])
+    mania_column_temperature = to_row_tensor(row_kwargs['mania_column_temperature'])
+    taiko_hit_temperature = to_row_tensor(row_kwargs['taiko_hit_temperature'])
+    top_p = row_kwargs['top_p']
+    lookback_time = row_kwargs['lookback_time']
 
     # Create the logits processors
     logits_processor_list = LogitsProcessorList()
-    if cfg_scale > 1.0:
+    if uses_cfg(row_kwargs):
         logits_processor_list.append(ClassifierFreeGuidanceLogitsProcessor(cfg_scale))
 
-    logits_processor_list.append(MonotonicTimeShiftLogitsProcessor(tokenizer))
+    logits_processor_list.append(MonotonicTimeShiftLogitsProcessor(tokenizer, incremental=incremental))
 
-    if timeshift_bias != 0:
+    if isinstance(timeshift_bias, torch.Tensor) or timeshift_bias != 0:
         logits_processor_list.append(
             TimeshiftBias(
                 timeshift_bias,
@@ -73,6 +183,7 @@ def model_generate(model, tokenizer, model_kwargs, generate_kwargs):
                 tokenizer.event_end[EventType.TIME_SHIFT]
             )
         )
+    # Conditional temperatures only apply to types_first models, the others sample with the plain temperature of each row
     if types_first:
         logits_processor_list.append(ConditionalTemperatureLogitsWarper(
             temperature,
@@ -86,26 +197,222 @@ def model_generate(model, tokenizer, model_kwargs, generate_kwargs):
         ))
     else:
         logits_processor_list.append(TemperatureLogitsWarper(temperature))
-    if lookback_time > 0:
-        logits_processor_list.append(LookbackBiasLogitsWarper(lookback_time, tokenizer, types_first, model.device))
+    if isinstance(lookback_time, list) or lookback_time > 0:
+        logits_processor_list.append(LookbackBiasLogitsWarper(to_row_tensor(lookback_time), tokenizer, types_first, model.device))
+
+    if isinstance(top_p, list):
+        # Apply top-k and per-row top-p ourselves in the order generate would apply them
+        if do_sample:
+            if top_k:
+                logits_processor_list.append(TopKLogitsWarper(top_k))
+            logits_processor_list.append(TopPLogitsWarper(to_row_tensor(top_p)))
+    return logits_processor_list
+
+
+@torch.no_grad()
+def model_generate(model, tokenizer, model_kwargs, generate_kwargs, past_key_values=None, cache_pool: CachePool = None, metrics: ServerMetrics = None):
+    # To device
+    model_kwargs = {k: v.to(model.device) if isinstance(v, torch.Tensor) else v for k, v in model_kwargs.items()}
+    model_kwargs = {k: v.to(model.dtype) if k != "inputs" and isinstance(v, torch.Tensor) and v.dtype == torch.float32 else v for k, v in model_kwargs.items()}
+    batch_size = model_kwargs['inputs'].shape[0] if 'inputs' in model_kwargs else model_kwargs['decoder_input_ids'].shape[0]
+    # print(f"[Model Generate] Batch size: {batch_size}, Model device: {model.device}")
+
+    # Per-row kwargs are either a single value or a list with a value for each row
+    row_kwargs = {k: _unique_or_rows(v) for k, v in get_row_generate_kwargs(generate_kwargs).items()}
+    has_top_p = 'top_p' in generate_kwargs
+    for k in ROW_GENERATE_KWARGS:
+        generate_kwargs.pop(k, None)
+
+    precision = generate_kwargs.pop('precision', 'fp32')
+    types_first = generate_kwargs.pop('types_first', False)
+    top_p = row_kwargs['top_p']
+    lookback_time = row_kwargs['lookback_time']
+    lookahead_time = row_kwargs['lookahead_time']
+    context_type = row_kwargs['context_type']
+    use_cfg = uses_cfg(row_kwargs)
+
+    do_sample = generate_kwargs.get('do_sample', False)
+    top_k = generate_kwargs.get('top_k', 0)
+
+    def get_logits_processor_list():
+        return get_row_logits_processor_list(
+            model,
+            tokenizer,
+            row_kwargs,
+            types_first=types_first,
+            incremental=generate_kwargs.get('num_beams', 1) == 1,
+            do_sample=do_sample,
+            top_k=top_k,
+        )
+
+    logits_processor_list = get_logits_processor_list()
+    if isinstance(top_p, list):
+        generate_kwargs['top_k'] = 0
+        generate_kwargs['top_p'] = 1.0
+    elif has_top_p:
+        generate_kwargs['top_p'] = top_p
+
+    # Get the EOS tokens
+    stopping_criteria = StoppingCriteriaList()
+    if any(isinstance(v, list) for v in (lookback_time, lookahead_time, context_type)):
+        rows_eos_token_id = [get_eos_token_id(
+            tokenizer,
+            lookback_time=lookback_time[i] if isinstance(lookback_time, list) else lookback_time,
+            lookahead_time=lookahead_time[i] if isinstance(lookahead_time, list) else lookahead_time,
+            context_type=ContextType(c) if (c := context_type[i] if isinstance(context_type, list) else context_type) is not None else None,
+        ) for i in range(batch_size)]
+        eos_mask = torch.zeros((batch_size, tokenizer.vocab_size_out), dtype=torch.bool)
+        for i, row_eos_token_id in enumerate(rows_eos_token_id):
+            eos_mask[i, row_eos_token_id] = True
+        # Tokens which are EOS for all rows are handled by generate, the rest by the stopping criteria
+        eos_token_id = sorted(set.intersection(*(set(e) for e in rows_eos_token_id)))
+        stopping_criteria.append(EosTokenMaskCriteria(eos_mask.to(model.device), eos_token_id))
+    else:
+        eos_token_id = get_eos_token_id(
+            tokenizer,
+            lookback_time=lookback_time,
+            lookahead_time=lookahead_time,
+            context_type=ContextType(context_type) if context_type is not None else None,
+        )
+
+    timer = None
+    if metrics is not None:
+        timer = StepTimer()
+        logits_processor_list.append(timer)
+
+    speculative_decoder = getattr(model, 'speculative_decoder', None)
+    if (speculative_decoder is not None and past_key_values is None and batch_size == 1 and 'max_new_tokens' not in generate_kwargs
+            and generate_kwargs.get('num_beams', 1) == 1):
+        return speculative_generate(
+            model,
+            speculative_decoder,
+            model_kwargs,
+            logits_processor_list,
+            get_logits_processor_list(),
+            eos_token_id=eos_token_id,
+            max_length=generate_kwargs.get('max_length', model.generation_config.max_length),
+            do_sample=do_sample,
+            top_k=generate_kwargs.get('top_k', 0),
+            top_p=generate_kwargs.get('top_p', 1.0),
+            precision=precision,
+            timer=timer,
+            metrics=metrics,
+        )
 
     # Prepare cache
-    cache = get_cache(model, batch_size, generate_kwargs.get('num_beams', 1), cfg_scale)
+    # Callers that generate repeatedly pass a pool to reuse caches, other calls free theirs afterwards
+    if past_key_values is not None:
+        cache = past_key_values
+    elif cache_pool is not None:
+        cache = cache_pool.acquire(model, batch_size, generate_kwargs.get('num_beams', 1), 2.0 if use_cfg else 1.0)
+    else:
+        cache = get_cache(model, batch_size, generate_kwargs.get('num_beams', 1), 2.0 if use_cfg else 1.0)
 
     # Perform batched generation
+    try:
+        with torch.autocast(device_type=model.device.type, dtype=torch.bfloat16, enabled=precision == 'amp'):
+            # Prefill the prefix shared by both CFG halves only once
+            shared_prefix_length = get_shared_prefix_length(model_kwargs) if use_cfg and generate_kwargs.get('num_beams', 1) == 1 else 0
+            shared_prefix_length = min(shared_prefix_length, model_kwargs['decoder_input_ids'].shape[1] - 1) if shared_prefix_length > 0 else 0
+            if shared_prefix_length > 0 and isinstance(cache.self_attention_cache, StaticCache) and cache.get_seq_length() == 0:
+                if 'encoder_outputs' not in model_kwargs:
+                    model_kwargs['encoder_outputs'] = model.get_encoder()(
+                        frames=model_kwargs['inputs'],
+                        beatmap_idx=model_kwargs.get('beatmap_idx'),
+                        difficulty=model_kwargs.get('difficulty'),
+                        mapper_idx=model_kwargs.get('mapper_idx'),
+                        song_position=model_kwargs.get('song_position'),
+                        return_dict=True,
+                    )
+                prefill_shared_prefix(model, cache, model_kwargs, shared_prefix_length)
+                if metrics is not None:
+                    metrics.inc('shared_prefix_tokens', shared_prefix_length * batch_size)
+
+            result = model.generate(
+                **model_kwargs,
+                **generate_kwargs,
+                use_cache=True,
+                past_key_values=cache,
+                logits_processor=logits_processor_list,
+                stopping_criteria=stopping_criteria,
+                eos_token_id=eos_token_id,
+            ).cpu()
+    finally:
+        if past_key_values is None and cache_pool is not None:
+            cache_pool.release(cache)
+
+    if timer is not None:
+        metrics.record_generate(timer, batch_size)
+
+    return result
+
+
+def speculative_generate(
+        model: Mapperatorinator,
+        speculative_decoder: SpeculativeDecoder,
+        model_kwargs: dict,
+        logits_processor_list: LogitsProcessorList,
+        draft_logits_processor_list: LogitsProcessorList,
+        *,
+        eos_token_id: list[int],
+        max_length: int,
+        do_sample: bool,
+        top_k: int,
+        top_p: float,
+        precision: str,
+        timer: StepTimer = None,
+        metrics: ServerMetrics = None,
+):
+    """Generates a single row with speculative decoding. Takes the logits processors of model_generate."""
+    # Add the sampling warpers generate would add after the logits processors
+    for processor_list in (logits_processor_list, draft_logits_processor_list):
+        if do_sample and top_k:
+            processor_list.append(TopKLogitsWarper(top_k))
+        if do_sample and top_p < 1.0:
+            processor_list.append(HFTopPLogitsWarper(top_p))
+
+    proposed, accepted = speculative_decoder.proposed, speculative_decoder.accepted
     with torch.autocast(device_type=model.device.type, dtype=torch.bfloat16, enabled=precision == 'amp'):
-        result = model.generate(
-            **model_kwargs,
-            **generate_kwargs,
-            use_cache=True,
-            past_key_values=cache,
+        result = speculative_decoder.generate(
+            model,
+            model_kwargs,
             logits_processor=logits_processor_list,
-            eos_token_id=get_eos_token_id(tokenizer, lookback_time=lookback_time, lookahead_time=lookahead_time, context_type=context_type),
+            draft_logits_processor=draft_logits_processor_list,
+            eos_token_id=eos_token_id,
+            max_length=max_length,
+            do_sample=do_sample,
         ).cpu()
 
+    if metrics is not None:
+        metrics.inc('draft_tokens_proposed', speculative_decoder.proposed - proposed)
+        metrics.inc('draft_tokens_accepted', speculative_decoder.accepted - accepted)
+        if timer is not None:
+            metrics.record_generate(timer, 1)
+
     return result
 
 
+@torch.no_grad()
+def model_encode(model, model_kwargs, precision='fp32'):
+    """Runs only the encoder so its outputs can be reused over multiple decode calls."""
+    # To device
+    model_kwargs = {k: v.to(model.device) if isinstance(v, torch.Tensor) else v for k, v in model_kwargs.items()}
+    model_kwargs = {k: v.to(model.dtype) if k != "inputs" and isinstance(v, torch.Tensor) and v.dtype == torch.float32 else v for k, v in model_kwargs.items()}
+    encoder = model.get_encoder()
+
+    with torch.autocast(device_type=model.device.type, dtype=torch.bfloat16, enabled=precision == 'amp'):
+        encoder_outputs = encoder(
+            frames=model_kwargs['inputs'],
+            beatmap_idx=model_kwargs.get('beatmap_idx'),
+            difficulty=model_kwargs.get('difficulty'),
+            mapper_idx=model_kwargs.get('mapper_idx'),
+            song_position=model_kwargs.get('song_position'),
+            return_dict=True,
+        )
+
+    return encoder_outputs.last_hidden_state
+
+
 @torch.no_grad()
 def model_forward(model, model_kwargs, generate_kwargs):
     # To device
@@ -131,6 +438,238 @@ def model_forward(model, model_kwargs, generate_kwargs):
     return logits
 
 
+def get_model_nbytes(model: torch.nn.Module) -> int:
+    return sum(t.numel() * t.element_size() for t in model.parameters()) + sum(t.numel() * t.element_size() for t in model.buffers())
+
+
+class ModelHost:
+    """
+    Holds the models of an inference server. Models are loaded on demand with the loaders registered for their model id.
+    When loading a model would exceed the memory budget, the least recently used models are unloaded first.
+    Models without a registered loader are never unloaded, because they could not be loaded again.
+    """
+
+    def __init__(self, memory_budget: int = None, on_evict=None):
+        """
+        :param memory_budget: Maximum number of bytes of model weights to keep loaded. None for no limit.
+        :param on_evict: Function called with the model id and model when a model gets unloaded.
+        """
+        self.memory_budget = memory_budget
+        self.on_evict = on_evict
+        self.loaders = {}  # model id -> (model_loader, tokenizer_loader)
+        self.loaded: OrderedDict = OrderedDict()  # model id -> (model, tokenizer), least recently used first
+        self.nbytes = {}  # model id -> size of the weights, also remembered for unloaded models
+        self.last_load_time = float('-inf')  # time.monotonic() of the last time a model was loaded
+        self.lock = threading.Lock()
+
+    def register(self, model_id, model_loader, tokenizer_loader):
+        with self.lock:
+            self.loaders[model_id] = (model_loader, tokenizer_loader)
+
+    def add(self, model_id, model, tokenizer):
+        with self.lock:
+            self.loaded[model_id] = (model, tokenizer)
+            self.nbytes[model_id] = get_model_nbytes(model)
+
+    def get_loaded_state(self) -> tuple[set, float]:
+        """Returns the ids of the loaded models and the time the last model was loaded."""
+        with self.lock:
+            return set(self.loaded.keys()), self.last_load_time
+
+    def get(self, model_id) -> tuple[Mapperatorinator, Tokenizer]:
+        with self.lock:
+            if model_id in self.loaded:
+                self.loaded.move_to_end(model_id)
+                return self.loaded[model_id]
+            if model_id not in self.loaders:
+                raise KeyError(f"Model {model_id} is not registered with the inference server.")
+            model_loader, tokenizer_loader = self.loaders[model_id]
+            # Guess the size of a model we have not seen yet from the largest loaded model
+            self._evict(self.nbytes.get(model_id, max(self.nbytes.values(), default=0)))
+
+        model = model_loader()
+        tokenizer = tokenizer_loader()
+        self.add(model_id, model, tokenizer)
+        with self.lock:
+            self.last_load_time = time.monotonic()
+        return model, tokenizer
+
+    def _evict(self, needed_bytes: int):
+        """Unloads models until needed_bytes fit in the memory budget. Must be called with the lock held."""
+        if self.memory_budget is None:
+            return
+        evicted = False
+        for model_id in list(self.loaded.keys()):
+            if sum(self.nbytes[i] for i in self.loaded) + needed_bytes <= self.memory_budget:
+                break
+            if model_id not in self.loaders:
+                continue
+            model, _ = self.loaded.pop(model_id)
+            print(f"Unloading model {model_id} from the inference server")
+            if self.on_evict is not None:
+                self.on_evict(model_id, model)
+            evicted = True
+
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def replica_worker(conn, cores: list[int], num_threads: int, memory_budget: int = None, cache_pool_bytes: int = 4 * 1024 ** 3):
+    """
+    Main loop of a model replica process. Runs the batches sent by a ReplicaPool on its own copy of the models.
+    The process is pinned to the given cores, so the thread pools of the replicas do not compete for them.
+    """
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+    torch.set_grad_enabled(False)
+
+    cache_pool = CachePool(cache_pool_bytes)
+    models = ModelHost(memory_budget, on_evict=lambda model_id, model: cache_pool.drop_model(model))
+    # Tensors are passed through shared memory in both directions
+    shm_reader = SharedMemoryReader(shared_tracker=True)
+    shm_writer = SharedMemoryWriter()
+
+    while True:
+        try:
+            op, args = conn.recv()
+        except (EOFError, OSError):
+            break
+        if op == "close":
+            break
+
+        try:
+            if op == "register":
+                models.register(*args)
+                result = None
+            elif op == "generate":
+                model_id, model_kwargs, generate_kwargs = args
+                model, tokenizer = models.get(model_id)
+                times = GenerateTimes()
+                output = model_generate(model, tokenizer, shm_reader.unpack(model_kwargs), generate_kwargs, cache_pool=cache_pool, metrics=times)
+                loaded, last_load_time = models.get_loaded_state()
+                # Send the age of the last load, because the clocks of the processes need not agree
+                result = (shm_writer.pack({'output': output}), times, loaded, time.monotonic() - last_load_time)
+            elif op == "generation_config":
+                result = models.get(args[0])[0].generation_config
+            else:
+                raise ValueError(f"Unknown replica operation {op}")
+            conn.send(("ok", result))
+        except Exception as e:
+            traceback.print_exc()
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+    shm_reader.close()
+    shm_writer.close()
+
+
+class ReplicaPool:
+    """
+    Model replicas in worker processes, each pinned to a disjoint group of CPU cores.
+    Batches are put in a shared queue, from which every replica takes the next batch as soon as it is idle.
+    The server does not need a copy of the models, because every replica runs whole batches.
+    The loaders of a model are sent to a replica once, before its first batch of the model,
+    and the tensors of batches and their results are passed through shared memory.
+    """
+
+    def __init__(self, num_replicas: int, threads_per_replica: int = None, memory_budget: int = None, cache_pool_bytes: int = 4 * 1024 ** 3):
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+        cores_per_replica = max(len(cores) // num_replicas, 1)
+        context = multiprocessing.get_context("spawn")  # forking a process that already uses OpenMP can deadlock
+        self.conns = []
+        self.processes = []
+        self.calls = queue.Queue()  # (future, op, model id, loaders, args) of calls to run
+        self.lock = threading.Lock()
+        self.loaded = [set() for _ in range(num_replicas)]  # model ids loaded in each replica, as of its last batch
+        self.last_load_time = float('-inf')
+        for i in range(num_replicas):
+            # Replicas share cores if there are more replicas than cores
+            replica_cores = cores[i * cores_per_replica:(i + 1) * cores_per_replica] or [cores[i % len(cores)]]
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=replica_worker,
+                args=(child_conn, replica_cores, threads_per_replica or len(replica_cores), memory_budget, cache_pool_bytes),
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.processes.append(process)
+        for i in range(num_replicas):
+            threading.Thread(target=self._feeder_thread, args=(i,), daemon=True).start()
+
+    def __len__(self):
+        return len(self.conns)
+
+    def submit(self, op: str, model_id, loaders: tuple, *args) -> Future:
+        """
+        Queues a call for the next idle replica.
+        "generate" takes the model kwargs and generate kwargs of a batch and resolves to its output and GenerateTimes.
+        "generation_config" resolves to the generation config of the model.
+        """
+        future = Future()
+        self.calls.put((future, op, model_id, loaders, args))
+        return future
+
+    def get_loaded_state(self) -> tuple[set, float]:
+        """Returns the ids of the models loaded in any replica and the time a replica last loaded a model."""
+        with self.lock:
+            return set().union(*self.loaded), self.last_load_time
+
+    def _feeder_thread(self, i: int):
+        """Takes calls from the shared queue and runs them on replica i, one at a time."""
+        conn = self.conns[i]
+        shm_writer = SharedMemoryWriter()
+        shm_reader = SharedMemoryReader(shared_tracker=True)
+        registered = {}  # model id -> loaders sent to the replica
+        while True:
+            item = self.calls.get()
+            if item is None:
+                break
+            future, op, model_id, loaders, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if registered.get(model_id) is not loaders:
+                    self._call(conn, "register", model_id, *loaders)
+                    registered[model_id] = loaders
+                if op == "generate":
+                    model_kwargs, generate_kwargs = args
+                    packed_output, times, loaded, load_age = self._call(conn, op, model_id, shm_writer.pack(model_kwargs), generate_kwargs)
+                    result = (shm_reader.unpack(packed_output)['output'], times)
+                    with self.lock:
+                        self.loaded[i] = loaded
+                        self.last_load_time = max(self.last_load_time, time.monotonic() - load_age)
+                else:
+                    result = self._call(conn, op, model_id, *args)
+                future.set_result(result)
+            except Exception as e:
+                future.set_exception(RuntimeError(f"Replica {i} failed: {e}"))
+
+        try:
+            conn.send(("close", ()))
+            conn.close()
+        except (EOFError, OSError):
+            pass
+        shm_writer.close()
+        shm_reader.close()
+
+    @staticmethod
+    def _call(conn, op: str, *args):
+        conn.send((op, args))
+        status, result = conn.recv()
+        if status == "error":
+            raise RuntimeError(result)
+        return result
+
+    def close(self):
+        # Each feeder thread closes its replica once it takes one of these
+        for _ in self.conns:
+            self.calls.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+
+
 class InferenceServer:
     def __init__(
             self,
@@ -139,28 +678,77 @@ class InferenceServer:
             max_batch_size=8,
             batch_timeout=0.2,
             idle_timeout=20,
-            socket_path=SOCKET_PATH
+            socket_path=SOCKET_PATH,
+            continuous_batching=False,
+            cache_pool_bytes=4 * 1024 ** 3,
+            model_id=None,
+            memory_budget=None,
+            metrics_log_path=None,
+            metrics_interval=60,
+            num_replicas=0,
+            threads_per_replica=None,
     ):
         """
         Initializes the inference server.
-        :param model: The model to use for inference.
+        :param model: The model to use for inference. None with replicas, which load their own copy of the model.
         :param tokenizer: The tokenizer to use for processing inputs.
         :param max_batch_size: Maximum batch size for processing requests.
-        :param batch_timeout: Time in seconds to wait for more requests before processing a batch.
+        :param batch_timeout: Maximum time in seconds to wait for more requests before processing a batch.
+            The actual wait adapts to the arrival rate of requests and is skipped when the batch is full
+            or every connected client is already waiting on a request.
         :param idle_timeout: Time in seconds to wait before shutting down due to no clients.
         :param socket_path: The address used for IPC.
+        :param continuous_batching: Let rows join and leave the running batch at every decoded token
+            instead of waiting for the whole batch to finish. Each row holds a slot of a preallocated cache,
+            which a new row takes over as soon as the row finishes. Only used for requests without beam search,
+            without replicas and for models with a Whisper backbone, the others run in static batches.
+        :param cache_pool_bytes: Maximum number of bytes of KV-caches to keep around for reuse between batches,
+            including the caches held by continuous batches.
+        :param model_id: The id of the given model. Clients can register more models to host under other ids.
+        :param memory_budget: Maximum number of bytes of model weights to keep loaded. None for no limit.
+        :param metrics_log_path: File to append a JSON snapshot of the server metrics to every metrics_interval seconds.
+        :param metrics_interval: Time in seconds between snapshots in the metrics log.
+        :param num_replicas: Number of model replicas in worker processes, each pinned to its own group of CPU cores.
+            Each replica runs whole batches of up to max_batch_size rows, so as many batches run at the same time.
+            The memory budget applies to each replica. 0 runs the model in the server process.
+            Replicas need registered loaders for their models.
+        :param threads_per_replica: Number of threads of each replica. Defaults to the number of cores of the replica.
         """
-        self.model: Mapperatorinator = model
-        self.tokenizer: Tokenizer = tokenizer
+        self.models = ModelHost(memory_budget, on_evict=self._on_evict)
+        if model is not None:
+            self.models.add(model_id, model, tokenizer)
         self.max_batch_size = max_batch_size
         self.batch_timeout = batch_timeout
         self.idle_timeout = idle_timeout
         self.socket_path = socket_path
-        self.grouped_requests = {}  # holds pending requests
+        self.continuous_batching = continuous_batching and num_replicas == 0
+        self.grouped_requests: dict[tuple, deque] = {}  # holds pending requests
+        self.active_rows = {}  # holds rows that are in the decode loop, grouped like grouped_requests
+        self.last_group = None
+        self.continuous_batches: dict[tuple, ContinuousBatch] = {}  # holds the slots of the active rows of each group
+        self.static_batches = []  # requests taken by each static batch that is running
+        self.cache_pool = CachePool(cache_pool_bytes)
         self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)  # notified when a request arrives
         self.shutdown_flag = threading.Event()
         self.listener = None
+        self.client_conns = {}  # connection -> shared memory reader of each connected client
+        self.wakeup_receiver, self.wakeup_sender = Pipe(duplex=False)  # wakes up the reader thread
+        self.outbox = queue.Queue()  # (connection, message) pairs sent by the sender thread
         self.connections = 0
+        self.waiting_clients = 0  # number of clients with a request in flight
+        self.last_arrival = None
+        self.arrival_interval = None  # exponential moving average of the time between requests
+        self.metrics = ServerMetrics()
+        self.metrics_log_path = metrics_log_path
+        self.metrics_interval = metrics_interval
+        self.num_replicas = num_replicas
+        self.threads_per_replica = threads_per_replica
+        self.memory_budget = memory_budget
+        self.cache_pool_bytes = cache_pool_bytes
+        self.replicas = None
+        self.generation_configs = {}  # model id -> (loaders, generation config) of the models run by the replicas
+        self.idle_replicas = threading.Semaphore(num_replicas)  # released when a replica finishes a batch
 
     def start(self):
         # Remove stale socket
@@ -169,134 +757,727 @@ class InferenceServer:
         except (FileNotFoundError, OSError):
             pass
 
+        if self.num_replicas > 0:
+            self.replicas = ReplicaPool(self.num_replicas, self.threads_per_replica, self.memory_budget, self.cache_pool_bytes)
+
         # Start IPC listener
         self.listener = Listener(self.socket_path)
         threading.Thread(target=self._listener_thread, daemon=True).start()
+        # Start the thread that reads requests from all clients
+        threading.Thread(target=self._reader_thread, daemon=True).start()
+        # Start the thread that sends responses, so slow clients do not hold up the other threads
+        threading.Thread(target=self._sender_thread, daemon=True).start()
         # Start batcher thread
         threading.Thread(target=self._batch_thread, daemon=True).start()
         # Start idle monitor
         threading.Thread(target=self._idle_monitor, daemon=True).start()
+        if self.metrics_log_path:
+            threading.Thread(target=self._metrics_logger, daemon=True).start()
 
     def _listener_thread(self):
         while not self.shutdown_flag.is_set():
             try:
                 conn = self.listener.accept()
-                # Handle each client in its own thread
-                threading.Thread(target=self._client_handler, args=(conn,), daemon=True).start()
+                # Hand the connection to the reader thread
+                with self.lock:
+                    self.client_conns[conn] = SharedMemoryReader()
+                    self.connections += 1
+                self.wakeup_sender.send_bytes(b"")
             except (OSError, EOFError) as e:
                 print(f"[Listener] Error in accept: {e}")
                 time.sleep(1)  # Wait before retrying
 
-    def _client_handler(self, conn):
-        with self.lock:
-            self.connections += 1
+    def _reader_thread(self):
+        """Receives the messages of all clients in a single thread."""
+        while not self.shutdown_flag.is_set():
+            with self.lock:
+                conns = list(self.client_conns.keys())
+            for conn in wait(conns + [self.wakeup_receiver], timeout=1):
+                if conn is self.wakeup_receiver:
+                    # A new client connected, so wait on its connection too
+                    conn.recv_bytes()
+                    continue
+                try:
+                    keep_open = self._handle_message(conn)
+                except Exception as e:
+                    # A bad message must not stop the thread that serves all clients
+                    print(f"[Reader] Error handling message: {e}")
+                    traceback.print_exc()
+                    keep_open = False
+                if not keep_open:
+                    self._close_client(conn)
+
+    def _handle_message(self, conn) -> bool:
+        """Handles one message from a client. Returns False if the connection is closed."""
         try:
-            with conn:
-                while True:
-                    try:
-                        model_kwargs, generate_kwargs = conn.recv()
-                    except _pickle.UnpicklingError:
-                        print("UnpicklingError detected! Requesting a retry from the client.")
-                        # Tell the client to try again
-                        conn.send(RETRY_SIGNAL)
-                        # Loop back to conn.recv() to wait for the resent data
-                        continue
-                    except (EOFError, OSError):
-                        break
+            message = conn.recv()
+            if message[0] == REGISTER_SIGNAL:
+                self.models.register(*message[1:])
+                return True
+            if message[0] == CANCEL_SIGNAL:
+                self._cancel_client_requests(conn)
+                return True
+            if message[0] == METRICS_SIGNAL:
+                return self._send(conn, self.get_metrics())
+            model_kwargs, generate_kwargs = message[:2]
+            model_id = message[2] if len(message) > 2 else None
+            timeout = message[3] if len(message) > 3 else None
+            model_kwargs = self.client_conns[conn].unpack(model_kwargs)
+        except _pickle.UnpicklingError:
+            print("UnpicklingError detected! Requesting a retry from the client.")
+            self.metrics.inc('unpickling_errors')
+            # Tell the client to try again
+            return self._send(conn, RETRY_SIGNAL)
+        except FileNotFoundError:
+            print("Shared memory block of the request is gone! Requesting a retry from the client.")
+            return self._send(conn, RETRY_SIGNAL)
+        except (EOFError, OSError):
+            return False
 
-                    generate_kwargs_set = frozenset(generate_kwargs.items())
+        group_key = (model_id, get_group_key(generate_kwargs))
+        batch_size = model_kwargs['inputs'].shape[0]
+        now = time.monotonic()
+        record = {'model_kwargs': model_kwargs, 'generate_kwargs': generate_kwargs, 'total_work': batch_size, 'work_done': 0, 'conn': conn, 'result': None,
+                  'row_results': [None] * batch_size, 'rows_finished': 0, 'time': now, 'deadline': now + timeout if timeout is not None else None,
+                  'cancelled': False, 'done': False}
 
-                    # Prepare a response event
-                    response_event = threading.Event()
-                    batch_size = model_kwargs['inputs'].shape[0]
-                    record = {'model_kwargs': model_kwargs, 'total_work': batch_size, 'work_done': 0, 'conn': conn, 'event': response_event, 'result': None}
+        # Enqueue request
+        with self.condition:
+            if group_key in self.grouped_requests:
+                self.grouped_requests[group_key].append(record)
+            else:
+                self.grouped_requests[group_key] = deque([record])
+            self.waiting_clients += 1
+            self._record_arrival()
+            self.condition.notify()
+        self.metrics.inc('requests_received')
+        self.metrics.inc('rows_received', batch_size)
+        return True
 
-                    # Enqueue request
-                    with self.lock:
-                        if generate_kwargs_set in self.grouped_requests:
-                            self.grouped_requests[generate_kwargs_set].append(record)
-                        else:
-                            self.grouped_requests[generate_kwargs_set] = [record]
+    def _close_client(self, conn):
+        # Nobody is left to receive the results of its requests
+        self._cancel_client_requests(conn)
+        with self.lock:
+            shm_reader = self.client_conns.pop(conn, None)
+            if shm_reader is not None:
+                self.connections -= 1
+        if shm_reader is not None:
+            shm_reader.close()
+        conn.close()
 
-                    # Wait until batch thread processes it
-                    response_event.wait()
+    def _sender_thread(self):
+        """Sends all messages to clients in a single thread, in the order they were queued."""
+        while not self.shutdown_flag.is_set():
+            try:
+                conn, message = self.outbox.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                conn.send(message)
+            except (EOFError, OSError):
+                # The reader thread closes the connection once it notices the client is gone
+                pass
 
-                    # Send back result
-                    conn.send(record['result'])
-        finally:  # Ensure we always close the connection
-            with self.lock:
-                self.connections -= 1
+    def _send(self, conn, message) -> bool:
+        """Queues a message for the sender thread. Returns True, so it can be returned by _handle_message."""
+        self.outbox.put((conn, message))
+        return True
+
+    def _respond(self, request: dict):
+        """Sends the result of a request back to its client. Only the first response of a request is sent."""
+        with self.lock:
+            if request['done']:
+                return
+            request['done'] = True
+            self.waiting_clients -= 1
+        if not isinstance(request['result'], str):
+            self.metrics.inc('requests_completed')
+            self.metrics.observe('request_seconds', time.monotonic() - request['time'])
+        self._send(request['conn'], request['result'])
+
+    def _get_requests(self) -> list[dict]:
+        """Returns all requests with pending or active rows. Must be called with the lock held."""
+        requests = {id(row['request']): row['request'] for rows in self.active_rows.values() for row in rows}
+        requests.update((id(request), request) for queue in self.grouped_requests.values() for request in queue)
+        return list(requests.values())
+
+    def _cancel_client_requests(self, conn):
+        """Marks the requests of a client as cancelled. The batch thread drops them before its next step."""
+        with self.condition:
+            for request in self._get_requests():
+                if request['conn'] is conn:
+                    request['cancelled'] = True
+            for batch_requests in self.static_batches:
+                for _, request, _, _ in batch_requests:
+                    # Requests in a running static batch are checked when it finishes
+                    if request['conn'] is conn:
+                        request['cancelled'] = True
+            self.condition.notify()
+
+    @staticmethod
+    def _get_expired_signal(request: dict, now: float):
+        """Returns the signal to respond with if the request was cancelled or passed its deadline, otherwise None."""
+        if request['cancelled']:
+            return CANCEL_SIGNAL
+        if request['deadline'] is not None and now > request['deadline']:
+            return DEADLINE_SIGNAL
+        return None
+
+    def _drop_expired_requests(self):
+        """Drops the queued and active rows of all requests that were cancelled or passed their deadline."""
+        now = time.monotonic()
+        with self.lock:
+            expired = [(request, self._get_expired_signal(request, now)) for request in self._get_requests()]
+        for request, signal in expired:
+            if signal is not None:
+                self._drop_requests([request], signal)
+
+    def _record_arrival(self):
+        """Updates the average time between requests. Must be called with the lock held."""
+        now = time.monotonic()
+        if self.last_arrival is not None:
+            interval = now - self.last_arrival
+            self.arrival_interval = interval if self.arrival_interval is None else 0.8 * self.arrival_interval + 0.2 * interval
+        self.last_arrival = now
+
+    def _get_batch_window(self) -> float:
+        """Returns how long to wait for more requests before dispatching a partial batch."""
+        if self.arrival_interval is None:
+            return self.batch_timeout
+        if self.arrival_interval > self.batch_timeout:
+            # Another request is unlikely to arrive in time, so waiting only adds latency
+            return 0
+        # Wait for about one more request per client that could still send one
+        idle_clients = max(self.connections - self.waiting_clients, 1)
+        return min(self.batch_timeout, self.arrival_interval * idle_clients)
+
+    def _is_batch_ready(self) -> bool:
+        """Returns whether a batch should be dispatched right away. Must be called with the lock held."""
+        if self.waiting_clients >= self.connections:
+            # No other client can send a request until one of these is answered
+            return True
+        for requests in self.grouped_requests.values():
+            capacity = self._get_batch_capacity(requests[0]['generate_kwargs'])
+            if sum(request['total_work'] - request['work_done'] for request in requests) >= capacity:
+                return True
+        return False
+
+    def _wait_for_batch(self):
+        """Blocks until a batch should be dispatched. Must be called with the condition held."""
+        while not self.grouped_requests:
+            # Wake up periodically to check the shutdown flag
+            self.condition.wait(self.batch_timeout)
+            if self.shutdown_flag.is_set():
+                return
+
+        deadline = time.monotonic() + self._get_batch_window()
+        while not self._is_batch_ready():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.condition.wait(remaining)
 
     def _batch_thread(self):
+        if self.replicas is not None:
+            self._replica_batch_thread()
+            return
+
         while not self.shutdown_flag.is_set():
-            time.sleep(self.batch_timeout)
+            with self.condition:
+                if not self.active_rows:
+                    # Nothing is decoding, so wait for requests to collect into a batch
+                    self._wait_for_batch()
+            # Evict the rows of cancelled and timed out requests before spending more time on them
+            self._drop_expired_requests()
             with self.lock:
-                if not self.grouped_requests:
-                    continue
-                generate_kwargs_set: frozenset = list(self.grouped_requests.keys())[0]
-                requests: list = self.grouped_requests[generate_kwargs_set]
-
-                generate_kwargs: dict = dict(generate_kwargs_set)
-                cfg_scale = generate_kwargs.get('cfg_scale', 1.0)
-                num_beams = generate_kwargs.get('num_beams', 1)
-                batch_multiplier = 2 * num_beams if cfg_scale > 1 else num_beams
-
-                # Grab full or partial requests until BATCH_SIZE is reached or requests is empty
-                batch_requests = []
-                remaining_batch_size = self.max_batch_size // batch_multiplier
-                while remaining_batch_size > 0 and len(requests) > 0:
-                    request = requests.pop(0)
-                    req_kwargs = request['model_kwargs']
-                    req_total_work = request['total_work']
-                    req_work_done = request['work_done']
-                    req_remaining_work = req_total_work - req_work_done
-                    work = min(req_remaining_work, remaining_batch_size)
-                    batch_requests.append((self._cut_model_kwargs(req_kwargs, req_work_done, work), request, work))
-                    remaining_batch_size -= work
-                    if req_remaining_work > work:
-                        # If there is still work left, re-add the record to the queue
-                        requests.insert(0, request)
-
-                if not self.grouped_requests[generate_kwargs_set]:
-                    del self.grouped_requests[generate_kwargs_set]
+                group_key = self._next_group()
+            if group_key is None:
+                continue
 
+            # Load the model of the group if it is not loaded
             try:
-                # Collate inputs
-                keys = [k for k in batch_requests[0][0].keys() if batch_requests[0][0][k] is not None]
-                model_kwargs = {}
-                paddings = [0 for _ in range(len(batch_requests))]  # For padding left
-                for k in keys:
-                    kwargses = [b[0][k] for b in batch_requests]
-                    # Pad left if necessary
-                    if kwargses[0].dim() > 1:
-                        max_len = max(tensor.size(-1) for tensor in kwargses)
-                        if k == 'decoder_input_ids':
-                            paddings = [max_len - tensor.size(-1) for tensor in kwargses]
-                        kwargses = [torch.nn.functional.pad(tensor, (max_len - tensor.size(-1), 0)) for tensor in kwargses]
-                    model_kwargs[k] = torch.cat(kwargses, dim=0)
-
-                outputs = model_generate(self.model, self.tokenizer, model_kwargs, generate_kwargs)
-
-                # Split and dispatch results
-                batch_i = 0
-                for i, (_, request, work_done) in enumerate(batch_requests):
-                    padding = paddings[i]
-                    out = outputs[batch_i:batch_i + work_done, padding:]  # Remove padding from the left
-                    batch_i += work_done
-                    request['result'] = out if request['result'] is None else torch.cat((request['result'], out), dim=0)
-                    request['work_done'] += work_done
-                    if request['work_done'] >= request['total_work']:
-                        # All work done for this record, signal completion
-                        request['event'].set()
+                model, tokenizer = self.models.get(group_key[0])
             except Exception as e:
-                print(f"[Batch Thread] Error processing batch: {e}")
+                print(f"[Batch Thread] Error loading model {group_key[0]}: {e}")
                 traceback.print_exc()
-                # Signal all requests in this batch to retry
-                for _, request, _ in batch_requests:
-                    request['result'] = RETRY_SIGNAL
-                    request['event'].set()  # Signal completion
+                self._fail_requests(self._get_group_requests(group_key))
+                continue
+
+            with self.lock:
+                if not self.active_rows.get(group_key) and not self.grouped_requests.get(group_key):
+                    continue
+
+                generate_kwargs = self._get_group_generate_kwargs(group_key)
+                if (self.continuous_batching and generate_kwargs.get('num_beams', 1) == 1
+                        and supports_continuous_batching(model)):
+                    rows = self._admit_rows(group_key, generate_kwargs, model, tokenizer)
+                    batch_requests = None
+                else:
+                    rows = None
+                    batch_requests = self._take_batch_requests(group_key, generate_kwargs)
+                    self.static_batches.append(batch_requests)
+
+            if rows is not None:
+                self._continuous_step(group_key, generate_kwargs, rows, model, tokenizer)
+            else:
+                self._static_step(generate_kwargs, batch_requests, model, tokenizer)
+
+    def _replica_batch_thread(self):
+        """Takes a static batch whenever a replica is idle and hands it to the replicas without waiting for it to finish."""
+        while not self.shutdown_flag.is_set():
+            # Wait for an idle replica first, so requests keep collecting into full batches while all replicas are busy
+            if not self.idle_replicas.acquire(timeout=1):
+                continue
+            submitted = False
+            try:
+                with self.condition:
+                    self._wait_for_batch()
+                self._drop_expired_requests()
+                with self.lock:
+                    group_key = self._next_group()
+                    if group_key is None or not self.grouped_requests.get(group_key):
+                        continue
+                    generate_kwargs = self._get_group_generate_kwargs(group_key)
+                    batch_requests = self._take_batch_requests(group_key, generate_kwargs)
+                    self.static_batches.append(batch_requests)
+                submitted = self._submit_replica_batch(group_key[0], generate_kwargs, batch_requests)
             finally:
-                torch.cuda.empty_cache()  # Clear any cached memory, otherwise will definitely run out of memory if multiple batch sizes are used
+                if not submitted:
+                    self.idle_replicas.release()
+
+    def _next_group(self):
+        """
+        Picks the next group to process in round-robin order. Must be called with the lock held.
+        Groups of models that are not loaded are skipped while other groups have work, to avoid swapping models back and forth.
+        They are only picked once they have waited longer than MODEL_SWITCH_TIMEOUT
+        and the last loaded model has stayed loaded for MODEL_MIN_RESIDENCY.
+        """
+        groups = list(dict.fromkeys(list(self.active_rows.keys()) + list(self.grouped_requests.keys())))
+        if not groups:
+            return None
+        index = (groups.index(self.last_group) + 1) % len(groups) if self.last_group in groups else 0
+        groups = groups[index:] + groups[:index]
+        now = time.monotonic()
+        loaded, last_load_time = (self.replicas or self.models).get_loaded_state()
+        can_switch = now - last_load_time > MODEL_MIN_RESIDENCY
+        self.last_group = next(
+            (g for g in groups if g[0] in loaded or (can_switch and now - self._get_group_start_time(g) > MODEL_SWITCH_TIMEOUT)),
+            groups[0],
+        )
+        return self.last_group
+
+    def _get_group_requests(self, group_key) -> list[dict]:
+        """Returns all requests with pending or active rows in the group."""
+        with self.lock:
+            requests = {id(row['request']): row['request'] for row in self.active_rows.get(group_key, [])}
+            requests.update((id(request), request) for request in self.grouped_requests.get(group_key, []))
+        return list(requests.values())
+
+    def _get_group_start_time(self, group_key) -> float:
+        """Returns the arrival time of the oldest request in the group. Must be called with the lock held."""
+        times = [row['request']['time'] for row in self.active_rows.get(group_key, [])]
+        times.extend(request['time'] for request in self.grouped_requests.get(group_key, []))
+        return min(times, default=time.monotonic())
+
+    def _on_evict(self, model_id, model):
+        self.cache_pool.drop_model(model)
+
+    def _get_group_generate_kwargs(self, group_key: tuple) -> dict:
+        """Returns the generate kwargs of any request in the group. Must be called with the lock held.
+        These only serve for the kwargs shared by the whole group, per-row kwargs are collated separately."""
+        if self.active_rows.get(group_key):
+            return dict(self.active_rows[group_key][0]['request']['generate_kwargs'])
+        return dict(self.grouped_requests[group_key][0]['generate_kwargs'])
+
+    @staticmethod
+    def _collate_row_generate_kwargs(generate_kwargs: dict, rows: list[tuple[dict, int]]) -> dict:
+        """Replaces the per-row generate kwargs with lists holding the value of each row,
+        given as the request and the index of the row in the request."""
+        row_values = [get_row_generate_kwargs(request['generate_kwargs'], index) for request, index in rows]
+        return generate_kwargs | {k: [v[k] for v in row_values] for k in ROW_GENERATE_KWARGS}
+
+    def _get_batch_capacity(self, generate_kwargs: dict) -> int:
+        """Returns the maximum number of rows in a batch."""
+        return self.max_batch_size // self._get_batch_multiplier(generate_kwargs)
+
+    def _get_batch_multiplier(self, generate_kwargs: dict) -> int:
+        num_beams = generate_kwargs.get('num_beams', 1)
+        return 2 * num_beams if uses_cfg(generate_kwargs) else num_beams
+
+    def _take_batch_requests(self, group_key: tuple, generate_kwargs: dict):
+        """Takes full or partial requests for a static batch. Must be called with the lock held.
+        Returns the model kwargs, request, index of the first row and number of rows of each part of the batch."""
+        requests: deque = self.grouped_requests[group_key]
+
+        # Grab full or partial requests until BATCH_SIZE is reached or requests is empty
+        batch_requests = []
+        remaining_batch_size = self._get_batch_capacity(generate_kwargs)
+        while remaining_batch_size > 0 and len(requests) > 0:
+            request = requests[0]
+            req_kwargs = request['model_kwargs']
+            req_total_work = request['total_work']
+            req_work_done = request['work_done']
+            req_remaining_work = req_total_work - req_work_done
+            work = min(req_remaining_work, remaining_batch_size)
+            if req_work_done == 0:
+                self.metrics.observe('queue_seconds', time.monotonic() - request['time'])
+            batch_requests.append((self._cut_model_kwargs(req_kwargs, req_work_done, work), request, req_work_done, work))
+            # Count the rows as taken right away, because with replicas the next batch is taken before this one finishes
+            request['work_done'] += work
+            remaining_batch_size -= work
+            if req_remaining_work <= work:
+                # No work left, so remove the record from the queue
+                requests.popleft()
+
+        if not self.grouped_requests[group_key]:
+            del self.grouped_requests[group_key]
+
+        return batch_requests
+
+    def _prepare_static_batch(self, generate_kwargs: dict, batch_requests: list) -> tuple[dict, dict, list[int]]:
+        """Collates the inputs of a static batch, padding left.
+        Returns the model kwargs, the generate kwargs with per-row values and the left padding of each part."""
+        keys = [k for k in batch_requests[0][0].keys() if batch_requests[0][0][k] is not None]
+        model_kwargs = {}
+        paddings = [0 for _ in range(len(batch_requests))]  # For padding left
+        for k in keys:
+            kwargses = [b[0][k] for b in batch_requests]
+            # Pad left if necessary
+            if kwargses[0].dim() > 1:
+                max_len = max(tensor.size(-1) for tensor in kwargses)
+                if k == 'decoder_input_ids':
+                    paddings = [max_len - tensor.size(-1) for tensor in kwargses]
+                kwargses = [torch.nn.functional.pad(tensor, (max_len - tensor.size(-1), 0)) for tensor in kwargses]
+            model_kwargs[k] = torch.cat(kwargses, dim=0)
+
+        rows = [(request, start + i) for _, request, start, work in batch_requests for i in range(work)]
+        self._record_batch(len(rows), self._get_batch_capacity(generate_kwargs))
+        generate_kwargs = self._collate_row_generate_kwargs(generate_kwargs, rows)
+        return model_kwargs, generate_kwargs, paddings
+
+    def _finish_static_batch(self, batch_requests: list, paddings: list[int], outputs: torch.Tensor, pad_id: int):
+        """Splits the outputs of a static batch and responds to the requests that are done."""
+        batch_i = 0
+        now = time.monotonic()
+        for i, (_, request, start, work) in enumerate(batch_requests):
+            padding = paddings[i]
+            out = outputs[batch_i:batch_i + work, padding:]  # Remove padding from the left
+            batch_i += work
+            if request['done']:
+                # Another part of the request failed or was dropped
+                continue
+            signal = self._get_expired_signal(request, now)
+            if signal is not None:
+                # Also drops the rest of the request that is still queued
+                self._drop_requests([request], signal)
+                continue
+            # Parts of a request can finish in any order, so place their rows by index
+            with self.lock:
+                request['row_results'][start:start + work] = list(out)
+                request['rows_finished'] += work
+                finished = request['rows_finished'] >= request['total_work']
+            if finished:
+                self._complete_request(request, pad_id)
+
+    def _remove_static_batch(self, batch_requests: list):
+        with self.lock:
+            self.static_batches = [b for b in self.static_batches if b is not batch_requests]
+
+    def _static_step(self, generate_kwargs: dict, batch_requests: list, model: Mapperatorinator, tokenizer: Tokenizer):
+        """Runs a batch with a single generate call until all rows are finished."""
+        try:
+            pad_id = self._get_pad_token_id(generate_kwargs, model.generation_config)
+            model_kwargs, generate_kwargs, paddings = self._prepare_static_batch(generate_kwargs, batch_requests)
+            outputs = model_generate(model, tokenizer, model_kwargs, generate_kwargs, cache_pool=self.cache_pool, metrics=self.metrics)
+            self._finish_static_batch(batch_requests, paddings, outputs, pad_id)
+        except Exception as e:
+            print(f"[Batch Thread] Error processing batch: {e}")
+            traceback.print_exc()
+            # Signal all requests in this batch to retry
+            self._fail_requests({id(request): request for _, request, _, _ in batch_requests}.values())
+        finally:
+            self._remove_static_batch(batch_requests)
+
+    def _submit_replica_batch(self, model_id, generate_kwargs: dict, batch_requests: list) -> bool:
+        """Queues a static batch for the replicas. Returns whether it was queued."""
+        try:
+            loaders = self._get_loaders(model_id)
+            pad_id = self._get_pad_token_id(generate_kwargs, self._get_replica_generation_config(model_id, loaders))
+            model_kwargs, generate_kwargs, paddings = self._prepare_static_batch(generate_kwargs, batch_requests)
+            future = self.replicas.submit("generate", model_id, loaders, model_kwargs, generate_kwargs)
+        except Exception as e:
+            print(f"[Batch Thread] Error processing batch: {e}")
+            traceback.print_exc()
+            self._fail_requests({id(request): request for _, request, _, _ in batch_requests}.values())
+            self._remove_static_batch(batch_requests)
+            return False
+        future.add_done_callback(functools.partial(self._on_replica_batch_done, batch_requests, paddings, pad_id))
+        return True
+
+    def _get_replica_generation_config(self, model_id, loaders: tuple) -> GenerationConfig:
+        """Returns the generation config of a model, read from the first replica that is idle, so the server does not load the model."""
+        if model_id not in self.generation_configs or self.generation_configs[model_id][0] is not loaders:
+            self.generation_configs[model_id] = (loaders, self.replicas.submit("generation_config", model_id, loaders).result())
+        return self.generation_configs[model_id][1]
+
+    @staticmethod
+    def _get_pad_token_id(generate_kwargs: dict, generation_config: GenerationConfig) -> int:
+        pad_token_id = generate_kwargs.get('pad_token_id', generation_config.pad_token_id)
+        return pad_token_id if pad_token_id is not None else 0
+
+    def _on_replica_batch_done(self, batch_requests: list, paddings: list[int], pad_id: int, future: Future):
+        """Dispatches the results of a batch run by a replica. Called by the thread that fed the batch to the replica."""
+        try:
+            outputs, times = future.result()
+            for call in times.calls:
+                self.metrics.record_generate_times(*call)
+            for name, value in times.counters.items():
+                self.metrics.inc(name, value)
+            self._finish_static_batch(batch_requests, paddings, outputs, pad_id)
+        except Exception as e:
+            print(f"[Replica] Error processing batch: {e}")
+            # Signal all requests in this batch to retry
+            self._fail_requests({id(request): request for _, request, _, _ in batch_requests}.values())
+        finally:
+            self._remove_static_batch(batch_requests)
+            self.idle_replicas.release()
+            with self.condition:
+                self.condition.notify()
+
+    def _admit_rows(self, group_key: tuple, generate_kwargs: dict, model: Mapperatorinator, tokenizer: Tokenizer) -> list[dict]:
+        """Moves queued rows into the decode loop until the batch is full. Must be called with the lock held."""
+        rows = self.active_rows.setdefault(group_key, [])
+        requests: deque = self.grouped_requests.get(group_key, deque())
+        capacity = self._get_batch_capacity(generate_kwargs) - len(rows)
+
+        while capacity > 0 and len(requests) > 0:
+            request = requests[0]
+            work = min(request['total_work'] - request['work_done'], capacity)
+            if request['work_done'] == 0:
+                self.metrics.observe('queue_seconds', time.monotonic() - request['time'])
+            for i in range(request['work_done'], request['work_done'] + work):
+                rows.append(self._make_row(request, i, model, tokenizer))
+            request['work_done'] += work
+            capacity -= work
+            if request['work_done'] >= request['total_work']:
+                requests.popleft()
+
+        if group_key in self.grouped_requests and not requests:
+            del self.grouped_requests[group_key]
+
+        return rows
+
+    def _make_row(self, request: dict, index: int, model: Mapperatorinator, tokenizer: Tokenizer) -> dict:
+        """Splits a single row off a request so it can be decoded independently."""
+        kwargs = self._cut_model_kwargs(request['model_kwargs'], index, 1)
+        prompt = kwargs.pop('decoder_input_ids', None)
+        if prompt is None:
+            prompt = torch.tensor([[model.generation_config.decoder_start_token_id]], dtype=torch.long)
+        attention_mask = kwargs.pop('decoder_attention_mask', None)
+        if attention_mask is None:
+            attention_mask = prompt.ne(tokenizer.pad_id)
+        negative_prompt = kwargs.pop('negative_prompt', None)
+        # Generate takes the negative prompt attention mask for its own CFG, so the negative prompt uses the attention mask of the prompt
+        kwargs.pop('negative_prompt_attention_mask', None)
+        row_kwargs = get_row_generate_kwargs(request['generate_kwargs'], index)
+        eos_token_id = get_eos_token_id(
+            tokenizer,
+            lookback_time=row_kwargs['lookback_time'],
+            lookahead_time=row_kwargs['lookahead_time'],
+            context_type=ContextType(row_kwargs['context_type']) if row_kwargs['context_type'] is not None else None,
+        )
+
+        return {
+            'request': request,
+            'index': index,
+            'pad_id': tokenizer.pad_id,
+            'eos_token_id': eos_token_id,
+            'encoder_kwargs': {k: v for k, v in kwargs.items() if v is not None},
+            'slot': None,  # slot in the continuous batch, once the row is prefilled
+            'tokens': prompt[0],
+            'attention_mask': attention_mask[0].bool(),
+            'negative_prompt': negative_prompt[0] if negative_prompt is not None else None,
+        }
+
+    def _continuous_step(self, group_key: tuple, generate_kwargs: dict, rows: list[dict], model: Mapperatorinator, tokenizer: Tokenizer):
+        """Generates one token for all active rows of a group. Rows that just joined are prefilled into free slots
+        of the continuous batch of the group first, and finished rows leave it right away."""
+        max_length = generate_kwargs.get('max_length', model.generation_config.max_length)
+        precision = generate_kwargs.get('precision', 'fp32')
+
+        try:
+            batch = self._get_continuous_batch(group_key, generate_kwargs, model)
+            with torch.autocast(device_type=model.device.type, dtype=torch.bfloat16, enabled=precision == 'amp'):
+                # Run the encoder once for the rows that just joined, then prefill each into its own slot
+                new_rows = [row for row in rows if row['slot'] is None]
+                if len(new_rows) > 0:
+                    encoder_kwargs = {k: torch.cat([row['encoder_kwargs'][k] for row in new_rows], dim=0) for k in new_rows[0]['encoder_kwargs']}
+                    encode_start = time.perf_counter()
+                    encoder_outputs = model_encode(model, encoder_kwargs, precision)
+                    self.metrics.observe('encode_seconds', time.perf_counter() - encode_start)
+                    prefill_start = time.perf_counter()
+                    for row, row_encoder_outputs in zip(new_rows, encoder_outputs.split(1)):
+                        row['slot'] = batch.add(
+                            model,
+                            row['tokens'].unsqueeze(0).to(model.device),
+                            row['attention_mask'].unsqueeze(0).to(model.device),
+                            row_encoder_outputs,
+                            self._get_row_logits_processor(row, generate_kwargs, model, tokenizer),
+                            row['eos_token_id'],
+                            max_length,
+                            negative_prompt=row['negative_prompt'].unsqueeze(0).to(model.device) if row['negative_prompt'] is not None else None,
+                        )
+                        row['encoder_kwargs'] = None
+                    self.metrics.record_prefill(time.perf_counter() - prefill_start, len(new_rows))
+
+                self._record_batch(len(rows), batch.capacity)
+                step_start = time.perf_counter()
+                finished = batch.step(model)
+                self.metrics.record_decode_step(time.perf_counter() - step_start, len(rows))
+
+            finished_rows = [row for row in rows if row['slot'] in finished]
+            rows[:] = [row for row in rows if row['slot'] not in finished]
+            for row in finished_rows:
+                row['tokens'] = finished[row['slot']]
+                self._finish_row(row)
+        except Exception as e:
+            print(f"[Batch Thread] Error processing batch: {e}")
+            traceback.print_exc()
+            # Signal all requests with rows in this batch to retry
+            self._fail_requests({id(row['request']): row['request'] for row in rows}.values())
+        finally:
+            with self.lock:
+                self._release_empty_groups()
+
+    def _get_continuous_batch(self, group_key: tuple, generate_kwargs: dict, model: Mapperatorinator) -> ContinuousBatch:
+        """Returns the continuous batch of a group, which holds a cache with a slot for as many rows as fit in a batch."""
+        if group_key not in self.continuous_batches:
+            cache = self.cache_pool.acquire(model, self._get_batch_capacity(generate_kwargs), cfg_scale=2.0 if uses_cfg(generate_kwargs) else 1.0)
+            self.cache_pool.hold(cache)
+            self.continuous_batches[group_key] = ContinuousBatch(cache, do_sample=generate_kwargs.get('do_sample', False))
+        return self.continuous_batches[group_key]
+
+    @staticmethod
+    def _get_row_logits_processor(row: dict, generate_kwargs: dict, model: Mapperatorinator, tokenizer: Tokenizer) -> LogitsProcessorList:
+        """Creates the logits processors of a single row, with the sampling warpers generate would add after them."""
+        row_kwargs = get_row_generate_kwargs(row['request']['generate_kwargs'], row['index'])
+        do_sample = generate_kwargs.get('do_sample', False)
+        top_k = generate_kwargs.get('top_k', 0)
+        logits_processor_list = get_row_logits_processor_list(
+            model,
+            tokenizer,
+            row_kwargs,
+            types_first=generate_kwargs.get('types_first', False),
+            do_sample=do_sample,
+            top_k=top_k,
+        )
+        if do_sample and top_k:
+            logits_processor_list.append(TopKLogitsWarper(top_k))
+        if do_sample and row_kwargs['top_p'] < 1.0:
+            logits_processor_list.append(HFTopPLogitsWarper(row_kwargs['top_p']))
+        return logits_processor_list
+
+    def _release_empty_groups(self):
+        """Removes groups without active rows and gives the caches of their continuous batches back to the pool.
+        Must be called with the lock held."""
+        for group_key in [group_key for group_key, rows in self.active_rows.items() if not rows]:
+            del self.active_rows[group_key]
+            batch = self.continuous_batches.pop(group_key, None)
+            if batch is not None:
+                self.cache_pool.unhold(batch.cache)
+                self.cache_pool.release(batch.cache)
+
+    def _get_loaders(self, model_id) -> tuple:
+        if model_id not in self.models.loaders:
+            raise KeyError(f"Model {model_id} has no registered loaders, so it can not be loaded in the replicas.")
+        return self.models.loaders[model_id]
+
+    def _finish_row(self, row: dict):
+        request = row['request']
+        request['row_results'][row['index']] = row['tokens']
+        request['rows_finished'] += 1
+        if request['rows_finished'] >= request['total_work']:
+            self._complete_request(request, row['pad_id'])
+
+    def _complete_request(self, request: dict, pad_id: int):
+        """Responds with the rows of a request once all of them are done, padded right like generate does."""
+        max_len = max(len(tokens) for tokens in request['row_results'])
+        request['result'] = torch.stack([torch.nn.functional.pad(tokens, (0, max_len - len(tokens)), value=pad_id)
+                                         for tokens in request['row_results']])
+        request['row_results'] = None
+        self._respond(request)
+
+    def _fail_requests(self, requests):
+        """Drops all queued and active rows of the given requests and tells their clients to retry."""
+        self._drop_requests(requests, RETRY_SIGNAL)
+
+    def _drop_requests(self, requests, signal: str):
+        """Drops all queued and active rows of the given requests and responds with the given signal.
+        Must be called from the batch thread, because it changes the rows of the running batch."""
+        requests = list(requests)
+        with self.lock:
+            for group in list(self.grouped_requests.keys()):
+                self.grouped_requests[group] = deque(r for r in self.grouped_requests[group] if all(r is not f for f in requests))
+                if not self.grouped_requests[group]:
+                    del self.grouped_requests[group]
+            for group in self.active_rows:
+                batch = self.continuous_batches.get(group)
+                for row in self.active_rows[group]:
+                    if batch is not None and row['slot'] is not None and any(row['request'] is f for f in requests):
+                        # Free the slot right away, so the next step does not decode the row anymore
+                        batch.remove(row['slot'])
+                self.active_rows[group][:] = [row for row in self.active_rows[group] if all(row['request'] is not f for f in requests)]
+            self._release_empty_groups()
+        self.metrics.inc(DROP_COUNTERS[signal], len(requests))
+        for request in requests:
+            request['result'] = signal
+            self._respond(request)
+
+    def _record_batch(self, batch_size: int, capacity: int):
+        self.metrics.inc('batches')
+        self.metrics.inc('batch_rows', batch_size)
+        self.metrics.observe('batch_occupancy', batch_size / capacity)
+
+    @staticmethod
+    def _format_group_key(group_key: tuple) -> str:
+        model_id, key = group_key
+        return f"{model_id}|" + ",".join(f"{k}={v}" for k, v in sorted(key, key=lambda item: item[0]))
+
+    def get_metrics(self) -> dict:
+        """Returns a snapshot of the server metrics, including the current queue depth and cache size."""
+        with self.lock:
+            queue_depth = {
+                self._format_group_key(group_key): sum(request['total_work'] - request['work_done'] for request in requests)
+                for group_key, requests in self.grouped_requests.items()
+            }
+            active_rows = {self._format_group_key(group_key): len(rows) for group_key, rows in self.active_rows.items()}
+            connections = self.connections
+            waiting_clients = self.waiting_clients
+            arrival_interval = self.arrival_interval
+        loaded_models, _ = (self.replicas or self.models).get_loaded_state()
+        cache_bytes = sum(get_cache_nbytes(batch.cache) for batch in list(self.continuous_batches.values()))
+        return self.metrics.snapshot({
+            'queue_depth': queue_depth,
+            'active_rows': active_rows,
+            'connections': connections,
+            'waiting_clients': waiting_clients,
+            'arrival_interval': arrival_interval,
+            'batch_window': self._get_batch_window(),
+            'max_batch_size': self.max_batch_size,
+            'batch_timeout': self.batch_timeout,
+            'cache_bytes': cache_bytes,
+            'cache_pool_bytes': self.cache_pool.total_bytes,
+            'loaded_models': list(loaded_models),
+            'model_bytes': sum(self.models.nbytes.get(model_id, 0) for model_id in loaded_models),
+        })
+
+    def _metrics_logger(self):
+        while not self.shutdown_flag.wait(self.metrics_interval):
+            try:
+                with open(self.metrics_log_path, "a") as f:
+                    f.write(json.dumps(self.get_metrics(), default=str) + "\n")
+            except OSError as e:
+                print(f"[Metrics] Error writing metrics log: {e}")
 
     def _cut_model_kwargs(self, model_kwargs, start, length):
         """Cuts the model_kwargs tensors to the specified range."""
@@ -317,6 +1498,8 @@ class InferenceServer:
                     os.unlink(self.socket_path)
                 except Exception:
                     pass
+                if self.replicas is not None:
+                    self.replicas.close()
 
 
 class InferenceClient:
@@ -328,15 +1511,34 @@ class InferenceClient:
             batch_timeout=0.2,
             idle_timeout=20,
             socket_path=SOCKET_PATH,
+            continuous_batching=False,
+            use_shared_memory=True,
+            model_id=None,
+            memory_budget=None,
+            request_timeout=None,
+            metrics_log_path=None,
+            num_replicas=0,
+            threads_per_replica=None,
     ):
         """
         Initializes the inference client. Automatically starts the inference server if it is not running.
         :param model_loader: Function to load the model.
         :param tokenizer_loader: Function to load the tokenizer.
         :param max_batch_size: Maximum batch size for processing requests.
-        :param batch_timeout: Time in seconds to wait for more requests before processing a batch.
+        :param batch_timeout: Maximum time in seconds to wait for more requests before processing a batch.
         :param idle_timeout: Time in seconds to wait before shutting down due to no clients.
         :param socket_path: The address used for IPC.
+        :param continuous_batching: Let rows join and leave the running batch of the server at every decoded token,
+            if it is started by this client.
+        :param use_shared_memory: Send request tensors through shared memory instead of pickling them over the socket.
+        :param model_id: Id of the model on a server that hosts multiple models. If given, the loaders are sent
+            to the server, so they must be picklable, for example a functools.partial of a module-level function.
+        :param memory_budget: Maximum number of bytes of model weights the server keeps loaded. None for no limit.
+        :param request_timeout: Default time in seconds the server may spend on a request before dropping it. None for no limit.
+        :param metrics_log_path: File the server appends a JSON snapshot of its metrics to every minute, if it is started by this client.
+        :param num_replicas: Number of CPU model replicas of the server, if it is started by this client.
+            The loaders must be picklable to use replicas.
+        :param threads_per_replica: Number of threads of each replica. Defaults to the number of cores of the replica.
         """
         self.model_loader = model_loader
         self.tokenizer_loader = tokenizer_loader
@@ -344,7 +1546,17 @@ class InferenceClient:
         self.batch_timeout = batch_timeout
         self.idle_timeout = idle_timeout
         self.socket_path = socket_path
+        self.continuous_batching = continuous_batching
+        self.shm_writer = SharedMemoryWriter() if use_shared_memory else None
+        self.model_id = model_id
+        self.memory_budget = memory_budget
+        self.request_timeout = request_timeout
+        self.metrics_log_path = metrics_log_path
+        self.num_replicas = num_replicas
+        self.threads_per_replica = threads_per_replica
         self.conn = None
+        self.send_lock = threading.Lock()  # cancel may be called from another thread than generate
+        self.cancelled = False
 
     def __enter__(self):
         self._reconnect()
@@ -354,40 +1566,85 @@ class InferenceClient:
         try:
             self.conn = Client(self.socket_path)
         except FileNotFoundError:
-            # No server: start one
-            threading.Thread(target=self._start_server, args=(self.model_loader, self.tokenizer_loader), daemon=False).start()
-            # Wait for server socket to appear
-            while not os.path.exists(self.socket_path):
-                time.sleep(0.1)
+            # Clients in other threads, like the jobs of the API server, must not start a second server
+            with SERVER_START_LOCK:
+                if not os.path.exists(self.socket_path):
+                    # No server: start one
+                    threading.Thread(target=self._start_server, args=(self.model_loader, self.tokenizer_loader), daemon=False).start()
+                # Wait for server socket to appear
+                while not os.path.exists(self.socket_path):
+                    time.sleep(0.1)
             self.conn = Client(self.socket_path)
 
+        if self.model_id is not None:
+            # Tell the server how to load our model, in case it hosts other models or unloaded ours
+            self.conn.send((REGISTER_SIGNAL, self.model_id, self.model_loader, self.tokenizer_loader))
+
     def __exit__(self, exception_type, exception_value, exception_traceback):
         if self.conn:
+            # Make sure the server does not keep working on a request we will never receive
+            self._send_cancel()
             self.conn.close()
+        if self.shm_writer is not None:
+            self.shm_writer.close()
 
     def _start_server(self, model_loader, tokenizer_loader):
-        # Load model inside server process
-        model = model_loader()
-        tokenizer = tokenizer_loader()
+        # Load model inside server process, unless the replicas load their own copy
+        model, tokenizer = (model_loader(), tokenizer_loader()) if self.num_replicas == 0 else (None, None)
         server = InferenceServer(
             model,
             tokenizer,
             max_batch_size=self.max_batch_size,
             batch_timeout=self.batch_timeout,
             idle_timeout=self.idle_timeout,
-            socket_path=self.socket_path
+            socket_path=self.socket_path,
+            continuous_batching=self.continuous_batching,
+            model_id=self.model_id,
+            memory_budget=self.memory_budget,
+            metrics_log_path=self.metrics_log_path,
+            num_replicas=self.num_replicas,
+            threads_per_replica=self.threads_per_replica,
         )
+        if self.num_replicas > 0:
+            server.models.register(self.model_id, model_loader, tokenizer_loader)
         server.start()
         # Block until shutdown
         while not server.shutdown_flag.is_set():
             time.sleep(1)
 
-    def generate(self, model_kwargs, generate_kwargs, max_retries=3):
+    def cancel(self):
+        """Cancels the request in flight and all future requests. Can be called from any thread."""
+        self.cancelled = True
+        self._send_cancel()
+
+    def _send_cancel(self):
+        try:
+            with self.send_lock:
+                self.conn.send((CANCEL_SIGNAL,))
+        except (AttributeError, EOFError, OSError):
+            pass
+
+    def get_metrics(self) -> dict:
+        """Returns a snapshot of the server metrics. Must not be called while a request is in flight."""
+        with self.send_lock:
+            self.conn.send((METRICS_SIGNAL,))
+        return self.conn.recv()
+
+    def generate(self, model_kwargs, generate_kwargs, max_retries=3, timeout=None):
+        """
+        Sends a request to the server and waits for the result.
+        :param timeout: Time in seconds the server may spend on the request. Defaults to request_timeout.
+        """
+        timeout = self.request_timeout if timeout is None else timeout
         attempts = 0
         while attempts < max_retries:
+            if self.cancelled:
+                raise RequestCancelledError("Request was cancelled.")
             # Send request and wait for response
             try:
-                self.conn.send((model_kwargs, generate_kwargs))
+                packed_kwargs = self.shm_writer.pack(model_kwargs) if self.shm_writer is not None else model_kwargs
+                with self.send_lock:
+                    self.conn.send((packed_kwargs, generate_kwargs, self.model_id, timeout))
                 result = self.conn.recv()
             except (EOFError, OSError):
                 print("Connection error, attempting to reconnect...")
@@ -399,13 +1656,34 @@ class InferenceClient:
                 print("Retrying request due to Error.")
                 attempts += 1
                 continue
+            elif result == CANCEL_SIGNAL:
+                raise RequestCancelledError("Request was cancelled.")
+            elif result == DEADLINE_SIGNAL:
+                raise TimeoutError(f"Request did not finish within {timeout} seconds.")
             else:
                 return result
 
         raise RuntimeError(f"Failed to get a valid response after {max_retries} attempts.")
 
 
+def get_server_metrics(socket_path=SOCKET_PATH) -> dict | None:
+    """Returns a snapshot of the metrics of the server at the given address, or None if no server is running."""
+    try:
+        conn = Client(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    try:
+        conn.send((METRICS_SIGNAL,))
+        return conn.recv()
+    except (EOFError, OSError):
+        return None
+    finally:
+        conn.close()
+
+
 if __name__ == "__main__":
+    from ..model import Mapperatorinator
+
     ckpt_path_str = "OliBomby/Mapperatorinator-v30"
 
     # Example usage
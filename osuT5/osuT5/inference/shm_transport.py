@@ -0,0 +1,108 @@
+import os
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+import torch
+
+# Marks a model_kwargs value that was moved to shared memory
+SHM_TENSOR = "SHM_TENSOR"
+
+# Alignment of tensors in the shared memory block
+ALIGNMENT = 64
+
+
+def _aligned(size: int) -> int:
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class SharedMemoryWriter:
+    """
+    Client side of the shared memory transport.
+    Copies the tensors of a request into a shared memory block and replaces them with small descriptors,
+    so only the descriptors have to be pickled and sent over the socket.
+    The block is reused for every request and only reallocated when a request does not fit.
+    """
+
+    def __init__(self, min_size: int = 1 << 20):
+        self.min_size = min_size
+        self.shm: shared_memory.SharedMemory | None = None
+
+    def pack(self, model_kwargs: dict) -> dict:
+        tensors = {k: v.detach().cpu().contiguous() for k, v in model_kwargs.items() if isinstance(v, torch.Tensor)}
+        total_size = sum(_aligned(t.numel() * t.element_size()) for t in tensors.values())
+        self._ensure_capacity(total_size)
+
+        packed = {k: v for k, v in model_kwargs.items() if k not in tensors}
+        offset = 0
+        for k, t in tensors.items():
+            nbytes = t.numel() * t.element_size()
+            dst = np.ndarray((nbytes,), dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+            dst[:] = t.view(-1).view(torch.uint8).numpy()
+            packed[k] = (SHM_TENSOR, self.shm.name, os.getpid(), offset, str(t.dtype).removeprefix("torch."), tuple(t.shape))
+            offset += _aligned(nbytes)
+        return packed
+
+    def _ensure_capacity(self, size: int):
+        if self.shm is not None and self.shm.size >= size:
+            return
+        self.close()
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, self.min_size))
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class SharedMemoryReader:
+    """
+    Server side of the shared memory transport.
+    Restores the tensors of a request packed by a SharedMemoryWriter.
+    Attached blocks are kept open until the client switches to a new block or the reader is closed.
+    """
+
+    def __init__(self, shared_tracker: bool = False):
+        """
+        :param shared_tracker: Whether the writer uses the same resource tracker as this process,
+            like processes started with multiprocessing do. Blocks are then left registered for the writer to unlink.
+        """
+        self.blocks: dict[str, shared_memory.SharedMemory] = {}
+        self.shared_tracker = shared_tracker
+
+    def unpack(self, model_kwargs: dict) -> dict:
+        unpacked = {}
+        for k, v in model_kwargs.items():
+            if not is_shm_descriptor(v):
+                unpacked[k] = v
+                continue
+            _, name, pid, offset, dtype, shape = v
+            shm = self._attach(name, pid)
+            dtype = getattr(torch, dtype)
+            count = int(np.prod(shape))
+            nbytes = count * torch.empty((), dtype=dtype).element_size()
+            src = np.ndarray((nbytes,), dtype=np.uint8, buffer=shm.buf, offset=offset)
+            # Copy out of the shared block, so it can be reused by the client for the next request
+            unpacked[k] = torch.from_numpy(src.copy()).view(dtype).reshape(shape)
+        return unpacked
+
+    def _attach(self, name: str, pid: int) -> shared_memory.SharedMemory:
+        if name in self.blocks:
+            return self.blocks[name]
+        # The client only ever uses one block at a time, so any other block is stale
+        self.close()
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == "posix" and pid != os.getpid() and not self.shared_tracker:
+            # The creating process owns the block. Stop our resource tracker from unlinking it when we exit.
+            resource_tracker.unregister(shm._name, "shared_memory")  # noqa
+        self.blocks[name] = shm
+        return shm
+
+    def close(self):
+        for shm in self.blocks.values():
+            shm.close()
+        self.blocks.clear()
+
+
+def is_shm_descriptor(value) -> bool:
+    return isinstance(value, tuple) and len(value) == 6 and value[0] == SHM_TENSOR
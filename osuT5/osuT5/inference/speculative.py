@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import LogitsProcessorList
+from transformers.cache_utils import DynamicCache, EncoderDecoderCache
+from transformers.modeling_outputs import BaseModelOutput
+
+if TYPE_CHECKING:
+    from ..model import Mapperatorinator
+
+ENCODER_KWARGS = ('beatmap_idx', 'difficulty', 'mapper_idx', 'song_position')
+SPECTROGRAM_SETTINGS = ('spectrogram_implementation', 'spectrogram_log_scale', 'sample_rate', 'n_fft', 'n_mels',
+                        'hop_length', 'f_min', 'f_max', 'pad_mode')
+
+
+class SpeculativeDecoder:
+    """
+    Speculative decoding with a small draft model that uses the same tokenizer and audio windows as the main model.
+    The draft model proposes up to num_draft_tokens tokens, which the main model verifies in a single forward pass.
+    Draft tokens are accepted with the speculative sampling rule, so the generated tokens follow the distribution
+    of the main model exactly. Only supports a single row without beam search.
+    """
+
+    def __init__(self, draft_model: Mapperatorinator, num_draft_tokens: int = 4):
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.proposed = 0
+        self.accepted = 0
+
+    @property
+    def acceptance_rate(self) -> Optional[float]:
+        return self.accepted / self.proposed if self.proposed > 0 else None
+
+    def check_compatible(self, model: Mapperatorinator):
+        """Raises a ValueError if the draft model can not draft for the given model."""
+        for name in ('vocab_size_in', 'vocab_size_out', 'sample_rate', 'hop_length', 'src_seq_len'):
+            model_value = getattr(model.config, name, None)
+            draft_value = getattr(self.draft_model.config, name, None)
+            if model_value != draft_value:
+                raise ValueError(f"Draft model has {name}={draft_value}, but the main model has {name}={model_value}.")
+
+    @torch.no_grad()
+    def generate(
+            self,
+            model: Mapperatorinator,
+            model_kwargs: dict,
+            *,
+            logits_processor: LogitsProcessorList,
+            draft_logits_processor: LogitsProcessorList,
+            eos_token_id: list[int],
+            max_length: int,
+            do_sample: bool,
+    ) -> torch.LongTensor:
+        """
+        Generates tokens like model.generate for a batch of one row.
+        The logits processors have to include the sampling warpers. The draft model gets its own logits processors,
+        because some logits processors keep state between steps.
+        """
+        frames = model_kwargs['inputs']
+        encoder_kwargs = {k: model_kwargs.get(k) for k in ENCODER_KWARGS}
+        encoder_outputs = model_kwargs.get('encoder_outputs')
+        if encoder_outputs is None:
+            encoder_outputs = model.get_encoder()(frames, **encoder_kwargs, return_dict=True)
+        if frames.dim() == 3:
+            # Precomputed spectrograms only fit a draft model with the same spectrogram settings
+            for name in SPECTROGRAM_SETTINGS:
+                if getattr(model.config, name, None) != getattr(self.draft_model.config, name, None):
+                    raise ValueError(f"Draft model has a different {name} than the main model, so it can not use precomputed spectrograms.")
+        draft_encoder_outputs = self.draft_model.get_encoder()(frames, **encoder_kwargs, return_dict=True)
+
+        input_ids = model_kwargs['decoder_input_ids']
+        attention_mask = model_kwargs.get('decoder_attention_mask')
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        negative_kwargs = dict(
+            negative_prompt=model_kwargs.get('negative_prompt'),
+            negative_prompt_attention_mask=model_kwargs.get('negative_prompt_attention_mask'),
+        )
+        eos_token_id = torch.tensor(eos_token_id, dtype=torch.long, device=input_ids.device)
+
+        # Both caches hold all tokens except the last one, which is fed in the next forward pass
+        cache = EncoderDecoderCache(DynamicCache(), DynamicCache())
+        draft_cache = EncoderDecoderCache(DynamicCache(), DynamicCache())
+
+        while input_ids.shape[1] < max_length:
+            length = input_ids.shape[1]
+
+            # Propose draft tokens, leaving room for the token of the main model
+            draft_ids, draft_mask = input_ids, attention_mask
+            draft_probs = []
+            for _ in range(min(self.num_draft_tokens, max_length - length - 1)):
+                logits = self._forward(self.draft_model, draft_encoder_outputs, draft_cache, draft_ids, draft_mask, negative_kwargs)
+                scores = draft_logits_processor(draft_ids, logits[:, -1].float())
+                probs = F.softmax(scores, dim=-1)
+                token = torch.multinomial(probs, 1) if do_sample else scores.argmax(dim=-1, keepdim=True)
+                draft_probs.append(probs)
+                draft_ids = torch.cat((draft_ids, token), dim=1)
+                draft_mask = F.pad(draft_mask, (0, 1), value=1)
+                if torch.isin(token, eos_token_id).any():
+                    break
+            num_draft = len(draft_probs)
+
+            # Verify all draft tokens with one forward pass of the main model
+            logits = self._forward(model, encoder_outputs, cache, draft_ids, draft_mask, negative_kwargs)[:, -(num_draft + 1):]
+            new_tokens = []
+            for i in range(num_draft + 1):
+                # The logits processors are called once for every generated token, just like in regular generation
+                scores = logits_processor(draft_ids[:, :length + i], logits[:, i].float())
+                if i == num_draft:
+                    new_tokens.append(self._pick(scores, do_sample))
+                    break
+
+                draft_token = draft_ids[:, length + i:length + i + 1]
+                if do_sample:
+                    probs = F.softmax(scores, dim=-1)
+                    p = probs.gather(-1, draft_token)
+                    q = draft_probs[i].gather(-1, draft_token)
+                    if torch.rand_like(p) * q < p:
+                        new_tokens.append(draft_token)
+                        continue
+                    # Sample from the part of the distribution of the main model that the draft model under-proposes
+                    residual = (probs - draft_probs[i]).clamp(min=0)
+                    if residual.sum() <= 0:
+                        residual = probs
+                    new_tokens.append(torch.multinomial(residual / residual.sum(dim=-1, keepdim=True), 1))
+                    break
+
+                token = scores.argmax(dim=-1, keepdim=True)
+                new_tokens.append(token)
+                if not torch.equal(token, draft_token):
+                    break
+
+            self.proposed += num_draft
+            self.accepted += len(new_tokens) - 1
+
+            new_tokens = torch.cat(new_tokens, dim=1)
+            eos_indices = torch.isin(new_tokens[0], eos_token_id).nonzero()
+            finished = len(eos_indices) > 0
+            if finished:
+                new_tokens = new_tokens[:, :eos_indices[0, 0] + 1]
+            input_ids = torch.cat((input_ids, new_tokens), dim=1)[:, :max_length]
+            attention_mask = F.pad(attention_mask, (0, input_ids.shape[1] - attention_mask.shape[1]), value=1)
+            if finished:
+                break
+
+            # Forget the rejected draft tokens
+            cache.crop(input_ids.shape[1] - 1)
+            draft_cache.crop(input_ids.shape[1] - 1)
+
+        return input_ids
+
+    @staticmethod
+    def _pick(scores: torch.FloatTensor, do_sample: bool) -> torch.LongTensor:
+        if do_sample:
+            return torch.multinomial(F.softmax(scores, dim=-1), 1)
+        return scores.argmax(dim=-1, keepdim=True)
+
+    @staticmethod
+    def _forward(
+            model: Mapperatorinator,
+            encoder_outputs: BaseModelOutput,
+            cache: EncoderDecoderCache,
+            input_ids: torch.LongTensor,
+            attention_mask: torch.Tensor,
+            negative_kwargs: dict,
+    ) -> torch.FloatTensor:
+        """Feeds the tokens which are not in the cache yet and returns their logits."""
+        cache_position = torch.arange(cache.get_seq_length(), input_ids.shape[1], device=input_ids.device)
+        inputs = model.prepare_inputs_for_generation(
+            input_ids,
+            past_key_values=cache,
+            use_cache=True,
+            encoder_outputs=encoder_outputs,
+            decoder_attention_mask=attention_mask,
+            cache_position=cache_position,
+            **negative_kwargs,
+        )
+        return model(**inputs).logits
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+from transformers import GenerationConfig
+from transformers.modeling_utils import no_init_weights
+from transformers.utils import cached_file
+
+from ..model import Mapperatorinator
+from ..model.configuration_mapperatorinator import MapperatorinatorConfig
+
+WEIGHTS_NAME = "model.safetensors"
+ALIASES_KEY = "aliases"
+BUFFERS_KEY = "buffers"
+
+
+def get_weights_cache_path(cache_dir: str, ckpt_path_str: str, precision: str) -> Path:
+    """Returns the cache entry of a checkpoint in the given precision.
+
+    Local checkpoints are identified by their path and the sizes and modification times of their files,
+    Hugging Face Hub checkpoints by the snapshot they resolve to, so updated checkpoints get a new entry.
+    """
+    ckpt_path = Path(ckpt_path_str)
+    if ckpt_path.is_dir():
+        source = str(ckpt_path.resolve())
+        files = sorted((f.name, f.stat().st_size, f.stat().st_mtime_ns) for f in ckpt_path.iterdir() if f.is_file())
+    else:
+        source = str(Path(cached_file(ckpt_path_str, "config.json")).parent)
+        files = []
+    key = json.dumps([source, files, precision])
+    return Path(cache_dir).expanduser() / hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def save_cached_model(model: Mapperatorinator, path: Path) -> None:
+    """Saves the weights of a model as they are, so they load without conversion, next to its config.
+    Tensors which share storage, like tied embeddings, are saved once.
+    Non-persistent buffers are saved too, so a loaded model needs no further conversion or device transfer."""
+    state_dict = model.state_dict()
+    buffers = [name for name, _ in model.named_buffers() if name not in state_dict]
+    state_dict.update((name, model.get_buffer(name)) for name in buffers)
+    tensors = {}
+    aliases = {}
+    names_by_storage = {}
+    for name, tensor in state_dict.items():
+        key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape), tensor.dtype)
+        if key in names_by_storage:
+            aliases[name] = names_by_storage[key]
+        else:
+            names_by_storage[key] = name
+            tensors[name] = tensor.detach().contiguous().cpu()
+
+    # Write to a temporary directory first so concurrent loaders never see a partial entry
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(tempfile.mkdtemp(dir=path.parent, suffix=".tmp"))
+    try:
+        save_file(tensors, tmp_path / WEIGHTS_NAME, metadata={ALIASES_KEY: json.dumps(aliases), BUFFERS_KEY: json.dumps(buffers)})
+        model.config.save_pretrained(tmp_path)
+        model.generation_config.save_pretrained(tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        # Another process may have written the entry first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_cached_model(path: Path, device) -> Optional[Mapperatorinator]:
+    """Builds a model from a cache entry without initializing its weights and memory-maps the cached weights into it.
+    The model is returned in the precision and on the device it was cached with.
+    Returns None if there is no complete entry."""
+    if not (path / WEIGHTS_NAME).exists():
+        return None
+
+    config = MapperatorinatorConfig.from_pretrained(path)
+    with no_init_weights():
+        model = Mapperatorinator(config)
+    model.generation_config = GenerationConfig.from_pretrained(path)
+
+    state_dict = load_file(path / WEIGHTS_NAME, device=str(device))
+    with safe_open(path / WEIGHTS_NAME, framework="pt") as f:
+        metadata = f.metadata() or {}
+    for name, target in json.loads(metadata.get(ALIASES_KEY, "{}")).items():
+        state_dict[name] = state_dict[target]
+
+    for name in json.loads(metadata.get(BUFFERS_KEY, "[]")):
+        module_name, _, buffer_name = name.rpartition(".")
+        model.get_submodule(module_name).register_buffer(buffer_name, state_dict.pop(name), persistent=False)
+
+    model.load_state_dict(state_dict, assign=True)
+    return model
@@ -1 +1,20 @@
-from .modeling_mapperatorinator import Mapperatorinator
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .modeling_mapperatorinator import Mapperatorinator
+
+# The model is imported on first access, so light submodules like the spectrogram do not load transformers
+_LAZY_EXPORTS = {
+    "Mapperatorinator": ".modeling_mapperatorinator",
+}
+
+__all__ = list(_LAZY_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _LAZY_EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import torch
+
+# Number of 64-bit words in the hash of the audio of a row
+HASH_WORDS = 2
+INT_DTYPES = {1: torch.int8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+
+class EncoderOutputCache:
+    """
+    Byte-bounded LRU cache of encoder outputs for single rows.
+    Rows are keyed by a hash of their audio samples and the values of their conditioning inputs,
+    so repeated passes over the same audio windows, like timing and then map generation, skip the encoder.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple, torch.Tensor] = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.hash_weights: dict[tuple[int, str], torch.Tensor] = {}
+
+    def _get_hash_weights(self, length: int, device: torch.device) -> torch.Tensor:
+        key = (length, str(device))
+        with self.lock:
+            weights = self.hash_weights.get(key)
+            if weights is None:
+                generator = torch.Generator().manual_seed(length)
+                weights = torch.randint(-2 ** 63, 2 ** 63 - 1, (HASH_WORDS, length), dtype=torch.int64, generator=generator).to(device)
+                self.hash_weights[key] = weights
+            return weights
+
+    def get_keys(
+            self,
+            frames: torch.Tensor,
+            conditions: list[Optional[torch.Tensor]],
+    ) -> list[tuple]:
+        """Returns the cache key of each row of the batch.
+        The audio of each row is hashed on its device with a random multilinear hash of the raw bits of its samples,
+        so only the hashes are copied to the host."""
+        bits = frames.detach().reshape(frames.shape[0], -1)
+        bits = bits.view(INT_DTYPES[bits.element_size()]).to(torch.int64)
+        weights = self._get_hash_weights(bits.shape[1], bits.device)
+        # Integer products and sums wrap around, so the hash does not depend on the order of the reduction
+        audio_hashes = torch.stack([(bits * w).sum(dim=1) for w in weights], dim=1).tolist()
+        conditions = [c.detach().cpu().tolist() if c is not None else None for c in conditions]
+        context = (str(frames.device), frames.dtype, torch.is_autocast_enabled())
+        keys = []
+        for i in range(frames.shape[0]):
+            row_conditions = tuple(str(c[i]) if c is not None else None for c in conditions)
+            keys.append((tuple(audio_hashes[i]), row_conditions, context))
+        return keys
+
+    def get(self, key: tuple) -> Optional[torch.Tensor]:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: tuple, value: torch.Tensor):
+        nbytes = value.numel() * value.element_size()
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = value
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.numel() * evicted.element_size()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
@@ -11,6 +11,7 @@ from transformers.modeling_outputs import Seq2SeqLMOutput, BaseModelOutput
 from .configuration_mapperatorinator import MapperatorinatorConfig
 from .custom_transformers import NWhisperConfig, RoPEWhisperConfig, NWhisperForConditionalGeneration, \
     RoPEWhisperForConditionalGeneration
+from .encoder_cache import EncoderOutputCache
 from .spectrogram import MelSpectrogram
 
 LABEL_IGNORE_ID = -100
@@ -107,6 +108,11 @@ class Mapperatorinator(PreTrainedModel, GenerationMixin):
             self.decoder_embedder = nn.Embedding(config.vocab_size_in, d_model)
             self.decoder_embedder.weight.data.normal_(mean=0.0, std=config.init_std)
 
+        # Cache of encoder outputs for inference, see enable_encoder_cache
+        self.encoder_cache: Optional[EncoderOutputCache] = None
+        # Draft model for speculative decoding in inference, see inference.speculative
+        self.speculative_decoder = None
+
         class_weights = torch.ones(config.vocab_size)
         class_weights[config.rhythm_token_start:config.rhythm_token_end] = config.rhythm_weight
         self.loss_fn = nn.CrossEntropyLoss(
@@ -131,7 +137,7 @@ class Mapperatorinator(PreTrainedModel, GenerationMixin):
             **kwargs
     ) -> Seq2SeqLMOutput:
         """
-        frames: B x L_encoder x mel_bins, float32
+        frames: B x L_encoder x mel_bins, float32, or B x L_samples audio which is converted to a spectrogram
         decoder_input_ids: B x L_decoder, int64
         beatmap_idx: B, int64
         beatmap_id: B, int64
@@ -143,8 +149,12 @@ class Mapperatorinator(PreTrainedModel, GenerationMixin):
             beatmap_idx = torch.full([batch_size], self.num_classes, dtype=torch.long, device=device)
 
         inputs_embeds = None
-        if encoder_outputs is None and frames is not None:
-            frames = self.spectrogram(frames)  # (N, L, M)
+        if encoder_outputs is None and frames is not None and self.encoder_cache is not None and labels is None:
+            # Go through the encoder module, so the encoder outputs get cached
+            encoder_outputs = self.get_encoder()(frames, beatmap_idx, difficulty, mapper_idx, song_position, return_dict=True)
+        elif encoder_outputs is None and frames is not None:
+            if frames.dim() == 2:
+                frames = self.spectrogram(frames)  # (N, L, M)
             frames = frames.to(dtype=self.transformer.dtype)  # Ensure correct dtype for the model
             conds = []
 
@@ -276,6 +286,11 @@ class Mapperatorinator(PreTrainedModel, GenerationMixin):
     def can_generate(self) -> bool:
         return True
 
+    def enable_encoder_cache(self, max_bytes: int):
+        """Caches up to max_bytes of encoder outputs, so windows with identical audio and conditioning skip the encoder.
+        Only used when gradients are disabled. Pass 0 to disable the cache."""
+        self.encoder_cache = EncoderOutputCache(max_bytes) if max_bytes > 0 else None
+
     def get_encoder(self):
         return OsuTEncoder(
             self.transformer.get_encoder(),
@@ -292,6 +307,7 @@ class Mapperatorinator(PreTrainedModel, GenerationMixin):
             self.do_difficulty_embed,
             self.do_mapper_embed,
             self.do_song_position_embed,
+            self.encoder_cache,
         )
 
     def get_decoder(self):
@@ -315,6 +331,7 @@ class OsuTEncoder(nn.Module):
             do_difficulty_embed: bool,
             do_mapper_embed: bool,
             do_song_position_embed: bool,
+            encoder_cache: Optional[EncoderOutputCache] = None,
     ):
         super().__init__()
         self.base = base_encoder
@@ -331,6 +348,7 @@ class OsuTEncoder(nn.Module):
         self.do_difficulty_embed = do_difficulty_embed
         self.do_mapper_embed = do_mapper_embed
         self.do_song_position_embed = do_song_position_embed
+        self.encoder_cache = encoder_cache
 
     def forward(
             self,
@@ -348,7 +366,46 @@ class OsuTEncoder(nn.Module):
             device = frames.device
             beatmap_idx = torch.full([batch_size], self.num_classes, dtype=torch.long, device=device)
 
-        frames = self.spectrogram(frames)  # (N, L, M)
+        if self.encoder_cache is None or output_attentions or output_hidden_states or torch.is_grad_enabled():
+            return self._encode(frames, beatmap_idx, difficulty, mapper_idx, song_position, output_attentions, output_hidden_states, return_dict)
+
+        # Only run the encoder for rows that are not cached
+        conditions = [beatmap_idx if self.do_style_embed else None,
+                      difficulty if self.do_difficulty_embed else None,
+                      mapper_idx if self.do_mapper_embed else None,
+                      song_position if self.do_song_position_embed else None]
+        keys = self.encoder_cache.get_keys(frames, conditions)
+        rows = [self.encoder_cache.get(key) for key in keys]
+        # Rows with the same key, like variants which only differ in decoder conditioning, are encoded once
+        missing = {}
+        for i, row in enumerate(rows):
+            if row is None:
+                missing.setdefault(keys[i], []).append(i)
+        if len(missing) > 0:
+            index = torch.tensor([indices[0] for indices in missing.values()], dtype=torch.long, device=frames.device)
+            outputs = self._encode(frames[index], *(c[index] if c is not None else None for c in [beatmap_idx, difficulty, mapper_idx, song_position]), return_dict=True)
+            for (key, indices), row in zip(missing.items(), outputs.last_hidden_state):
+                row = row.clone()  # Clone, so the cache does not keep the whole batch alive
+                self.encoder_cache.put(key, row)
+                for i in indices:
+                    rows[i] = row
+
+        last_hidden_state = torch.stack(rows)
+        return BaseModelOutput(last_hidden_state=last_hidden_state) if return_dict else (last_hidden_state,)
+
+    def _encode(
+            self,
+            frames: torch.FloatTensor,
+            beatmap_idx: Optional[torch.Tensor] = None,
+            difficulty: Optional[torch.Tensor] = None,
+            mapper_idx: Optional[torch.Tensor] = None,
+            song_position: Optional[torch.Tensor] = None,
+            output_attentions: bool = False,
+            output_hidden_states: bool = False,
+            return_dict: bool = False
+    ):
+        if frames.dim() == 2:
+            frames = self.spectrogram(frames)  # (N, L, M)
         frames = frames.to(dtype=self.base.dtype)  # Ensure correct dtype for the model
         conds = []
 
@@ -2,7 +2,7 @@ import json
 import os
 import pickle
 from pathlib import Path
-from typing import Union, Optional
+from typing import Union, Optional, Sequence
 
 import numpy as np
 import pandas as pd
@@ -42,6 +42,13 @@ class Tokenizer(PushToHubMixin):
         "num_descriptor_classes",
         "num_cs_classes",
         "metadata",
+        "event_types",
+        "event_type_index",
+        "event_offsets",
+        "event_min_values",
+        "event_max_values",
+        "token_type_indices",
+        "token_values",
     ]
 
     def __init__(self, args: TrainConfig = None):
@@ -230,6 +237,27 @@ class Tokenizer(PushToHubMixin):
             er.max_value - er.min_value + 1 for er in self.input_event_ranges
         )
 
+        self._init_lookup_tables()
+
+    def _init_lookup_tables(self) -> None:
+        """Precomputes dense lookup tables, so encoding and decoding do not have to search the event ranges."""
+        self.event_types: list[EventType] = list(self.event_range.keys())
+        self.event_type_index: dict[EventType, int] = {event_type: i for i, event_type in enumerate(self.event_types)}
+        event_ranges = [self.event_range[event_type] for event_type in self.event_types]
+        self.event_offsets = np.array([self.event_start[er.type] - er.min_value for er in event_ranges], dtype=np.int64)
+        self.event_min_values = np.array([er.min_value for er in event_ranges], dtype=np.int64)
+        self.event_max_values = np.array([er.max_value for er in event_ranges], dtype=np.int64)
+
+        # Token id -> index in event_types and event value, -1 for tokens which are not events
+        self.token_type_indices = np.full(self.vocab_size_in, -1, dtype=np.int64)
+        self.token_values = np.zeros(self.vocab_size_in, dtype=np.int64)
+        offset = self.offset
+        for er in self.event_ranges + self.input_event_ranges:
+            size = er.max_value - er.min_value + 1
+            self.token_type_indices[offset:offset + size] = self.event_type_index[er.type]
+            self.token_values[offset:offset + size] = np.arange(er.min_value, er.max_value + 1)
+            offset += size
+
     @property
     def pad_id(self) -> int:
         """[PAD] token for padding."""
@@ -247,18 +275,33 @@ class Tokenizer(PushToHubMixin):
 
     def decode(self, token_id: int) -> Event:
         """Converts token ids into Event objects."""
-        offset = self.offset
-        for er in self.event_ranges:
-            if offset <= token_id <= offset + er.max_value - er.min_value:
-                return Event(type=er.type, value=er.min_value + token_id - offset)
-            offset += er.max_value - er.min_value + 1
-        for er in self.input_event_ranges:
-            if offset <= token_id <= offset + er.max_value - er.min_value:
-                return Event(type=er.type, value=er.min_value + token_id - offset)
-            offset += er.max_value - er.min_value + 1
+        if 0 <= token_id < len(self.token_type_indices):
+            type_index = self.token_type_indices[token_id]
+            if type_index >= 0:
+                return Event(type=self.event_types[type_index], value=int(self.token_values[token_id]))
 
         raise ValueError(f"id {token_id} is not mapped to any event")
 
+    def decode_many(self, token_ids) -> tuple[np.ndarray, np.ndarray]:
+        """Converts an array of token ids into events at once.
+
+        Args:
+            token_ids: NumPy array or torch tensor of token ids.
+
+        Returns:
+            type_indices: Index of the event type of each token in event_types, or -1 if the token is not an event.
+            values: Event value of each token, 0 if the token is not an event.
+        """
+        if hasattr(token_ids, "cpu"):
+            token_ids = token_ids.cpu().numpy()
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        is_event = (token_ids >= 0) & (token_ids < len(self.token_type_indices))
+        type_indices = np.full(token_ids.shape, -1, dtype=np.int64)
+        type_indices[is_event] = self.token_type_indices[token_ids[is_event]]
+        values = np.zeros(token_ids.shape, dtype=np.int64)
+        values[is_event] = self.token_values[token_ids[is_event]]
+        return type_indices, values
+
     def encode(self, event: Event) -> int:
         """Converts Event objects into token ids."""
         if event.type not in self.event_range:
@@ -275,6 +318,28 @@ class Tokenizer(PushToHubMixin):
 
         return offset + event.value - er.min_value
 
+    def encode_many(self, event_types: Sequence[EventType], values) -> np.ndarray:
+        """Converts events given as a sequence of event types and an array of values into token ids at once.
+
+        Args:
+            event_types: Type of each event.
+            values: NumPy array or torch tensor with the value of each event.
+
+        Returns:
+            token_ids: Token id of each event.
+        """
+        if hasattr(values, "cpu"):
+            values = values.cpu().numpy()
+        values = np.asarray(values, dtype=np.int64)
+        type_indices = np.fromiter((self.event_type_index.get(t, -1) for t in event_types), dtype=np.int64, count=len(values))
+        invalid = (type_indices < 0)
+        invalid[~invalid] = (values[~invalid] < self.event_min_values[type_indices[~invalid]]) | (values[~invalid] > self.event_max_values[type_indices[~invalid]])
+        if invalid.any():
+            # Raise the same error as encode for the first invalid event
+            i = int(invalid.argmax())
+            self.encode(Event(type=event_types[i], value=int(values[i])))
+        return self.event_offsets[type_indices] + values
+
     def event_type_range(self, event_type: EventType) -> tuple[int, int]:
         """Get the token id range of each Event type."""
         if event_type not in self.event_range:
@@ -706,6 +771,7 @@ class Tokenizer(PushToHubMixin):
             self.num_descriptor_classes = state_dict["num_descriptor_classes"]
         if "num_cs_classes" in state_dict:
             self.num_cs_classes = state_dict["num_cs_classes"]
+        self._init_lookup_tables()
 
     def load_context_type_dict(self, d):
         if isinstance(d, dict) and all(isinstance(k, ContextType) and isinstance(v, int) for k, v in d.items()):
@@ -1,5 +1,29 @@
-from .utils.data_loading import repeat_type
-from .utils.tokenizer import Tokenizer
-from .utils.positional_embedding import timestep_embedding
-from .utils.diffusion import create_diffusion
-from .utils.models import DiT_models, DiT
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .utils.data_loading import repeat_type
+    from .utils.tokenizer import Tokenizer
+    from .utils.positional_embedding import timestep_embedding
+    from .utils.diffusion import create_diffusion
+    from .utils.models import DiT_models, DiT
+
+# Exports are imported on first access, so importing osu_diffusion.config does not load torch and the models
+_LAZY_EXPORTS = {
+    "repeat_type": ".utils.data_loading",
+    "Tokenizer": ".utils.tokenizer",
+    "timestep_embedding": ".utils.positional_embedding",
+    "create_diffusion": ".utils.diffusion",
+    "DiT_models": ".utils.models",
+    "DiT": ".utils.models",
+}
+
+__all__ = list(_LAZY_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _LAZY_EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value